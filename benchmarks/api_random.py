@@ -0,0 +1,84 @@
+"""
+load test of /random at different pool sizes, the old full-transfer pick vs the rank-based pick,
+it needs a running redis and uses its own key, which is deleted afterwards
+
+usage: python -m benchmarks.api_random --sizes 1000 10000 50000 --requests 2000 --threads 8
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from models import convert_proxy_or_proxies
+from proxy_server import app
+from setting import PROXY_SCORE_MAX, PROXY_SCORE_MIN
+from trans4redis import RedisClient
+
+BENCH_KEY = 'proxies:bench:random'
+
+
+def legacy_random(conn):
+    """
+    the pick used before, which transfers every max score proxy for each call
+    """
+    proxies = conn.db.zrangebyscore(conn.key, PROXY_SCORE_MAX, PROXY_SCORE_MAX)
+    if len(proxies):
+        return convert_proxy_or_proxies(random.choice(proxies))
+    proxies = conn.db.zrevrange(conn.key, PROXY_SCORE_MIN, PROXY_SCORE_MAX)
+    return convert_proxy_or_proxies(random.choice(proxies))
+
+
+def populate(conn, size):
+    """
+    fill the pool, half of the proxies with max score
+    """
+    conn.db.delete(conn.key)
+    pipe = conn.db.pipeline(transaction=False)
+    for i in range(size):
+        proxy = f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:8080'
+        pipe.zadd(conn.key, {proxy: PROXY_SCORE_MAX if i % 2 else random.randint(1, PROXY_SCORE_MAX - 1)})
+    pipe.incr(conn.version_key)
+    pipe.execute()
+
+
+def run(name, size, func, requests, threads):
+    latencies = []
+
+    def call(_):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(call, range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f'{name:<20} size {size:>7} {requests / elapsed:>10.1f} req/s p99 {p99:>8.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/random benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='pool sizes')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per case')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients')
+    args = parser.parse_args()
+
+    conn = RedisClient(key=BENCH_KEY)
+    app.redis = conn
+    client = app.test_client()
+    try:
+        for size in args.sizes:
+            populate(conn, size)
+            run('legacy', size, lambda: legacy_random(conn), args.requests, args.threads)
+            run('rank', size, conn.random, args.requests, args.threads)
+            run('weighted', size, lambda: conn.random(weighted=True), args.requests, args.threads)
+            run('/random', size, lambda: client.get('/random'), args.requests, args.threads)
+            run('/random?weighted=1', size, lambda: client.get('/random?weighted=1'), args.requests, args.threads)
+    finally:
+        conn.db.delete(conn.key)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+requests/sec and p99 latency of the api, gevent WSGI server vs aiohttp server,
+it needs a running redis and uses its own key, which is deleted afterwards
+
+usage: python -m benchmarks.api_server --size 10000 --requests 20000 --concurrency 200 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+BENCH_KEY = 'proxies:bench:server'
+
+
+def serve(method, port, workers):
+    """
+    run one server in this process, called in a subprocess with REDIS_KEY pointing to the bench key
+    """
+    if method == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        from proxy_server import app
+        WSGIServer(('127.0.0.1', port), app, log=None).serve_forever()
+    else:
+        from proxy_server_async import run_app
+        run_app('127.0.0.1', port, workers)
+
+
+async def load(url, requests, concurrency):
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(url)
+
+    async def worker(session):
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            async with session.get(url) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return requests / elapsed, latencies[int(len(latencies) * 0.99) - 1] * 1000
+
+
+def wait_ready(url, timeout=10):
+    async def ping():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                await response.read()
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            asyncio.run(ping())
+            return
+        except aiohttp.ClientError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server at {url} not ready')
+
+
+def populate(size):
+    from trans4redis import RedisClient
+    conn = RedisClient(key=BENCH_KEY)
+    conn.db.delete(conn.key)
+    pipe = conn.db.pipeline(transaction=False)
+    for i in range(size):
+        pipe.zadd(conn.key, {f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:8080': 100 if i % 2 else 10})
+    pipe.incr(conn.version_key)
+    pipe.execute()
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='api server benchmark')
+    parser.add_argument('--serve', choices=['gevent', 'aiohttp'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=15555, help='port of the server under test')
+    parser.add_argument('--size', type=int, default=10000, help='pool size')
+    parser.add_argument('--requests', type=int, default=20000, help='requests per case')
+    parser.add_argument('--concurrency', type=int, default=200, help='concurrent connections')
+    parser.add_argument('--workers', type=int, default=0, help='aiohttp worker processes, 0 means number of cpus')
+    parser.add_argument('--paths', nargs='+', default=['/random', '/count', '/all?limit=100'], help='paths to load')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.workers)
+        return
+
+    conn = populate(args.size)
+    # servers remove LOG_DIR when logging is disabled, so they get a directory of their own
+    log_dir = tempfile.mkdtemp(prefix='proxypool-bench-')
+    env = {**os.environ, 'REDIS_KEY': BENCH_KEY, 'PROXYPOOL_REDIS_KEY': BENCH_KEY,
+           'APP_ENV': 'prod', 'ENABLE_API_CACHE': 'true', 'ENABLE_LOG': 'false', 'LOG_DIR': log_dir}
+    try:
+        for method in ('gevent', 'aiohttp'):
+            server = subprocess.Popen([sys.executable, '-m', 'benchmarks.api_server', '--serve', method,
+                                       '--port', str(args.port), '--workers', str(args.workers)], env=env)
+            try:
+                base = f'http://127.0.0.1:{args.port}'
+                wait_ready(base + '/count')
+                for path in args.paths:
+                    rps, p99 = asyncio.run(load(base + path, args.requests, args.concurrency))
+                    print(f'{method:<8} {path:<16} {rps:>10.1f} req/s p99 {p99:>8.2f}ms')
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        conn.db.delete(conn.key, conn.version_key)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
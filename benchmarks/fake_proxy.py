@@ -0,0 +1,37 @@
+"""
+local stand-in http proxy for benchmarks, it answers every request itself
+instead of forwarding it, so a benchmark only measures the client side
+"""
+import asyncio
+
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\nConnection: keep-alive\r\n\r\nok'
+
+
+async def _handle(reader, writer):
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            if not head:
+                break
+            writer.write(RESPONSE)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_fake_proxies(ports, host='127.0.0.1'):
+    """
+    start one fake proxy on each port
+    :param ports: list of ports
+    :param host: listen host
+    :return: list of asyncio servers
+    """
+    return [await asyncio.start_server(_handle, host, port, reuse_address=True) for port in ports]
+
+
+async def stop_fake_proxies(servers):
+    for server in servers:
+        server.close()
+        await server.wait_closed()
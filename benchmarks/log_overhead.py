@@ -0,0 +1,99 @@
+"""
+benchmark of logging overhead inside an event loop, handlers writing synchronously as before
+vs the queue handler of handle_log with and without rate limiting, the same file and console
+handlers are used in all cases, the console goes to os.devnull
+
+usage: python -m benchmarks.log_overhead --tasks 500 --messages 200
+"""
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import tempfile
+import time
+from logging.handlers import QueueListener
+
+from handle_log import LOG_FORMAT, ProcessQueueHandler, RateLimitFilter
+
+
+def create_handlers(directory):
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(open(os.devnull, 'w')), logging.FileHandler(os.path.join(directory, 'bench.log'))]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+async def ticker(lags, interval=0.001):
+    """
+    measure how late the loop wakes up a sleeping task
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def task(logger, messages):
+    for i in range(messages):
+        logger.debug('proxy 127.0.0.1:%d is valid, set max score, latency %.0fms', i, 12.5)
+        await asyncio.sleep(0)
+
+
+async def run(logger, tasks, messages):
+    lags = []
+    tick = asyncio.ensure_future(ticker(lags))
+    start = time.perf_counter()
+    await asyncio.gather(*[task(logger, messages) for _ in range(tasks)])
+    elapsed = time.perf_counter() - start
+    tick.cancel()
+    return elapsed, max(lags, default=0)
+
+
+def bench(name, tasks, messages, handlers=(), queued=False, rate_limit=None):
+    logger = logging.getLogger(f'bench.{name}')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    listener = None
+    if not queued:
+        for handler in handlers:
+            logger.addHandler(handler)
+    else:
+        records = queue.SimpleQueue()
+        handler = ProcessQueueHandler(records)
+        if rate_limit is not None:
+            handler.addFilter(rate_limit)
+        logger.addHandler(handler)
+        listener = QueueListener(records, *handlers)
+        listener.start()
+    elapsed, lag = asyncio.run(run(logger, tasks, messages))
+    if listener is not None:
+        start = time.perf_counter()
+        listener.stop()
+        drain = time.perf_counter() - start
+    else:
+        drain = 0
+    total = tasks * messages
+    print(f'{name:<12} {total:>9} records {elapsed:>8.3f}s in loop {elapsed / total * 1e6:>8.2f}us/record '
+          f'max loop lag {lag * 1000:>8.2f}ms drained in {drain:.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logging overhead benchmark')
+    parser.add_argument('--tasks', type=int, default=500, help='number of concurrent tasks')
+    parser.add_argument('--messages', type=int, default=200, help='number of records logged by one task')
+    parser.add_argument('--rate', type=float, default=20, help='records per second of one call site')
+    parser.add_argument('--burst', type=int, default=100, help='burst of one call site')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        bench('no handler', args.tasks, args.messages)
+        bench('sync', args.tasks, args.messages, create_handlers(directory))
+        bench('queue', args.tasks, args.messages, create_handlers(directory), queued=True)
+        bench('queue+limit', args.tasks, args.messages, create_handlers(directory), queued=True,
+              rate_limit=RateLimitFilter(args.rate, args.burst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+memory and time of proxy representations at 50k-1M proxies:
+strings, Proxy namedtuples, a set of packed ints and a ProxyArray
+
+usage: python -m benchmarks.models --sizes 50000 200000 1000000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from models import ProxyArray, convert_proxy_or_proxies, pack_proxy
+
+
+def make_strings(size):
+    return [f'{10 + (i >> 24 & 200)}.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:{8000 + i % 1000}' for i in range(size)]
+
+
+CASES = {
+    'list of str': lambda strings: list(strings),
+    'list of Proxy': lambda strings: convert_proxy_or_proxies(strings),
+    'set of str': lambda strings: set(strings),
+    'set of packed int': lambda strings: {pack_proxy(s) for s in strings},
+    'ProxyArray': lambda strings: ProxyArray(strings),
+}
+
+
+def measure(build, strings):
+    """
+    :return: seconds to build, bytes allocated by the result, seconds to format all back to strings
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build(strings)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    start = time.perf_counter()
+    result = build(strings)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for proxy in result:
+        str(proxy)
+    formatted = time.perf_counter() - start
+    return elapsed, size, formatted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='proxy representation benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50000, 200000, 1000000], help='numbers of proxies')
+    args = parser.parse_args()
+    for size in args.sizes:
+        tracemalloc.start()
+        strings = make_strings(size)
+        nbytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{size:>8} {"the strings themselves":<20} {nbytes / 2 ** 20:>44.1f} MiB  {nbytes / size:>6.1f} B/proxy')
+        for name, build in CASES.items():
+            elapsed, nbytes, formatted = measure(build, strings)
+            print(f'{size:>8} {name:<20} build {elapsed:>7.3f}s  format {formatted:>7.3f}s  '
+                  f'{nbytes / 2 ** 20:>8.1f} MiB  {nbytes / size:>6.1f} B/proxy')
+
+
+if __name__ == '__main__':
+    main()
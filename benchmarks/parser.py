@@ -0,0 +1,82 @@
+"""
+benchmark of the source page parsers over the saved pages in benchmarks/corpus,
+reports MB/s parsed and proxies extracted per page, and fails if a page yields
+a different number of proxies or follow-up urls than recorded in corpus/index.json
+
+usage: python -m benchmarks.parser --repeat 200
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from os.path import dirname, join
+
+from models import Proxy, pack_proxy
+from proxy_getter import parse_page
+
+CORPUS_DIR = join(dirname(__file__), 'corpus')
+
+# patterns used before, to compare with
+LEGACY_PROXY_PATTERN = r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\D+(\d{1,5})'
+LEGACY_PAGE_LIST_PATTERN = r'href="([^"]+)".*?>.*?2.*?<[\D,\s]*?href="([^"]+)".*?>.*?3.*?<[\D,\s]*?href="([^"]+)"'
+
+
+def legacy_is_valid_proxy(data):
+    if ':' in data:
+        ip = data.split(':')[0]
+        port = data.split(':')[1]
+        a = ip.split('.')
+        return len(a) == 4 and all(x.isdigit() and 0 <= int(x) <= 255 for x in a) and len(port) < 6
+    return False
+
+
+def legacy_parse_html(text):
+    re.findall(LEGACY_PAGE_LIST_PATTERN, text)
+    proxies = [Proxy(ip=ip, port=port) for ip, port in re.findall(LEGACY_PROXY_PATTERN, text)]
+    return [proxy for proxy in dict.fromkeys(proxies) if legacy_is_valid_proxy(f'{proxy}')]
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='parser benchmark')
+    parser.add_argument('--repeat', type=int, default=200, help='times every page is parsed')
+    args = parser.parse_args()
+
+    with open(join(CORPUS_DIR, 'index.json'), encoding='utf-8') as f:
+        index = json.load(f)
+    failed = False
+    proxies_seen = []
+    for name, meta in index.items():
+        with open(join(CORPUS_DIR, name), encoding='utf-8') as f:
+            text = f.read()
+        mb = len(text.encode('utf-8')) * args.repeat / 1e6
+        elapsed, (proxies, next_urls) = timeit(
+            lambda: parse_page(meta['url'], meta['parsetype'], meta.get('next_type'), text), args.repeat)
+        proxies_seen.extend(str(proxy) for proxy in proxies)
+        line = f'{name:<26} {mb / elapsed:>8.1f} MB/s {len(proxies):>5} proxies/page {len(next_urls):>2} urls'
+        if meta['parsetype'] == 'html':
+            legacy_elapsed, _ = timeit(lambda: legacy_parse_html(text), args.repeat)
+            line += f'   legacy {mb / legacy_elapsed:>8.1f} MB/s'
+        if len(proxies) != meta['proxies'] or len(next_urls) != meta['next_urls']:
+            failed = True
+            line += f'   MISMATCH, expected {meta["proxies"]} proxies {meta["next_urls"]} urls'
+        print(line)
+
+    repeat = max(args.repeat // 10, 1)
+    count = len(proxies_seen) * repeat
+    elapsed, _ = timeit(lambda: [pack_proxy(proxy) for proxy in proxies_seen], repeat)
+    legacy_elapsed, _ = timeit(lambda: [legacy_is_valid_proxy(proxy) for proxy in proxies_seen], repeat)
+    print(f'{"validate":<26} {count / elapsed:>10.0f} proxies/s   legacy {count / legacy_elapsed:>10.0f} proxies/s')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
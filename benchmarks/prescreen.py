@@ -0,0 +1,58 @@
+"""
+benchmark of tester cycle time on a mostly unreachable pool, with and without the tcp pre-screen,
+live proxies are fake proxies on local ports, dead ones point to --dead-host, which should drop
+connections like most dead proxies do, 192.0.2.1 is reserved for documentation and usually does
+
+usage: python -m benchmarks.prescreen --proxies 2000 --dead 0.9
+"""
+import argparse
+import asyncio
+
+from benchmarks.fake_proxy import start_fake_proxies, stop_fake_proxies
+from benchmarks.tester import ResultSink
+from models import Proxy
+from proxy_tester import Tester
+from setting import PROXY_SCORE_INIT
+
+
+def bench(name, prescreen, proxies, ports):
+    tester = Tester(anonymous=False, prescreen=prescreen)
+    tester.writer = ResultSink()
+
+    async def produce(queue):
+        for proxy in proxies:
+            await queue.put((proxy, PROXY_SCORE_INIT))
+
+    tester.produce = produce
+    loop = tester.loop
+    asyncio.set_event_loop(loop)
+    servers = loop.run_until_complete(start_fake_proxies(ports))
+    try:
+        stats = loop.run_until_complete(tester.run())
+    finally:
+        loop.run_until_complete(stop_fake_proxies(servers))
+    print(f'{name:<16} {stats["tested"]:>8} proxies {stats["duration"]:>8.2f}s {stats["throughput"]:>10.1f} proxies/s '
+          f'valid {stats["valid"]} invalid {stats["invalid"]} unreachable {stats["unreachable"]}')
+    return stats['duration']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tester pre-screen benchmark')
+    parser.add_argument('--proxies', type=int, default=2000, help='number of proxies in the pool')
+    parser.add_argument('--dead', type=float, default=0.9, help='ratio of unreachable proxies')
+    parser.add_argument('--dead-host', default='192.0.2.1', help='host of unreachable proxies')
+    parser.add_argument('--ports', type=int, default=50, help='number of fake proxies to listen on')
+    parser.add_argument('--base-port', type=int, default=18000, help='first port of fake proxies')
+    args = parser.parse_args()
+
+    ports = list(range(args.base_port, args.base_port + args.ports))
+    dead = int(args.proxies * args.dead)
+    proxies = [Proxy(ip=args.dead_host, port=str(10000 + i % 50000)) for i in range(dead)]
+    proxies += [Proxy(ip='127.0.0.1', port=str(ports[i % len(ports)])) for i in range(args.proxies - dead)]
+    without = bench('http only', False, proxies, ports)
+    with_prescreen = bench('tcp pre-screen', True, proxies, ports)
+    print(f'cycle time reduced by {(1 - with_prescreen / without) * 100:.1f}%')
+
+
+if __name__ == '__main__':
+    main()
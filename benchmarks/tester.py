@@ -0,0 +1,79 @@
+"""
+benchmark of proxies validated per second by Tester, one session per proxy vs shared session
+
+usage: python -m benchmarks.tester --proxies 5000 --ports 50
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.fake_proxy import start_fake_proxies, stop_fake_proxies
+from models import Proxy
+from proxy_tester import Tester
+
+
+class ResultSink(object):
+    """
+    stands in for the score buffer of RedisClient, so only the testing itself is measured
+    """
+
+    def __init__(self):
+        self.valid = 0
+        self.invalid = 0
+        self.evicted = 0
+
+    def max(self, proxy, latency=None, connect=None, anonymous=False, https=False):
+        self.valid += 1
+
+    def decrease(self, proxy):
+        self.invalid += 1
+
+    def evict(self, proxy):
+        self.evicted += 1
+
+    def full(self):
+        return False
+
+    def flush(self):
+        return 0
+
+
+async def _run(tester, proxies):
+    session = tester.create_session() if tester.shared_session else None
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*[tester.test(proxy, session) for proxy in proxies])
+        return time.perf_counter() - start
+    finally:
+        if session is not None:
+            await session.close()
+
+
+def bench(name, tester, proxies, ports):
+    tester.writer = ResultSink()
+    loop = tester.loop
+    asyncio.set_event_loop(loop)
+    servers = loop.run_until_complete(start_fake_proxies(ports))
+    try:
+        elapsed = loop.run_until_complete(_run(tester, proxies))
+    finally:
+        loop.run_until_complete(stop_fake_proxies(servers))
+    print(f'{name:<24} {len(proxies):>8} proxies {elapsed:>8.2f}s {len(proxies) / elapsed:>10.1f} proxies/s '
+          f'valid {tester.writer.valid} invalid {tester.writer.invalid}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tester benchmark')
+    parser.add_argument('--proxies', type=int, default=5000, help='number of proxies to validate')
+    parser.add_argument('--ports', type=int, default=50, help='number of fake proxies to listen on')
+    parser.add_argument('--base-port', type=int, default=18000, help='first port of fake proxies')
+    args = parser.parse_args()
+
+    ports = list(range(args.base_port, args.base_port + args.ports))
+    proxies = [Proxy(ip='127.0.0.1', port=str(ports[i % len(ports)])) for i in range(args.proxies)]
+    bench('session per proxy', Tester(shared_session=False, headers_pool_size=0, anonymous=False), proxies, ports)
+    bench('shared session', Tester(shared_session=True, headers_pool_size=100, anonymous=False), proxies, ports)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+benchmark of proxies validated per second by Scheduler.run_tester_workers with 1, 2, 4 ... worker processes,
+the workers share the due queue of a pool of fake proxies served by separate processes,
+it needs a running redis and uses its own key, which is deleted afterwards
+
+proxies are spread over loopback addresses 127.x.y.z, so fake proxies listen on all interfaces
+
+usage: python -m benchmarks.tester_workers --proxies 20000 --workers 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from benchmarks.fake_proxy import start_fake_proxies, stop_fake_proxies
+
+BENCH_KEY = 'proxies:bench:testers'
+
+
+def serve_fake_proxies(ports, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    servers = loop.run_until_complete(start_fake_proxies(ports, host='0.0.0.0'))
+    ready.set()
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(stop_fake_proxies(servers))
+
+
+def reset(conn):
+    """
+    delete the bench key with all its records, heartbeats of workers included
+    """
+    keys = list(conn.db.scan_iter(f'{BENCH_KEY}*'))
+    if keys:
+        conn.db.delete(*keys)
+
+
+def bench(workers, proxies, conn, timeout):
+    """
+    add proxies to a fresh pool, all of them due at once, and let the workers test it for one cycle
+    """
+    from scheduler import Scheduler
+    reset(conn)
+    conn.add_many(proxies)
+    stats = Scheduler(tester_workers=workers).run_tester_workers(cycle=timeout, window=timeout, rounds=1)
+    print(f'{workers:>3} workers {stats["tested"]:>8} proxies {stats["duration"]:>8.2f}s '
+          f'{stats["throughput"]:>10.1f} proxies/s valid {stats["valid"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tester workers benchmark')
+    parser.add_argument('--proxies', type=int, default=20000, help='number of proxies to validate')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='max number of tester workers, doubled from 1')
+    parser.add_argument('--servers', type=int, default=2, help='number of processes serving fake proxies')
+    parser.add_argument('--ports', type=int, default=50, help='number of fake proxies to listen on')
+    parser.add_argument('--base-port', type=int, default=18000, help='first port of fake proxies')
+    parser.add_argument('--timeout', type=int, default=600, help='max seconds to wait for one case')
+    args = parser.parse_args()
+
+    # settings are read on import, so they are set before the tester is imported, and workers inherit them,
+    # testers remove LOG_DIR when logging is disabled, so they get a directory of their own
+    log_dir = tempfile.mkdtemp(prefix='proxypool-bench-')
+    os.environ.update({'REDIS_KEY': BENCH_KEY, 'PROXYPOOL_REDIS_KEY': BENCH_KEY, 'REDIS_TIERED': 'false',
+                       'TEST_ADAPTIVE': 'true', 'TEST_ANONYMOUS': 'false', 'ENABLE_LOG': 'false',
+                       'LOG_DIR': log_dir})
+    from models import Proxy
+    from trans4redis import RedisClient
+
+    ports = list(range(args.base_port, args.base_port + args.ports))
+    proxies = [Proxy(ip=f'127.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}', port=str(ports[n % len(ports)]))
+               for n in range(1, args.proxies + 1)]
+    servers = []
+    for i in range(args.servers):
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve_fake_proxies, args=(ports[i::args.servers], ready), daemon=True)
+        server.start()
+        ready.wait()
+        servers.append(server)
+    conn = RedisClient(key=BENCH_KEY)
+    try:
+        workers = 1
+        while workers <= args.workers:
+            bench(workers, proxies, conn, args.timeout)
+            workers *= 2
+    finally:
+        reset(conn)
+        for server in servers:
+            server.terminate()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
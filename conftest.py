@@ -0,0 +1,43 @@
+import os
+import tempfile
+import types
+
+import pytest
+
+# settings are read on import, logs of the tests go to a directory of their own,
+# which is removed when logging is disabled
+os.environ.setdefault('LOG_DIR', tempfile.mkdtemp(prefix='proxypool-test-'))
+os.environ.setdefault('ENABLE_LOG', 'false')
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """
+    point the blocking and asyncio clients of trans4redis to one in-memory redis, lua scripts need lupa
+    """
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    import trans4redis
+    server = fakeredis.FakeServer()
+
+    class FakeStrictRedis(fakeredis.FakeStrictRedis):
+        def __init__(self, host=None, port=None, password=None, db=0, **kwargs):
+            super().__init__(server=server, db=db, **kwargs)
+
+        @classmethod
+        def from_url(cls, url, **kwargs):
+            return cls(**kwargs)
+
+    def fake_async_redis(*args, **kwargs):
+        return fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+
+    monkeypatch.setattr(trans4redis.redis, 'StrictRedis', FakeStrictRedis)
+    monkeypatch.setattr(trans4redis, 'aioredis', types.SimpleNamespace(
+        ConnectionPool=lambda **kwargs: None, Redis=fake_async_redis, from_url=fake_async_redis))
+    return server
+
+
+@pytest.fixture
+def conn(redis_server):
+    from trans4redis import RedisClient
+    return RedisClient()
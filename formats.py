@@ -0,0 +1,20 @@
+import json
+
+__all__ = ['make_formats', 'ALL_FORMATS', 'FASTEST_FORMATS']
+
+
+def make_formats(field):
+    """
+    renderers of pages of (proxy, value) by format name, shared by the flask and aiohttp servers
+    :param field: name of value in jsonl format
+    :return: dict of format name to (mimetype, render function)
+    """
+    return {
+        'text': ('text/plain', lambda page: ''.join(f'{proxy}\n' for proxy, _ in page)),
+        'jsonl': ('application/x-ndjson',
+                  lambda page: ''.join(json.dumps({'proxy': proxy, field: value}) + '\n' for proxy, value in page)),
+    }
+
+
+ALL_FORMATS = make_formats('score')
+FASTEST_FORMATS = make_formats('latency')
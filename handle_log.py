@@ -1,15 +1,277 @@
+import atexit
+import glob
+import json
 import logging
+import multiprocessing.util
+import os
+import queue
+import re
 import shutil
 import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 from os import mkdir
 from os.path import join, exists
 from setting import LOG_LEVEL, ENABLE_LOG_FILE, ENABLE_LOG_RUNTIME_FILE, env, LOG_DIR, ENABLE_LOG_ERROR_FILE, \
-    ENABLE_LOG, ENABLE_LOG_CONSOLE
+    ENABLE_LOG, ENABLE_LOG_CONSOLE, LOG_ROTATION, LOG_RETENTION, LOG_RATE_LIMIT, LOG_RATE_BURST, LOG_JSON
 
 loggers = {}
 
 LOG_FORMAT = '%(levelname)s - %(asctime)s - pid: %(process)d -tid: %(thread)d - %(name)s - %(module)s - %(message)s'
 
+SIZE_UNITS = {'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+DURATION_UNITS = {'s': 1, 'second': 1, 'm': 60, 'minute': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400,
+                  'w': 604800, 'week': 604800}
+
+
+def parse_size(value):
+    """
+    parse size like 500MB or 1 GB
+    :param value: str
+    :return: bytes, None if it is not a size
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?b)\s*', value or '', re.IGNORECASE)
+    if not match:
+        return None
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_duration(value):
+    """
+    parse duration like 1 week, 12 hours or 30m
+    :param value: str
+    :return: seconds, None if it is not a duration
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([a-z]+?)s?\s*', value or '', re.IGNORECASE)
+    if not match or match.group(2).lower() not in DURATION_UNITS:
+        return None
+    return float(match.group(1)) * DURATION_UNITS[match.group(2).lower()]
+
+
+class RotatingFileHandler(logging.FileHandler):
+    """
+    file handler which rotates the file once it exceeds a size or an age, rotated files are named by
+    the time of rotation and removed once they are out of retention, the file may be shared by processes,
+    a process reopens it once another one rotated it
+    """
+
+    def __init__(self, filename, rotation=LOG_ROTATION, retention=LOG_RETENTION):
+        """
+        :param filename: path of log file
+        :param rotation: size like 500MB or age like 1 day, no rotation if empty
+        :param retention: age like 1 week, or number of rotated files to keep, keep all if empty
+        """
+        super().__init__(filename, encoding='utf-8')
+        self.max_bytes = parse_size(rotation) or 0
+        self.interval = 0 if self.max_bytes else parse_duration(rotation) or 0
+        retention = (retention or '').strip()
+        self.retention_count = int(retention) if retention.isdigit() else 0
+        self.retention_seconds = parse_duration(retention) or 0
+        self.rollover_at = time.time() + self.interval
+
+    def reopen_if_rotated(self):
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = self._open()
+            self.rollover_at = time.time() + self.interval
+
+    def should_rollover(self) -> bool:
+        if self.max_bytes:
+            return os.fstat(self.stream.fileno()).st_size >= self.max_bytes
+        return bool(self.interval) and time.time() >= self.rollover_at
+
+    def rollover(self):
+        self.stream.close()
+        target = f'{self.baseFilename}.{time.strftime("%Y%m%d-%H%M%S")}'
+        if exists(target):
+            target = f'{target}.{os.getpid()}'
+        try:
+            os.rename(self.baseFilename, target)
+        except OSError:
+            # rotated by another process in the meantime
+            pass
+        self.stream = self._open()
+        self.rollover_at = time.time() + self.interval
+        self.remove_expired()
+
+    def remove_expired(self):
+        rotated = []
+        for path in glob.glob(glob.escape(self.baseFilename) + '.*'):
+            try:
+                rotated.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        rotated.sort(reverse=True)
+        now = time.time()
+        for i, (mtime, path) in enumerate(rotated):
+            if self.retention_count and i >= self.retention_count or \
+                    self.retention_seconds and now - mtime > self.retention_seconds:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def emit(self, record):
+        if self.stream is not None and (self.max_bytes or self.interval):
+            try:
+                self.reopen_if_rotated()
+                if self.should_rollover():
+                    self.rollover()
+            except OSError:
+                self.handleError(record)
+                return
+        super().emit(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    format record as one json line
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'pid': record.process,
+            'tid': record.thread,
+            'name': record.name,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    let records below WARNING of one call site through at most rate times per second, with bursts of burst,
+    the next record let through tells how many were dropped
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT, burst=LOG_RATE_BURST):
+        """
+        :param rate: records per second of one call site, 0 means no limit
+        :param burst: max records of one call site let through at once
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # call site: [tokens, last update, dropped records]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate or record.levelno >= logging.WARNING:
+            return True
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(site)
+            if bucket is None:
+                bucket = self.buckets[site] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1
+            dropped, bucket[2] = bucket[2], 0
+        if dropped:
+            record.msg, record.args = f'({dropped} similar messages dropped) {record.getMessage()}', None
+        return True
+
+
+def create_handlers():
+    """
+    create handlers writing records, which are run by the listener thread
+    :return: list of handlers
+    """
+    formatter = JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT)
+    handlers = []
+    # 输出到控制台
+    if ENABLE_LOG_CONSOLE:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    if ENABLE_LOG_FILE:
+        if (ENABLE_LOG_RUNTIME_FILE or ENABLE_LOG_ERROR_FILE) and not exists(LOG_DIR):
+            mkdir(LOG_DIR)
+        if ENABLE_LOG_RUNTIME_FILE:
+            handlers.append(RotatingFileHandler(join(LOG_DIR, 'runtime.log')))
+        if ENABLE_LOG_ERROR_FILE:
+            handler = RotatingFileHandler(join(LOG_DIR, 'error.log'))
+            handler.setLevel(logging.ERROR)
+            handlers.append(handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+# queue and listener of this process, created again in a forked process as threads do not survive a fork
+_queue, _listener, _listener_pid = None, None, None
+_listener_lock = threading.Lock()
+
+
+def get_queue():
+    """
+    get the queue of the listener of this process, start the listener at the first call
+    :return: queue
+    """
+    global _queue, _listener, _listener_pid
+    if _listener_pid != os.getpid():
+        with _listener_lock:
+            if _listener_pid != os.getpid():
+                _queue = queue.SimpleQueue()
+                _listener = QueueListener(_queue, *create_handlers(), respect_handler_level=True)
+                _listener.start()
+                _listener_pid = os.getpid()
+                # processes started by multiprocessing skip atexit, but run its finalizers
+                atexit.register(stop_listener)
+                multiprocessing.util.Finalize(None, stop_listener, exitpriority=0)
+    return _queue
+
+
+def stop_listener():
+    """
+    write out records left in the queue and stop the listener of this process
+    """
+    global _listener_pid
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            _listener.stop()
+            _listener_pid = None
+
+
+class ProcessQueueHandler(QueueHandler):
+    """
+    hand records over to the listener thread of this process, so callers never wait for writes,
+    records are formatted by the listener, the caller only merges the args into the message
+    """
+
+    def __init__(self, queue=None):
+        """
+        :param queue: queue read by a listener, defaults to the queue of the listener of this process
+        """
+        super().__init__(queue)
+
+    def prepare(self, record):
+        # unlike QueueHandler.prepare, neither format nor copy the record, args are merged so that
+        # objects changed after the call are logged as they were
+        if record.args:
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        (self.queue or get_queue()).put_nowait(record)
+
+
+rate_limit_filter = RateLimitFilter()
+
 
 def get_logger(name=None):
     """
@@ -28,36 +290,11 @@ def get_logger(name=None):
     logger = logging.getLogger(name)
     logger.setLevel(LOG_LEVEL)
 
-    # 输出到控制台
-    if ENABLE_LOG and ENABLE_LOG_CONSOLE:
-        stream_handler = logging.StreamHandler(sys.stdout)
-        stream_handler.setLevel(level=LOG_LEVEL)
-        formatter = logging.Formatter(LOG_FORMAT)
-        stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
-
-    if ENABLE_LOG and ENABLE_LOG_FILE:
-        if ENABLE_LOG_RUNTIME_FILE:
-            if not exists(LOG_DIR):
-                mkdir(LOG_DIR)
-            log_file = join(LOG_DIR, 'runtime.log')
-            if not exists(log_file):
-                open(log_file, 'x').close()
-            file_handler_runtime = logging.FileHandler(log_file)
-            formatter = logging.Formatter(LOG_FORMAT)
-            file_handler_runtime.setFormatter(formatter)
-            logger.addHandler(file_handler_runtime)
-        if ENABLE_LOG_ERROR_FILE:
-            if not exists(LOG_DIR):
-                mkdir(LOG_DIR)
-            log_file = join(LOG_DIR, 'error.log')
-            if not exists(log_file):
-                open(log_file, 'w').close()
-            file_handler_error = logging.FileHandler(log_file)
-            formatter = logging.Formatter(LOG_FORMAT)
-            file_handler_error.setFormatter(formatter)
-            logger.addHandler(file_handler_error)
-    else:
+    if ENABLE_LOG and (ENABLE_LOG_CONSOLE or ENABLE_LOG_FILE):
+        handler = ProcessQueueHandler()
+        handler.addFilter(rate_limit_filter)
+        logger.addHandler(handler)
+    if not (ENABLE_LOG and ENABLE_LOG_FILE):
         shutil.rmtree(LOG_DIR, ignore_errors=True)
     # 保存到全局 loggers
     loggers[name] = logger
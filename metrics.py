@@ -0,0 +1,288 @@
+import json
+import os
+import socket
+import threading
+import time
+from functools import wraps
+
+from setting import ENABLE_METRICS, METRICS_PUSH_INTERVAL, METRICS_TTL
+from handle_log import get_logger
+
+logger = get_logger('metrics')
+
+# buckets of latency histograms in seconds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# buckets of proxy latency histograms in ms
+MS_BUCKETS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000)
+
+
+class Counter(object):
+    """
+    monotonically increasing value per set of label values
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: metric name
+        :param help: description of metric
+        :param labels: names of labels
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dump(self) -> list:
+        """
+        :return: list of [label values, value], json serializable
+        """
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+
+class Histogram(Counter):
+    """
+    distribution of observed values per set of label values, in cumulative buckets
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        """
+        :param buckets: upper bounds of buckets, sorted ascending
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # cumulative counts of buckets, then total count and sum
+                state = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += 1
+            state[-1] += value
+
+    def time(self, **labels):
+        """
+        context manager observing the seconds spent in it
+        """
+        return _Timer(self, labels)
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry(object):
+    """
+    metrics of this process
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help, labels=(), **kwargs):
+        """
+        get metric by name, and create it at the first call
+        """
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, labels, **kwargs)
+            return self.metrics[name]
+
+    def dump(self) -> dict:
+        """
+        :return: snapshot of all metrics, json serializable
+        """
+        return {name: {'type': metric.type, 'help': metric.help, 'labels': list(metric.labels),
+                       'buckets': list(getattr(metric, 'buckets', ())), 'values': metric.dump()}
+                for name, metric in list(self.metrics.items())}
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()) -> Counter:
+    return REGISTRY.register(Counter, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=SECONDS_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram, name, help, labels, buckets=buckets)
+
+
+REDIS_SECONDS = histogram('proxypool_redis_call_seconds', 'latency of redis client calls', ('method',))
+# observed by both the flask and aiohttp servers
+API_SECONDS = histogram('proxypool_api_request_seconds', 'latency of api requests, by route and status',
+                        ('route', 'status'))
+
+
+def timed(func):
+    """
+    decorator observing latency of redis client methods
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - start, method=name)
+
+    return wrapper
+
+
+def merge(dumps) -> dict:
+    """
+    merge metrics dumped by several processes, values of the same labels are summed
+    :param dumps: list of results of Registry.dump
+    :return: merged dump
+    """
+    merged = {}
+    for dump in dumps:
+        for name, metric in dump.items():
+            target = merged.setdefault(name, {**metric, 'values': {}})
+            for key, value in metric['values']:
+                key = tuple(key)
+                old = target['values'].get(key)
+                if old is None:
+                    target['values'][key] = value
+                elif isinstance(value, list):
+                    target['values'][key] = [a + b for a, b in zip(old, value)]
+                else:
+                    target['values'][key] = old + value
+    return merged
+
+
+def _labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render(merged) -> str:
+    """
+    render merged metrics in prometheus text format
+    :param merged: result of merge
+    :return: text
+    """
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for key, value in sorted(metric['values'].items()):
+            if metric['type'] == 'histogram':
+                bounds = [str(bound) for bound in metric['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value[:len(bounds) - 1] + [value[-2]]):
+                    lines.append(f'{name}_bucket{_labels(metric["labels"], key, ("le", bound))} {count}')
+                lines.append(f'{name}_count{_labels(metric["labels"], key)} {value[-2]}')
+                lines.append(f'{name}_sum{_labels(metric["labels"], key)} {value[-1]}')
+            else:
+                lines.append(f'{name}{_labels(metric["labels"], key)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsPusher(threading.Thread):
+    """
+    push metrics of this process to redis periodically, where they are merged with those of
+    the other processes by collect, a process stops counting once its push expires
+    """
+
+    def __init__(self, db, key, interval=METRICS_PUSH_INTERVAL, ttl=METRICS_TTL):
+        """
+        :param db: redis connection
+        :param key: key of the pool
+        :param interval: seconds between pushes
+        :param ttl: seconds a push is kept
+        """
+        super().__init__(daemon=True)
+        self.db = db
+        self.key = f'{key}:metrics'
+        self.pid = os.getpid()
+        self.id = f'{socket.gethostname()}:{self.pid}'
+        self.interval = interval
+        self.ttl = ttl
+
+    def push(self):
+        pipe = self.db.pipeline(transaction=False)
+        pipe.set(f'{self.key}:{self.id}', json.dumps(REGISTRY.dump()), ex=self.ttl)
+        pipe.zadd(self.key, {self.id: time.time()})
+        pipe.execute()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.push()
+            except Exception as e:
+                logger.error(f'push metrics failed: {e!r}')
+
+
+# pusher of this process, started once per process, as threads do not survive a fork
+_pusher = None
+
+
+def start_pusher(db, key):
+    """
+    start pushing metrics of this process to redis, if not started yet
+    :param db: redis connection
+    :param key: key of the pool
+    """
+    global _pusher
+    if not ENABLE_METRICS:
+        return
+    if _pusher is not None and _pusher.pid == os.getpid():
+        return
+    _pusher = MetricsPusher(db, key)
+    _pusher.start()
+
+
+def collect(db, key, ttl=METRICS_TTL) -> str:
+    """
+    collect metrics pushed by all processes and render them
+    :param db: redis connection
+    :param key: key of the pool
+    :param ttl: seconds after which a process without push is dropped
+    :return: text in prometheus format
+    """
+    key = f'{key}:metrics'
+    now = time.time()
+    pipe = db.pipeline(transaction=False)
+    pipe.zremrangebyscore(key, '-inf', now - ttl)
+    pipe.zrange(key, 0, -1)
+    # metrics of this process are taken fresh instead of from its last push
+    own = f'{socket.gethostname()}:{os.getpid()}'
+    ids = [i for i in pipe.execute()[-1] if i != own]
+    dumps = [json.loads(dump) for dump in db.mget([f'{key}:{i}' for i in ids]) if dump] if ids else []
+    dumps.append(REGISTRY.dump())
+    return render(merge(dumps))
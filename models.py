@@ -1,43 +1,65 @@
+import re
+from array import array
 from collections import namedtuple
+from socket import inet_aton
 
 _Proxy = namedtuple('Proxy', ['ip', 'port'])
 
+# dotted decimal ipv4 with every octet within 0-255 and no leading zeros, used with fullmatch
+IP_PATTERN = re.compile(r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(?:\.(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}')
+
 
 class Proxy(_Proxy):
     def __str__(self):
         return f'{self.ip}:{self.port}'
 
 
-def is_valid_proxy(data):
+def pack_ip_port(ip, port):
     """
-    check this string is within proxy format
+    validate ip and port and pack them into a 48 bits int,
+    ip in the high 32 bits and port in the low 16 bits
+    :param ip: string like 8.8.8.8
+    :param port: int or string of digits, 0 or empty string if absent
+    :return: int, None if invalid
     """
-    if ':' in data:
-        ip = data.split(':')[0]
-        port = data.split(':')[1]
-        return is_ip_valid(ip) and is_port_valid(port)
-    else:
-        return is_ip_valid(data)
+    if IP_PATTERN.fullmatch(ip) is None:
+        return None
+    if isinstance(port, str):
+        if not port:
+            port = 0
+        elif port.isascii() and port.isdigit() and len(port) <= 5:
+            port = int(port)
+        else:
+            return None
+    if not 0 <= port <= 65535:
+        return None
+    return int.from_bytes(inet_aton(ip), 'big') << 16 | port
 
 
-def is_ip_valid(ip):
+def pack_proxy(data):
     """
-    check this string is within ip format
+    validate ip or ip:port string in a single pass and pack it into a 48 bits int, port is 0 if absent
+    :param data: string like 8.8.8.8:88
+    :return: int, None if invalid
     """
-    a = ip.split('.')
-    if len(a) != 4:
-        return False
-    for x in a:
-        if not x.isdigit():
-            return False
-        i = int(x)
-        if i < 0 or i > 255:
-            return False
-    return True
+    ip, _, port = data.partition(':')
+    return pack_ip_port(ip, port)
+
 
+def unpack_proxy(value):
+    """
+    format an int packed by pack_proxy back to ip:port
+    :param value: int
+    :return: string like 8.8.8.8:88
+    """
+    return f'{value >> 40 & 255}.{value >> 32 & 255}.{value >> 24 & 255}.{value >> 16 & 255}:{value & 65535}'
 
-def is_port_valid(port):
-    return len(port) < 6
+
+def is_valid_proxy(data):
+    """
+    check this string is within proxy format
+    """
+    return pack_proxy(data) is not None
 
 
 def convert_proxy_or_proxies(data):
@@ -54,11 +76,69 @@ def convert_proxy_or_proxies(data):
         for item in data:
             # skip invalid item
             item = item.strip()
-            if not is_valid_proxy(item):
+            ip, _, port = item.partition(':')
+            if not port or pack_ip_port(ip, port) is None:
                 continue
-            ip, port = item.split(':')
             result.append(Proxy(ip=ip, port=port))
         return result
-    if isinstance(data, str) and is_valid_proxy(data):
-        ip, port = data.split(':')
-        return Proxy(ip=ip, port=port)
+    if isinstance(data, str):
+        ip, _, port = data.partition(':')
+        if port and pack_ip_port(ip, port) is not None:
+            return Proxy(ip=ip, port=port)
+
+
+class ProxyArray(object):
+    """
+    array of proxies packed as unsigned 64 bits ints, 8 bytes per proxy
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, proxies=()):
+        """
+        :param proxies: iterable of strings, Proxy or packed ints, invalid ones are dropped
+        """
+        self.values = array('Q')
+        self.extend(proxies)
+
+    @staticmethod
+    def _pack(proxy):
+        if isinstance(proxy, int):
+            return proxy
+        if isinstance(proxy, Proxy):
+            return pack_ip_port(proxy.ip, proxy.port)
+        return pack_proxy(proxy)
+
+    def append(self, proxy) -> bool:
+        """
+        :return: whether proxy is valid and appended
+        """
+        value = self._pack(proxy)
+        if value is None:
+            return False
+        self.values.append(value)
+        return True
+
+    def extend(self, proxies):
+        for proxy in proxies:
+            self.append(proxy)
+
+    def unique(self) -> 'ProxyArray':
+        """
+        :return: new array of distinct proxies sorted by packed value
+        """
+        result = ProxyArray()
+        result.values = array('Q', sorted(set(self.values)))
+        return result
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return unpack_proxy(self.values[i])
+
+    def __iter__(self):
+        return map(unpack_proxy, self.values)
+
+    def __contains__(self, proxy):
+        return self._pack(proxy) in self.values
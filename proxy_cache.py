@@ -0,0 +1,175 @@
+import random
+import threading
+import time
+from array import array
+from bisect import bisect
+
+from base_exception import PoolEmptyException
+from models import Proxy, ProxyArray, convert_proxy_or_proxies
+from trans4redis import RedisClient
+from handle_log import get_logger
+from setting import API_CACHE_SIZE, API_CACHE_POLL, API_CACHE_TTL, PROXY_SCORE_MAX, PROXY_SCORE_MIN
+
+logger = get_logger('ProxyCache')
+
+
+class Snapshot(object):
+    """
+    top ranked proxies of the pool at a point of time, proxies are kept packed
+    in a ProxyArray and cumulative scores in a float array
+    """
+
+    __slots__ = ('proxies', 'cum_scores', 'max_count', 'count', 'version', 'created')
+
+    def __init__(self, version, count, proxies):
+        """
+        :param version: version of pool
+        :param count: count of all proxies in pool
+        :param proxies: list of (proxy, score) sorted by score desc
+        """
+        self.version = version
+        self.count = count
+        self.proxies = ProxyArray()
+        self.cum_scores = array('d')
+        self.max_count = 0
+        total = 0
+        for proxy, score in proxies:
+            if not self.proxies.append(proxy):
+                continue
+            total += score
+            self.cum_scores.append(total)
+            if score >= PROXY_SCORE_MAX:
+                self.max_count += 1
+        self.created = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+    def covers(self, weighted=False) -> bool:
+        """
+        whether random picks from this snapshot follow the same distribution as RedisClient.random,
+        a weighted pick needs the whole pool, others all max score proxies, or the top ranks if there is none
+        :param weighted: pick with probability proportional to score
+        :return: bool
+        """
+        if len(self.proxies) >= self.count:
+            return True
+        if weighted:
+            return False
+        if self.max_count:
+            return self.max_count < len(self.proxies)
+        return len(self.proxies) >= PROXY_SCORE_MAX - PROXY_SCORE_MIN + 1
+
+    def random(self, weighted=False) -> str:
+        """
+        same rules as RedisClient.random
+        :param weighted: pick with probability proportional to score
+        :return: proxy string
+        """
+        if weighted and self.cum_scores and self.cum_scores[-1] > 0:
+            i = bisect(self.cum_scores, random.random() * self.cum_scores[-1])
+            return self.proxies[min(i, len(self.proxies) - 1)]
+        count = self.max_count or min(len(self.proxies), PROXY_SCORE_MAX - PROXY_SCORE_MIN + 1)
+        if not count:
+            raise PoolEmptyException
+        return self.proxies[random.randrange(count)]
+
+
+class ProxyCache(object):
+    """
+    in-process cache of the pool, a background thread reloads the snapshot
+    once the pool version changes, which happens when the set of max score proxies changes,
+    or once the snapshot is older than ttl, which picks up count and other scores,
+    a snapshot older than max_age is never served
+    """
+
+    def __init__(self, redis: RedisClient, size=API_CACHE_SIZE, poll=API_CACHE_POLL, ttl=API_CACHE_TTL):
+        """
+        :param redis: redis client
+        :param size: number of top ranked proxies to keep
+        :param poll: seconds between checks of the pool version
+        :param ttl: seconds after which the snapshot is reloaded anyway
+        """
+        self.redis = redis
+        self.size = size
+        self.poll = poll
+        self.ttl = ttl
+        self.max_age = ttl * 2
+        self.snapshot = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        start the background thread once
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='proxy-cache', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh_if_needed()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f'refresh proxy cache failed: {e}')
+            time.sleep(self.poll)
+
+    def refresh_if_needed(self):
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.age() >= self.ttl or self.redis.version() != snapshot.version:
+            self.refresh()
+
+    def refresh(self):
+        self.snapshot = Snapshot(*self.redis.snapshot(self.size))
+        self.refreshes += 1
+        logger.debug(f'proxy cache refreshed, version {self.snapshot.version}, '
+                     f'{len(self.snapshot.proxies)}/{self.snapshot.count} proxies')
+
+    def current(self, weighted=None):
+        """
+        get snapshot if it is fresh enough, count the hit or miss
+        :param weighted: if not None, the snapshot must also cover random picks of this kind, a snapshot
+        truncated to size is not used for picks which would differ from those of the whole pool
+        :return: Snapshot or None
+        """
+        self.start()
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.age() <= self.max_age and \
+                (weighted is None or snapshot.covers(weighted)):
+            self.hits += 1
+            return snapshot
+        self.misses += 1
+        return None
+
+    def random(self, weighted=False) -> Proxy:
+        snapshot = self.current(weighted)
+        if snapshot is None:
+            return self.redis.random(weighted=weighted)
+        return convert_proxy_or_proxies(snapshot.random(weighted=weighted))
+
+    def count(self) -> int:
+        snapshot = self.current()
+        if snapshot is None:
+            return self.redis.count()
+        return snapshot.count
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0,
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+            'snapshot_age': snapshot.age() if snapshot else None,
+            'snapshot_version': snapshot.version if snapshot else None,
+            'snapshot_size': len(snapshot.proxies) if snapshot else 0,
+        }
@@ -1,36 +1,95 @@
+import asyncio
 import base64
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
-import queue
 import re
-from pprint import pprint
+import time
+from urllib.parse import urlsplit
 
+import aiohttp
 from fake_headers import Headers
-import requests
-from retrying import RetryError, retry
-# import urllib3
 
-from models import Proxy
-from setting import GET_TIMEOUT
+from models import Proxy, pack_ip_port
+from setting import GET_TIMEOUT, GET_CONCURRENCY, GET_CONCURRENCY_PER_HOST, GET_RETRIES, GET_BACKOFF, \
+    GET_BACKOFF_MAX, GET_DUMP_FILE, TOMBSTONE_TTL
 from init_urls import init_urls
 from trans4redis import RedisClient
 from handle_log import get_logger
-
-# urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from metrics import counter, histogram, start_pusher
 
 logger = get_logger('Getter')
 
+FETCH_SECONDS = histogram('proxypool_getter_fetch_seconds', 'duration of page fetch attempts, by host and result',
+                          ('source', 'result'))
+PROXIES = counter('proxypool_getter_proxies_total', 'proxies parsed, by host and whether new to pool, known, '
+                  'or skipped as recently evicted', ('source', 'status'))
+
+# returned by Fetcher.fetch if the page is the same as last time
+NOT_MODIFIED = object()
+
+# ip not preceded by a digit or dot, then port within a short gap of non-digits, like <td>1.2.3.4</td><td>80</td>,
+# the lookbehind comes after the first digit so the pattern still starts with a digit and is searched fast
+PROXY_HTML_PATTERN = re.compile(r'(\d(?<![\d.]\d)\d{0,2}\.\d{1,3}\.\d{1,3}\.\d{1,3})(?![\d.])\D{1,128}(\d{1,5})(?!\d)')
+BASE64_PATTERN = re.compile(r'window\.atob\("([A-Za-z0-9+/=]+)"\)\D{0,128}(\d{1,5})(?!\d)')
+# anchor with its text, like <a href="/2.html">2</a>
+ANCHOR_PATTERN = re.compile(r'<a\b[^>]*?\bhref="([^"]+)"[^>]*>([^<]*)<', re.IGNORECASE)
+CLICK_PAGE_PATTERN = re.compile(r'href="(/dayProxy/ip/\d{4}\.html)"\D{0,512}?href="(/dayProxy/ip/\d{4}\.html)"')
+
+
+def _valid_proxies(pairs):
+    """
+    build proxies from (ip, port) pairs, drop invalid and duplicated ones
+    :param pairs: iterable of (ip, port)
+    :return: list of proxies
+    """
+    seen = set()
+    proxies = []
+    for ip, port in pairs:
+        packed = pack_ip_port(ip, port)
+        if packed is None or packed in seen:
+            continue
+        seen.add(packed)
+        proxies.append(Proxy(ip=ip, port=str(port)))
+    return proxies
+
+
+def store_proxies(source, proxies, redis_trans):
+    """
+    store proxies parsed from one source in bulk, skip proxies evicted lately
+    :param source: url the proxies come from
+    :param proxies: list of proxies
+    :param redis_trans: redis client
+    :return: count of new proxies, count of known proxies, count of dead proxies skipped
+    """
+    if not proxies:
+        return 0, 0, 0
+    parsed = len(proxies)
+    if TOMBSTONE_TTL:
+        dead = redis_trans.dead(proxies)
+        if dead:
+            proxies = [proxy for proxy in proxies if str(proxy) not in dead]
+    new, known = redis_trans.add_many(proxies) if proxies else (0, 0)
+    skipped = parsed - len(proxies)
+    host = urlsplit(source).netloc
+    PROXIES.inc(new, source=host, status='new')
+    PROXIES.inc(known, source=host, status='known')
+    PROXIES.inc(skipped, source=host, status='dead')
+    logger.info(f'{source}: {parsed} proxies parsed, {new} new, {known} known, {skipped} dead '
+                f'({skipped / parsed:.0%} skipped)')
+    return new, known, skipped
+
 
 def _get_proxies_base64_in(html):
     """
     handle some string encoded by base64 in a html
     """
-    lst_base64_in = re.findall(r'window\.atob\("(\S+)"\)[\D,\s]*?(\d{1,5})', html)
-    for item in lst_base64_in:
-        ip = base64.b64decode(item[0]).decode('utf-8')
-        port = item[1]
-        proxy = Proxy(ip=ip, port=port)
-        logger.info('put new proxy %s', proxy)
+    pairs = []
+    for encoded, port in BASE64_PATTERN.findall(html):
+        try:
+            pairs.append((base64.b64decode(encoded).decode('utf-8'), port))
+        except (ValueError, UnicodeDecodeError):
+            continue
+    return _valid_proxies(pairs)
 
 
 def _combine_url(url, item):
@@ -49,151 +108,315 @@ def _combine_url(url, item):
     return new_url
 
 
-def from_page_list(url, html, urls_q):
+def from_page_list(url, html):
     """
-    general method to get urls from page
+    general method to get urls from page, find the pagination links
+    whose texts contain 2 and 3, and take them with the link after them
     """
-    pattern = re.compile(r'href="([^"]+)".*?>.*?2.*?<[\D,\s]*?href="([^"]+)".*?>.*?3.*?<[\D,\s]*?href="([^"]+)"')
-    m_list = pattern.findall(html)
-    if m_list:
-        m_tuple = m_list[0]
-        for item in m_tuple:
-            new_url = _combine_url(url, item)
-            logger.info('put new url %s', new_url)
-            urls_q.put(new_url)
-    else:
-        return None
+    anchors = ANCHOR_PATTERN.findall(html)
+    for i in range(len(anchors) - 1):
+        if '2' in anchors[i][1] and '3' in anchors[i + 1][1]:
+            return [_combine_url(url, href) for href, _ in anchors[i:i + 3]]
+    return []
 
 
-def get_proxies_html(html, redis_trans):
+def get_proxies_html(html):
     """
     get list of proxies from html
     """
-    pattern = re.compile(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\D+(\d{1,5})')
-    lst = pattern.findall(html)
-    for item in lst:
-        proxy = Proxy(ip=item[0], port=item[1])
-        redis_trans.add(proxy)
-        logger.info(f'put new proxy {proxy}')
+    return _valid_proxies(PROXY_HTML_PATTERN.findall(html))
 
 
-def get_proxies_from_json_txt(json_txt, redis_trans):
+def get_proxies_from_json_txt(json_txt):
     """
     get list of proxies from json
     """
-    lines = json_txt.strip().split('\n')
-    for line in lines:
-        pre_proxy = json.loads(line)
-        proxy = Proxy(ip=pre_proxy['host'], port=pre_proxy['port'])
-        redis_trans.add(proxy)
-        logger.info(f'put new proxy {proxy}')
+    pairs = []
+    for line in json_txt.splitlines():
+        if line.strip():
+            pre_proxy = json.loads(line)
+            pairs.append((pre_proxy['host'], pre_proxy['port']))
+    return _valid_proxies(pairs)
 
 
-def get_proxies_from_json(json_data, redis_trans):
+def get_proxies_from_json(json_data):
     """
     get list of proxies from json
     """
     dict_data = json.loads(json_data)
     key = list(dict_data.keys())[0]
     list_data = dict_data[key]
-    for item in list_data:
-        proxy = Proxy(ip=item['ip'], port=item['port'])
-        redis_trans.add(proxy)
-        logger.info(f'put new proxy {proxy}')
-
-
-@retry(stop_max_attempt_number=3, retry_on_result=lambda x: x is None, wait_fixed=20000)
-def fetch(url, **kwargs):
-    """
-    get html entities from url
-    """
-    headers = Headers(headers=True).generate()
-    default_dict = {'timeout': GET_TIMEOUT, 'verify': False, 'headers': headers}
-    kwargs = {**default_dict, **kwargs}
-
-    try:
-        logger.info('fetching %s', url)
-        response = requests.get(url, **kwargs)
-        if response.status_code == 200:
-            response.encoding = 'utf-8'
-            with open('test.html', 'w', encoding='utf-8') as f:
-                f.write(response.text)
-            return response.text
-    except (requests.ConnectionError, requests.ReadTimeout):
-        return None
+    return _valid_proxies((item['ip'], item['port']) for item in list_data)
+
+
+def parse_page(url, parsetype, next_type, text):
+    """
+    parse a fetched page
+    :param url: url of page
+    :param parsetype: html, html_with_base64, json_txt or json
+    :param next_type: list, one_page, click_page or None
+    :param text: content of page
+    :return: list of proxies, list of follow-up urls
+    """
+    if parsetype == 'html':
+        if next_type == 'list':
+            return get_proxies_html(text), from_page_list(url, text)
+        if next_type == 'click_page':
+            m = CLICK_PAGE_PATTERN.search(text)
+            return [], [_combine_url(url, suffix_url) for suffix_url in (m.groups() if m else [])]
+        return get_proxies_html(text), []
+    if parsetype == 'html_with_base64':
+        return _get_proxies_base64_in(text), []
+    if parsetype == 'json_txt':
+        return get_proxies_from_json_txt(text), []
+    if parsetype == 'json':
+        return get_proxies_from_json(text), []
+    logger.error(f'unsupported parsetype {parsetype} of {url}')
+    return [], []
 
 
-def process_init_url(url, parsetype, next_type, urls_q, trans_redis):
-    """
-    process initial url
-    """
-    try:
-        if parsetype == 'html':
-            if next_type == 'list':
-                html = fetch(url)
-                from_page_list(url, html, urls_q)
-                logger.info('put new url %s', url)
-                get_proxies_html(html, trans_redis)
-            if next_type == 'one_page':
-                logger.info('put new url %s', url)
-                get_proxies_html(url, trans_redis)
-            if next_type == 'click_page':
-                html = fetch(url)
-                suffix_urls = re.findall(r'href="(/dayProxy/ip/\d{4}.html)"[\D,\s]*?href="(/dayProxy/ip/\d{4}.html)"', html)[0]
-                for suffix_url in suffix_urls:
-                    url_new = _combine_url(url, suffix_url)
-                    logger.info('put new url %s', url_new)
-                    urls_q.put(url_new)
-        if parsetype == 'html_with_base64':
-            html = fetch(url)
-            logger.info('put new url %s', url)
-            _get_proxies_base64_in(html)
-        if parsetype == 'json_txt':
-            json_txt = fetch(url)
-            if json_txt:
-                logger.info('put new url %s', url)
-                get_proxies_from_json_txt(json_txt, trans_redis)
-        if parsetype == 'json':
-            json_data = fetch(url)
-            if json_data:
-                logger.info('put new url %s', url)
-                get_proxies_from_json(json_data, trans_redis)
-    except RetryError:
+def dump_page(text, path=GET_DUMP_FILE):
+    """
+    write a fetched page to file for debugging
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+class SourceCache(object):
+    """
+    validators, content hash and follow-up urls of fetched pages, kept across getter cycles,
+    so a page that did not change is neither downloaded again nor parsed, validators and hash of a changed page
+    are only kept once its proxies are stored, so a page failed to be parsed or stored is processed again
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def conditional_headers(self, url) -> dict:
+        """
+        get If-None-Match and If-Modified-Since headers of url
+        """
+        entry = self.entries.get(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, url, headers, body) -> bool:
+        """
+        take validators and content hash of a downloaded page, those of a changed page are pending until commit
+        :param url: url of page
+        :param headers: response headers
+        :param body: response body, bytes
+        :return: whether the content changed since last commit
+        """
+        digest = hashlib.sha1(body).hexdigest()
+        entry = self.entries.setdefault(url, {})
+        changed = entry.get('digest') != digest
+        entry['pending'] = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+                            'digest': digest}
+        if not changed:
+            self.commit(url)
+        return changed
+
+    def commit(self, url):
+        """
+        keep pending validators and content hash of a page, once its proxies are stored
+        """
+        entry = self.entries.get(url)
+        if entry and 'pending' in entry:
+            entry.update(entry.pop('pending'))
+
+    def next_urls(self, url) -> list:
+        entry = self.entries.get(url)
+        return entry.get('next_urls', []) if entry else []
+
+    def set_next_urls(self, url, next_urls):
+        self.entries.setdefault(url, {})['next_urls'] = next_urls
+
+
+class Fetcher(object):
+    """
+    fetch pages with a limit of concurrent requests per host, and retry with exponential backoff
+    which only holds up the page being retried
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, cache: SourceCache = None, per_host=GET_CONCURRENCY_PER_HOST,
+                 retries=GET_RETRIES, backoff=GET_BACKOFF, backoff_max=GET_BACKOFF_MAX):
+        """
+        :param session: aiohttp session
+        :param cache: cache of fetched pages for conditional requests, None to always fetch in full
+        :param per_host: max concurrent requests of one host
+        :param retries: max attempts of one url
+        :param backoff: seconds to wait before the first retry, doubled for every next retry
+        :param backoff_max: max seconds to wait before one retry
+        """
+        self.session = session
+        self.cache = cache or SourceCache()
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.host_limits = {}
+
+    def host_limit(self, url) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self.host_limits[host]
+
+    async def fetch_once(self, url):
+        """
+        get html entities from url
+        :return: text, NOT_MODIFIED if page did not change, None if failed
+        """
+        async with self.host_limit(url):
+            try:
+                logger.info('fetching %s', url)
+                headers = {**Headers(headers=True).generate(), **self.cache.conditional_headers(url)}
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status == 304:
+                        logger.debug(f'{url} not modified')
+                        return NOT_MODIFIED
+                    if response.status == 200:
+                        body = await response.read()
+                        if not self.cache.update(url, response.headers, body):
+                            logger.debug(f'{url} content unchanged')
+                            return NOT_MODIFIED
+                        text = body.decode('utf-8', errors='replace')
+                        if GET_DUMP_FILE:
+                            await asyncio.get_running_loop().run_in_executor(None, dump_page, text)
+                        return text
+                    logger.debug(f'fetch {url} got status {response.status}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.debug(f'fetch {url} failed: {e!r}')
+        return None
+
+    async def fetch(self, url):
+        """
+        fetch url, retry with exponential backoff
+        :return: text, NOT_MODIFIED if page did not change, None if all attempts failed
+        """
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            start = time.perf_counter()
+            text = await self.fetch_once(url)
+            FETCH_SECONDS.observe(time.perf_counter() - start, source=urlsplit(url).netloc,
+                                  result='failed' if text is None else 'unchanged' if text is NOT_MODIFIED else 'ok')
+            if text is not None:
+                return text
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.backoff_max)
         logger.error('fetch %s failed', url)
+        return None
 
 
 class Getter(object):
-    def __init__(self):
-        self.urls_queue = queue.Queue()
+    """
+    crawl proxy sources by an asyncio pipeline: workers fetch and parse pages of the frontier,
+    follow-up urls go back into the frontier, parsed proxies go to a single store stage
+    which adds them in bulk, the crawl ends once the frontier has no pending page
+    """
+
+    def __init__(self, concurrency=GET_CONCURRENCY):
+        """
+        :param concurrency: max number of pages being fetched at the same time
+        """
         self.redis = RedisClient()
+        self.loop = asyncio.new_event_loop()
         self.initial_urls = init_urls
+        self.concurrency = concurrency
+        self.sources = SourceCache()
 
-    def process_init_urls(self, initial_urls, trans_redis):
+    async def crawl_worker(self, fetcher: Fetcher, frontier: asyncio.Queue, results: asyncio.Queue, seen: set,
+                           stats: dict):
+        while True:
+            url, parsetype, next_type = await frontier.get()
+            try:
+                text = await fetcher.fetch(url)
+                next_urls = []
+                if text is NOT_MODIFIED:
+                    # nothing to parse, but pages it links to may have changed
+                    stats['unchanged'] += 1
+                    next_urls = self.sources.next_urls(url)
+                elif text:
+                    proxies, next_urls = parse_page(url, parsetype, next_type, text)
+                    self.sources.set_next_urls(url, next_urls)
+                    if proxies:
+                        # committed by the store stage once the proxies are stored
+                        await results.put((url, proxies))
+                    else:
+                        self.sources.commit(url)
+                for next_url in next_urls:
+                    if next_url not in seen:
+                        seen.add(next_url)
+                        logger.info('put new url %s', next_url)
+                        frontier.put_nowait((next_url, 'html', None))
+            except Exception as e:
+                logger.exception(f'process {url} failed: {e}')
+            finally:
+                frontier.task_done()
+
+    async def store_worker(self, results: asyncio.Queue, stats: dict):
+        while True:
+            source, proxies = await results.get()
+            try:
+                new, known, dead = await self.loop.run_in_executor(None, store_proxies, source, proxies, self.redis)
+                self.sources.commit(source)
+                stats['pages'] += 1
+                stats['new'] += new
+                stats['known'] += known
+                stats['dead'] += dead
+            except Exception as e:
+                logger.exception(f'store proxies of {source} failed: {e}')
+            finally:
+                results.task_done()
+
+    async def crawl(self) -> dict:
         """
-        build some Thread pools for processing initial urls
+        crawl all sources once
+        :return: stats of this crawl
         """
-        with ThreadPoolExecutor(max_workers=6) as executor:
-            futures_ = [executor.submit(process_init_url,
-                                       url_item['url'],
-                                       url_item['parsetype'],
-                                       url_item.get('next_type', None),
-                                       self.urls_queue, trans_redis) for url_item in initial_urls]
-            as_completed(futures_)
-            logger.info('all initial urls processed')
+        stats = {'pages': 0, 'unchanged': 0, 'new': 0, 'known': 0, 'dead': 0, 'trimmed': 0}
+        if TOMBSTONE_TTL:
+            await self.loop.run_in_executor(None, self.redis.purge_tombstones)
+        frontier, results = asyncio.Queue(), asyncio.Queue()
+        seen = set()
+        for url_item in self.initial_urls:
+            seen.add(url_item['url'])
+            frontier.put_nowait((url_item['url'], url_item['parsetype'], url_item.get('next_type', None)))
+        timeout = aiohttp.ClientTimeout(total=GET_TIMEOUT)
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False), timeout=timeout) as session:
+            fetcher = Fetcher(session, self.sources)
+            workers = [asyncio.ensure_future(self.crawl_worker(fetcher, frontier, results, seen, stats))
+                       for _ in range(self.concurrency)]
+            store = asyncio.ensure_future(self.store_worker(results, stats))
+            try:
+                await frontier.join()
+                await results.join()
+            finally:
+                for task in workers + [store]:
+                    task.cancel()
+                await asyncio.gather(*workers, store, return_exceptions=True)
+        # trim once after all pages are stored, not on every add
+        stats['trimmed'] = await self.loop.run_in_executor(None, self.redis.trim)
+        return stats
 
     def __call__(self, *args, **kwargs):
-        self.process_init_urls(self.initial_urls, self.redis)
-        while True:
-            try:
-                url = self.urls_queue.get(timeout=4)
-                html = fetch(url)
-                if html:
-                    get_proxies_html(html, self.redis)
-            except queue.Empty:
-                logger.info('queue is empty')
-                break
+        asyncio.set_event_loop(self.loop)
+        stats = self.loop.run_until_complete(self.crawl())
+        logger.info(f'getter cycle finished, {stats["pages"]} pages stored, {stats["unchanged"]} pages unchanged, '
+                    f'{stats["new"]} new proxies, {stats["known"]} known proxies, '
+                    f'{stats["dead"]} dead proxies skipped, {stats["trimmed"]} proxies trimmed')
+        return stats
 
 
 if __name__ == '__main__':
     getter = Getter()
-    getter()
\ No newline at end of file
+    start_pusher(getter.redis.db, getter.redis.key)
+    getter()
@@ -1,6 +1,14 @@
-from flask import Flask, current_app
+import time
+
+from flask import Flask, Response, current_app, request, jsonify, stream_with_context, g
 from trans4redis import RedisClient
-from setting import API_HOST, API_PORT, API_THREADED, IS_DEV
+from base_exception import PoolEmptyException
+from models import is_valid_proxy
+from proxy_cache import ProxyCache
+from metrics import collect, start_pusher, API_SECONDS
+from formats import ALL_FORMATS, FASTEST_FORMATS
+from setting import API_HOST, API_PORT, API_THREADED, IS_DEV, RANDOM_WEIGHTED, ENABLE_API_CACHE, PROXY_SCORE_MIN, \
+    PROXY_SCORE_MAX, LEASE_TTL, LEASE_TTL_MAX, LEASE_CAP, API_RANDOM_MAX
 
 __all__ = ['app']
 
@@ -8,7 +16,6 @@ app = Flask(__name__)
 if IS_DEV:
     app.debug = True
 
-
 def get_conn():
     """
     get redis client object
@@ -19,6 +26,53 @@ def get_conn():
     return current_app.redis
 
 
+def get_cache():
+    """
+    get in-process cache of the pool, or the redis client itself if cache is disabled
+    :return:
+    """
+    if not ENABLE_API_CACHE:
+        return get_conn()
+    if not hasattr(current_app, 'proxy_cache'):
+        current_app.proxy_cache = ProxyCache(get_conn())
+    return current_app.proxy_cache
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def observe_latency(response):
+    route = request.url_rule.rule if request.url_rule else 'unknown'
+    API_SECONDS.observe(time.perf_counter() - g.start, route=route, status=response.status_code)
+    return response
+
+
+def get_reports():
+    """
+    get buffer of reports of clients, which is flushed by a background thread
+    :return:
+    """
+    if not hasattr(current_app, 'reports'):
+        current_app.reports = get_conn().reports().start()
+    return current_app.reports
+
+
+def arg_bool(name, default=False):
+    """
+    get a bool from query args, like ?weighted=1 or ?weighted=true
+    :param name: name of arg
+    :param default: default value if arg is absent
+    :return: bool
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
 @app.route('/')
 def index():
     """
@@ -28,30 +82,136 @@ def index():
     return '<h2>Welcome to Proxy Pool System</h2>'
 
 
+@app.route('/echo')
+def echo():
+    """
+    answer the ip and headers of the client, used as TEST_ECHO_URL by the tester,
+    which checks validity and anonymity of a proxy by one request to it
+    :return: json, like {"origin": "8.8.8.8", "headers": {...}}
+    """
+    return jsonify({'origin': request.remote_addr, 'headers': dict(request.headers)})
+
+
 @app.route('/random')
 def get_proxy():
     """
-    get a random proxy
+    get a random proxy, pass ?weighted=1 to pick with probability proportional to score,
+    or ?max_latency=ms to pick from proxies whose average latency is at most that,
+    pass ?n= or any of min_score, protocol (http or https), anonymity (anonymous) to get distinct random proxies
+    in one call, see get_proxies
     :return: get a random proxy
     """
-    conn = get_conn()
-    return str(conn.random())
+    if any(name in request.args for name in ('n', 'min_score', 'protocol', 'anonymity')):
+        return get_proxies()
+    max_latency = request.args.get('max_latency', None, type=float)
+    if max_latency is not None:
+        return str(get_conn().random(max_latency=max_latency))
+    conn = get_cache()
+    return str(conn.random(weighted=arg_bool('weighted', RANDOM_WEIGHTED)))
+
+
+def get_proxies():
+    """
+    get up to n distinct random proxies matching the filters, fewer if not enough proxies match
+    query args: n (default 1, at most API_RANDOM_MAX), min_score (default max score), protocol (http or https),
+    anonymity (anonymous), max_latency (ms), format (text or jsonl)
+    :return: one proxy per line
+    """
+    fmt = request.args.get('format', 'text')
+    if fmt not in ALL_FORMATS:
+        return f'unsupported format {fmt}, use one of {", ".join(ALL_FORMATS)}', 400
+    protocol = request.args.get('protocol', 'http')
+    if protocol not in ('http', 'https'):
+        return f'unsupported protocol {protocol}, use http or https', 400
+    anonymity = request.args.get('anonymity')
+    if anonymity not in (None, 'anonymous'):
+        return f'unsupported anonymity {anonymity}, use anonymous', 400
+    mimetype, render = ALL_FORMATS[fmt]
+    count = min(max(request.args.get('n', 1, type=int), 1), API_RANDOM_MAX)
+    proxies = get_conn().random_many(count, min_score=request.args.get('min_score', None, type=float),
+                                     anonymous=anonymity == 'anonymous', https=protocol == 'https',
+                                     max_latency=request.args.get('max_latency', None, type=float))
+    return Response(render(proxies), mimetype=mimetype)
+
+
+@app.route('/lease')
+def lease_proxy():
+    """
+    lease a proxy which is not leased by too many clients, give it back by /release
+    query args: ttl, seconds before the lease expires if it is not released
+    :return: json, like {"lease": "...", "proxy": "8.8.8.8:8", "ttl": 60}
+    """
+    ttl = min(max(request.args.get('ttl', LEASE_TTL, type=int), 1), LEASE_TTL_MAX)
+    try:
+        lease_id, proxy = get_conn().lease(ttl=ttl, cap=LEASE_CAP)
+    except PoolEmptyException:
+        return 'no proxy available', 503
+    return jsonify({'lease': lease_id, 'proxy': str(proxy), 'ttl': ttl})
+
+
+@app.route('/release')
+def release_proxy():
+    """
+    end a lease, the score of its proxy is decreased if the client failed with it
+    query args: lease, ok (default 1)
+    :return: proxy of the lease
+    """
+    lease_id = request.args.get('lease')
+    if not lease_id:
+        return 'lease is required', 400
+    proxy = get_conn().release(lease_id, ok=arg_bool('ok', True))
+    if proxy is None:
+        return 'unknown or expired lease', 404
+    return str(proxy)
+
+
+@app.route('/report')
+def report_proxy():
+    """
+    report whether a proxy worked for the client, failures decrease its score within REPORT_FLUSH_INTERVAL
+    seconds, and a proxy with a burst of failures is tested again first
+    query args: proxy, ok (default 1)
+    :return: ok
+    """
+    proxy = request.args.get('proxy', '')
+    if not is_valid_proxy(proxy):
+        return f'invalid proxy {proxy}', 400
+    get_reports().report(proxy, ok=arg_bool('ok', True))
+    return 'ok'
 
 
 @app.route('/all')
 def get_proxy_all():
     """
-    get a random proxy
-    :return: get a random proxy
+    get all proxies by score desc, streamed page by page
+    query args: limit, offset, min_score, max_score, format (text or jsonl)
+    :return: one proxy per line
     """
+    fmt = request.args.get('format', 'text')
+    if fmt not in ALL_FORMATS:
+        return f'unsupported format {fmt}, use one of {", ".join(ALL_FORMATS)}', 400
+    mimetype, render = ALL_FORMATS[fmt]
     conn = get_conn()
-    proxies = conn.all()
-    proxies_string = ''
-    if proxies:
-        for proxy in proxies:
-            proxies_string += str(proxy) + '\n'
+    pages = conn.iter_pages(min_score=request.args.get('min_score', PROXY_SCORE_MIN, type=float),
+                            max_score=request.args.get('max_score', PROXY_SCORE_MAX, type=float),
+                            offset=max(request.args.get('offset', 0, type=int), 0),
+                            limit=request.args.get('limit', None, type=int))
+    return Response(stream_with_context(render(page) for page in pages), mimetype=mimetype)
 
-    return proxies_string
+
+@app.route('/fastest')
+def get_proxy_fastest():
+    """
+    get proxies with the lowest average latency
+    query args: n (default 10, at most API_RANDOM_MAX), format (text or jsonl)
+    :return: one proxy per line, fastest first
+    """
+    fmt = request.args.get('format', 'text')
+    if fmt not in FASTEST_FORMATS:
+        return f'unsupported format {fmt}, use one of {", ".join(FASTEST_FORMATS)}', 400
+    mimetype, render = FASTEST_FORMATS[fmt]
+    count = min(max(request.args.get('n', 10, type=int), 1), API_RANDOM_MAX)
+    return Response(render(get_conn().fastest(count)), mimetype=mimetype)
 
 
 @app.route('/count')
@@ -60,9 +220,32 @@ def get_count():
     get the count of proxies
     :return: count, int
     """
-    conn = get_conn()
+    conn = get_cache()
     return str(conn.count())
 
 
+@app.route('/cache')
+def get_cache_stats():
+    """
+    get hit rate and snapshot age of the in-process cache
+    :return: json
+    """
+    if not ENABLE_API_CACHE:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **get_cache().stats()})
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    get metrics of all processes of the pool in prometheus text format
+    :return: text
+    """
+    conn = get_conn()
+    return Response(collect(conn.db, conn.key), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
+    conn = RedisClient()
+    start_pusher(conn.db, conn.key)
     app.run(host=API_HOST, port=API_PORT, threaded=API_THREADED)
@@ -0,0 +1,300 @@
+import asyncio
+import multiprocessing
+import signal
+import sys
+import time
+
+from aiohttp import web
+
+from proxy_cache import ProxyCache
+from formats import ALL_FORMATS, FASTEST_FORMATS
+from metrics import collect, start_pusher, API_SECONDS
+from trans4redis import RedisClient, AsyncRedisClient
+from base_exception import PoolEmptyException
+from models import is_valid_proxy
+from handle_log import get_logger
+from setting import API_HOST, API_PORT, API_WORKERS, RANDOM_WEIGHTED, ENABLE_API_CACHE, PROXY_SCORE_MIN, \
+    PROXY_SCORE_MAX, IS_WINDOWS, LEASE_TTL, LEASE_TTL_MAX, LEASE_CAP, API_RANDOM_MAX
+
+__all__ = ['create_app', 'run_app']
+
+logger = get_logger('AsyncServer')
+
+routes = web.RouteTableDef()
+
+
+@web.middleware
+async def observe_latency(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.resource
+        API_SECONDS.observe(time.perf_counter() - start, route=route.canonical if route else 'unknown', status=status)
+
+
+def arg_bool(request, name, default=False):
+    """
+    get a bool from query args, like ?weighted=1 or ?weighted=true
+    """
+    value = request.query.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def arg_number(request, name, default, type_=int):
+    """
+    get a number from query args, fall back to default if absent or malformed
+    """
+    try:
+        return type_(request.query[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def current_snapshot(request, weighted=None):
+    """
+    get fresh snapshot of the in-process cache, None if cache is disabled or stale,
+    or if it does not cover random picks of the kind given by weighted, see ProxyCache.current
+    """
+    cache = request.app['cache']
+    return cache.current(weighted) if cache is not None else None
+
+
+@routes.get('/')
+async def index(request):
+    """
+    get home page, you can define your own templates
+    :return:
+    """
+    return web.Response(text='<h2>Welcome to Proxy Pool System</h2>', content_type='text/html')
+
+
+@routes.get('/echo')
+async def echo(request):
+    """
+    answer the ip and headers of the client, same as /echo of the flask app
+    :return: json, like {"origin": "8.8.8.8", "headers": {...}}
+    """
+    return web.json_response({'origin': request.remote, 'headers': dict(request.headers)})
+
+
+@routes.get('/random')
+async def get_proxy(request):
+    """
+    get a random proxy, pass ?weighted=1 to pick with probability proportional to score,
+    or ?max_latency=ms to pick from proxies whose average latency is at most that,
+    pass ?n= or any of min_score, protocol, anonymity to get distinct random proxies in one call, see get_proxies
+    :return: get a random proxy
+    """
+    if any(name in request.query for name in ('n', 'min_score', 'protocol', 'anonymity')):
+        return await get_proxies(request)
+    max_latency = arg_number(request, 'max_latency', None, float)
+    if max_latency is not None:
+        return web.Response(text=str(await request.app['redis'].random(max_latency=max_latency)))
+    weighted = arg_bool(request, 'weighted', RANDOM_WEIGHTED)
+    snapshot = current_snapshot(request, weighted)
+    if snapshot is not None:
+        return web.Response(text=snapshot.random(weighted=weighted))
+    return web.Response(text=str(await request.app['redis'].random(weighted=weighted)))
+
+
+async def get_proxies(request):
+    """
+    get up to n distinct random proxies matching the filters, same as get_proxies of the flask app
+    :return: one proxy per line
+    """
+    fmt = request.query.get('format', 'text')
+    if fmt not in ALL_FORMATS:
+        return web.Response(text=f'unsupported format {fmt}, use one of {", ".join(ALL_FORMATS)}', status=400)
+    protocol = request.query.get('protocol', 'http')
+    if protocol not in ('http', 'https'):
+        return web.Response(text=f'unsupported protocol {protocol}, use http or https', status=400)
+    anonymity = request.query.get('anonymity')
+    if anonymity not in (None, 'anonymous'):
+        return web.Response(text=f'unsupported anonymity {anonymity}, use anonymous', status=400)
+    mimetype, render = ALL_FORMATS[fmt]
+    count = min(max(arg_number(request, 'n', 1), 1), API_RANDOM_MAX)
+    proxies = await request.app['redis'].random_many(count, min_score=arg_number(request, 'min_score', None, float),
+                                                     anonymous=anonymity == 'anonymous', https=protocol == 'https',
+                                                     max_latency=arg_number(request, 'max_latency', None, float))
+    return web.Response(text=render(proxies), content_type=mimetype)
+
+
+@routes.get('/lease')
+async def lease_proxy(request):
+    """
+    lease a proxy, same as /lease of the flask app
+    :return: json, like {"lease": "...", "proxy": "8.8.8.8:8", "ttl": 60}
+    """
+    ttl = min(max(arg_number(request, 'ttl', LEASE_TTL), 1), LEASE_TTL_MAX)
+    conn = request.app['sync_redis']
+    try:
+        lease_id, proxy = await asyncio.get_running_loop().run_in_executor(None, conn.lease, ttl, LEASE_CAP)
+    except PoolEmptyException:
+        return web.Response(text='no proxy available', status=503)
+    return web.json_response({'lease': lease_id, 'proxy': str(proxy), 'ttl': ttl})
+
+
+@routes.get('/release')
+async def release_proxy(request):
+    """
+    end a lease, same as /release of the flask app
+    :return: proxy of the lease
+    """
+    lease_id = request.query.get('lease')
+    if not lease_id:
+        return web.Response(text='lease is required', status=400)
+    conn = request.app['sync_redis']
+    proxy = await asyncio.get_running_loop().run_in_executor(None, conn.release, lease_id,
+                                                             arg_bool(request, 'ok', True))
+    if proxy is None:
+        return web.Response(text='unknown or expired lease', status=404)
+    return web.Response(text=str(proxy))
+
+
+@routes.get('/report')
+async def report_proxy(request):
+    """
+    report whether a proxy worked for the client, same as /report of the flask app
+    :return: ok
+    """
+    proxy = request.query.get('proxy', '')
+    if not is_valid_proxy(proxy):
+        return web.Response(text=f'invalid proxy {proxy}', status=400)
+    request.app['reports'].report(proxy, ok=arg_bool(request, 'ok', True))
+    return web.Response(text='ok')
+
+
+@routes.get('/all')
+async def get_proxy_all(request):
+    """
+    get all proxies by score desc, streamed page by page
+    query args: limit, offset, min_score, max_score, format (text or jsonl)
+    :return: one proxy per line
+    """
+    fmt = request.query.get('format', 'text')
+    if fmt not in ALL_FORMATS:
+        return web.Response(text=f'unsupported format {fmt}, use one of {", ".join(ALL_FORMATS)}', status=400)
+    mimetype, render = ALL_FORMATS[fmt]
+    response = web.StreamResponse()
+    response.content_type = mimetype
+    await response.prepare(request)
+    async for page in request.app['redis'].iter_pages(
+            min_score=arg_number(request, 'min_score', PROXY_SCORE_MIN, float),
+            max_score=arg_number(request, 'max_score', PROXY_SCORE_MAX, float),
+            offset=max(arg_number(request, 'offset', 0), 0),
+            limit=arg_number(request, 'limit', None)):
+        await response.write(render(page).encode())
+    await response.write_eof()
+    return response
+
+
+@routes.get('/fastest')
+async def get_proxy_fastest(request):
+    """
+    get proxies with the lowest average latency
+    query args: n (default 10, at most API_RANDOM_MAX), format (text or jsonl)
+    :return: one proxy per line, fastest first
+    """
+    fmt = request.query.get('format', 'text')
+    if fmt not in FASTEST_FORMATS:
+        return web.Response(text=f'unsupported format {fmt}, use one of {", ".join(FASTEST_FORMATS)}', status=400)
+    mimetype, render = FASTEST_FORMATS[fmt]
+    count = min(max(arg_number(request, 'n', 10), 1), API_RANDOM_MAX)
+    return web.Response(text=render(await request.app['redis'].fastest(count)), content_type=mimetype)
+
+
+@routes.get('/count')
+async def get_count(request):
+    """
+    get the count of proxies
+    :return: count, int
+    """
+    snapshot = current_snapshot(request)
+    if snapshot is not None:
+        return web.Response(text=str(snapshot.count))
+    return web.Response(text=str(await request.app['redis'].count()))
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    """
+    get metrics of all processes of the pool in prometheus text format
+    :return: text
+    """
+    conn = request.app['sync_redis']
+    text = await asyncio.get_running_loop().run_in_executor(None, collect, conn.db, conn.key)
+    return web.Response(text=text, content_type='text/plain')
+
+
+async def on_startup(app):
+    app['redis'] = AsyncRedisClient()
+    # blocking client for the snapshot and metrics, which are handled in threads
+    app['sync_redis'] = RedisClient()
+    start_pusher(app['sync_redis'].db, app['sync_redis'].key)
+    # reports of clients are applied by a background thread
+    app['reports'] = app['sync_redis'].reports().start()
+    app['cache'] = None
+    if ENABLE_API_CACHE:
+        # the snapshot is reloaded by a background thread with a blocking client,
+        # requests only read it and never wait on redis
+        app['cache'] = ProxyCache(app['sync_redis'])
+        app['cache'].start()
+
+
+async def on_cleanup(app):
+    await asyncio.get_running_loop().run_in_executor(None, app['reports'].flush)
+    await app['redis'].close()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[observe_latency])
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def serve(host=API_HOST, port=API_PORT, reuse_port=False):
+    """
+    serve app in current process
+    """
+    web.run_app(create_app(), host=host, port=port, reuse_port=reuse_port, print=None, access_log=None)
+
+
+def run_app(host=API_HOST, port=API_PORT, workers=API_WORKERS):
+    """
+    run app in worker processes sharing one port by SO_REUSEPORT
+    :param host: listen host
+    :param port: listen port
+    :param workers: number of processes, 0 means number of cpus
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or IS_WINDOWS:
+        logger.info(f'serving on {host}:{port}')
+        serve(host, port)
+        return
+    processes = [multiprocessing.Process(target=serve, args=(host, port, True)) for _ in range(workers)]
+    # make sure workers are terminated with this process
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    for process in processes:
+        process.start()
+    logger.info(f'serving on {host}:{port} by {workers} workers, pids {[p.pid for p in processes]}')
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    run_app()
@@ -1,12 +1,21 @@
 import asyncio
+import os
+import socket
+import time
+import zlib
+from random import choice
+
 import aiohttp
-import requests
 from fake_headers import Headers
 
 from models import Proxy
 from trans4redis import RedisClient
 from handle_log import get_logger
-from setting import TEST_TIMEOUT, TEST_BATCH, TEST_URL, TEST_VALID_STATUS, TEST_ANONYMOUS
+from metrics import counter, histogram, start_pusher, MS_BUCKETS
+from setting import TEST_TIMEOUT, TEST_BATCH, TEST_URL, TEST_VALID_STATUS, TEST_ANONYMOUS, TEST_SESSION_SHARED, \
+    TEST_CONN_LIMIT, TEST_CONN_LIMIT_PER_HOST, TEST_DNS_CACHE_TTL, TEST_HEADERS_POOL, TEST_CONCURRENCY, TEST_ADAPTIVE, \
+    TEST_WORKER_ID, TEST_WORKER_TTL, TEST_ORIGIN_URL, TEST_ORIGIN_TTL, TEST_ECHO_URL, TEST_ANONYMOUS_TTL, \
+    TEST_PRESCREEN, TEST_PRESCREEN_TIMEOUT, TEST_PRESCREEN_CONCURRENCY, PROXY_SCORE_MAX, PROXY_SCORE_INIT
 from aiohttp import ClientProxyConnectionError, ServerDisconnectedError, ClientOSError, ClientHttpProxyError, \
     ContentTypeError, ClientResponseError
 from asyncio import TimeoutError
@@ -22,62 +31,396 @@ EXCEPTIONS = (
 
 logger = get_logger('Tester')
 
+TESTS = counter('proxypool_tester_tests_total', 'proxies tested, by result', ('result',))
+TEST_LATENCY = histogram('proxypool_tester_latency_ms', 'latency of valid proxies in ms', buckets=MS_BUCKETS)
+CYCLE_SECONDS = histogram('proxypool_tester_cycle_seconds', 'duration of tester cycles',
+                          buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """
+    trace config which records connect latency in ms as trace_request_ctx['connect']
+    when a request opens a new connection
+    :return: aiohttp.TraceConfig
+    """
+
+    async def on_connection_create_start(session, context, params):
+        if isinstance(context.trace_request_ctx, dict):
+            context.trace_request_ctx['connect_start'] = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params):
+        ctx = context.trace_request_ctx
+        if isinstance(ctx, dict) and 'connect_start' in ctx:
+            ctx['connect'] = (time.perf_counter() - ctx.pop('connect_start')) * 1000
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+def shard_of(proxy: Proxy, total) -> int:
+    """
+    get index of the tester worker which proxy belongs to in a sweep
+    :param proxy: proxy
+    :param total: number of tester workers
+    :return: index of worker
+    """
+    return zlib.crc32(str(proxy).encode()) % total
+
+
+def merge_stats(reports) -> dict:
+    """
+    merge stats reported by tester workers running side by side in one window
+    :param reports: list of stats returned by Tester.run
+    :return: stats of all workers
+    """
+    stats = {key: sum(report[key] for report in reports) for key in ('tested', 'valid', 'invalid', 'unreachable')}
+    stats['duration'] = max((report['duration'] for report in reports), default=0)
+    stats['throughput'] = stats['tested'] / stats['duration'] if stats['duration'] else 0
+    return stats
+
 
 class Tester(object):
     """
     tester for testing proxies in queue
     """
 
-    def __init__(self):
+    def __init__(self, shared_session=TEST_SESSION_SHARED, headers_pool_size=TEST_HEADERS_POOL,
+                 anonymous=TEST_ANONYMOUS, concurrency=TEST_CONCURRENCY, adaptive=TEST_ADAPTIVE,
+                 worker_id=TEST_WORKER_ID, prescreen=TEST_PRESCREEN):
         """
         self.loop = asyncio.get_event_loop()
         init redis
+        :param shared_session: reuse one session for a whole cycle
+        :param headers_pool_size: number of pre-generated headers, 0 to generate per proxy
+        :param anonymous: only keep anonymous proxies
+        :param concurrency: number of proxies being tested at the same time
+        :param adaptive: only test proxies which are due, instead of the whole pool
+        :param worker_id: id of this worker among all testers of the pool, defaults to hostname:pid
+        :param prescreen: connect to proxies by tcp first, and only test the connectable ones by http
         """
         self.redis = RedisClient()
+        self.adaptive = adaptive
+        self.writer = self.redis.buffer(schedule=adaptive)
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        # index of this worker and number of alive workers, a sweep only tests proxies of its own shard
+        self.shard = (0, 1)
+        self.last_heartbeat = 0
         self.loop = asyncio.new_event_loop()
-        self.url = 'https://httpbin.org/ip'
+        self.url = TEST_ORIGIN_URL
+        self.echo_url = TEST_ECHO_URL
+        self.origin_ip = None
+        self.origin_checked_at = 0
+        # timestamps until which proxies are known to be anonymous, loaded at the start of every cycle
+        self.anonymous_until = {}
+        self.shared_session = shared_session
+        self.anonymous = anonymous
+        self.concurrency = concurrency
+        self.prescreen = prescreen
+        self.headers_pool = [Headers(headers=True).generate() for _ in range(headers_pool_size)]
 
-    def get_origin_ip(self):
-        response = requests.get(self.url, timeout=TEST_TIMEOUT)
-        resp_json = response.json()
+    async def get_origin_ip(self, session: aiohttp.ClientSession = None):
+        """
+        find out the ip of this host, it is cached for TEST_ORIGIN_TTL seconds
+        :param session: session to use, if None, a new session is opened
+        :return: ip
+        """
+        if self.origin_ip and time.time() - self.origin_checked_at < TEST_ORIGIN_TTL:
+            return self.origin_ip
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.get_origin_ip(session)
+        async with session.get(self.url, timeout=TEST_TIMEOUT) as response:
+            resp_json = await response.json(content_type=None)
         self.origin_ip = resp_json['origin']
+        self.origin_checked_at = time.time()
+        return self.origin_ip
 
-    async def test(self, proxy: Proxy):
+    def check_anonymous(self, proxy: Proxy, resp_json):
+        """
+        make sure that the proxy hides the ip of this host, by what the target saw
+        :param proxy: proxy
+        :param resp_json: json answered by the target, with the ip it saw as origin,
+        and the headers it saw if it is an echo endpoint
+        :raise AssertionError: if the proxy is not anonymous
+        """
+        anonymous_ip = resp_json['origin']
+        assert self.origin_ip != anonymous_ip
+        assert proxy.ip == anonymous_ip
+        assert not any(self.origin_ip in str(value) for value in resp_json.get('headers', {}).values())
+
+    def get_headers(self):
+        """
+        pick headers from the pre-generated pool, or generate new ones if there is no pool
+        :return: dict of headers
+        """
+        if self.headers_pool:
+            return choice(self.headers_pool)
+        return Headers(headers=True).generate()
+
+    @staticmethod
+    def create_session():
+        """
+        create a session whose connector is tuned for testing many proxies concurrently,
+        must be called inside the running event loop
+        :return: aiohttp.ClientSession
+        """
+        connector = aiohttp.TCPConnector(ssl=False,
+                                         limit=TEST_CONN_LIMIT,
+                                         limit_per_host=TEST_CONN_LIMIT_PER_HOST,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=TEST_DNS_CACHE_TTL)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[create_trace_config()])
+
+    @staticmethod
+    async def connectable(proxy: Proxy) -> bool:
+        """
+        check that proxy accepts a tcp connection within TEST_PRESCREEN_TIMEOUT seconds
+        :param proxy: proxy
+        :return: bool
+        """
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(proxy.ip, int(proxy.port)),
+                                               TEST_PRESCREEN_TIMEOUT)
+        except (OSError, TimeoutError):
+            return False
+        writer.close()
+        # wait for the transport to close, so that thousands of screens do not leave it to the loop
+        try:
+            await asyncio.wait_for(writer.wait_closed(), TEST_PRESCREEN_TIMEOUT)
+        except (OSError, TimeoutError):
+            pass
+        return True
+
+    async def test(self, proxy: Proxy, session: aiohttp.ClientSession = None):
         """
         test single proxy
         :param proxy: Proxy object
-        :return:
+        :param session: shared session, if None, a new session is opened for this proxy
+        :return: True if valid, False if invalid, None if unknown
         """
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-            try:
-                headers = Headers(headers=True).generate()
-                logger.debug(f'testing {proxy}')
-                # if TEST_ANONYMOUS is True, make sure that
-                # the proxy has the effect of hiding the real IP
-                if TEST_ANONYMOUS:
+        if session is None:
+            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False),
+                                             trace_configs=[create_trace_config()]) as session:
+                return await self.test(proxy, session)
+        # filled with connect latency by the trace config of session
+        trace_ctx = {}
+        try:
+            headers = self.get_headers()
+            logger.debug(f'testing {proxy}')
+            # if TEST_ANONYMOUS is True, make sure that the proxy has the effect of hiding the real IP,
+            # a passed check is trusted for TEST_ANONYMOUS_TTL seconds
+            check_anonymous = self.anonymous and self.anonymous_until.get(str(proxy), 0) < time.time()
+            if self.echo_url:
+                # one request checks both validity and anonymity
+                start = time.perf_counter()
+                async with session.get(self.echo_url,
+                                       proxy=f'http://{proxy}',
+                                       timeout=TEST_TIMEOUT,
+                                       allow_redirects=False, headers=headers,
+                                       trace_request_ctx=trace_ctx) as response:
+                    latency = (time.perf_counter() - start) * 1000
+                    valid = response.status in TEST_VALID_STATUS
+                    if valid and check_anonymous:
+                        self.check_anonymous(proxy, await response.json(content_type=None))
+            else:
+                if check_anonymous:
                     async with session.get(self.url,
                                            proxy=f'http://{proxy}',
                                            timeout=TEST_TIMEOUT,
-                                           headers=headers) as response:
-                        resp_json = await response.json()
-                        anonymous_ip = resp_json['origin']
-                    assert self.origin_ip != anonymous_ip
-                    assert proxy.ip == anonymous_ip
+                                           headers=headers,
+                                           trace_request_ctx=trace_ctx) as response:
+                        self.check_anonymous(proxy, await response.json())
+                start = time.perf_counter()
                 async with session.get(TEST_URL,
                                        proxy=f'http://{proxy}',
                                        timeout=TEST_TIMEOUT,
-                                       allow_redirects=False, headers=headers) as response:
-                    if response.status in TEST_VALID_STATUS:
-                        self.redis.max(proxy)
-                        logger.debug(f'proxy {proxy} is valid, set max score')
-                    else:
-                        self.redis.decrease(proxy)
-                        logger.debug(f'proxy {proxy} is invalid, decrease score')
-            except (ContentTypeError, ClientResponseError, AttributeError) as e:
-                logger.debug(f'proxy {proxy} is invalid, decrease score \n {e}')
-            except EXCEPTIONS:
-                self.redis.decrease(proxy)
+                                       allow_redirects=False, headers=headers,
+                                       trace_request_ctx=trace_ctx) as response:
+                    latency = (time.perf_counter() - start) * 1000
+                    valid = response.status in TEST_VALID_STATUS
+            if valid:
+                if check_anonymous:
+                    self.anonymous_until[str(proxy)] = time.time() + TEST_ANONYMOUS_TTL
+                urls = [self.echo_url] if self.echo_url else [TEST_URL] + ([self.url] if check_anonymous else [])
+                self.writer.max(proxy, latency=latency, connect=trace_ctx.get('connect'), anonymous=check_anonymous,
+                                https=any(url.startswith('https://') for url in urls))
+                TEST_LATENCY.observe(latency)
+                logger.debug(f'proxy {proxy} is valid, set max score, latency {latency:.0f}ms')
+                return True
+            else:
+                self.writer.decrease(proxy)
                 logger.debug(f'proxy {proxy} is invalid, decrease score')
+                return False
+        except (ContentTypeError, ClientResponseError, AttributeError, ValueError) as e:
+            logger.debug(f'proxy {proxy} is invalid, decrease score \n {e}')
+        except EXCEPTIONS:
+            self.writer.decrease(proxy)
+            logger.debug(f'proxy {proxy} is invalid, decrease score')
+            return False
+
+    def heartbeat(self):
+        """
+        tell other workers this one is alive, at most every third of TEST_WORKER_TTL
+        :return: index of this worker, number of alive workers
+        """
+        if time.time() - self.last_heartbeat >= TEST_WORKER_TTL / 3:
+            self.shard = self.redis.heartbeat(self.worker_id)
+            self.last_heartbeat = time.time()
+        return self.shard
+
+    async def produce_candidates(self, queue: asyncio.Queue):
+        """
+        feed candidates of the shard of this worker into queue, by ZSCAN, with init score,
+        they join the pool once they pass the test and are dropped once they fail it
+        :param queue: queue consumed by workers
+        :return:
+        """
+        index, total = self.shard
+        cursor = 0
+        while True:
+            cursor, proxies = await self.loop.run_in_executor(None, self.redis.candidate_batch, cursor, TEST_BATCH)
+            for proxy, _ in proxies:
+                if total == 1 or shard_of(proxy, total) == index:
+                    await queue.put((proxy, PROXY_SCORE_INIT))
+            if not cursor:
+                break
+
+    async def produce(self, queue: asyncio.Queue):
+        """
+        feed proxies into queue, candidates first if tiered, then if adaptive, claim proxies due at the start
+        of the cycle, which are shared by all workers, so failed proxies coming due again during a long cycle
+        do not keep it running, else sweep the pool by ZSCAN and keep proxies of the shard of this worker
+        :param queue: queue consumed by workers
+        :return:
+        """
+        if self.redis.tiered:
+            await self.produce_candidates(queue)
+        if self.adaptive:
+            due = time.time()
+            while True:
+                await self.loop.run_in_executor(None, self.heartbeat)
+                proxies = await self.loop.run_in_executor(None, self.redis.claim_due, TEST_BATCH, due)
+                if not proxies:
+                    break
+                for item in proxies:
+                    await queue.put(item)
+            return
+        # shard is taken at the start of the cycle, workers joining or leaving are picked up by the next one
+        index, total = self.shard
+        cursor = 0
+        while True:
+            logger.debug(f'scanning proxies use cursor {cursor}, count {TEST_BATCH}')
+            await self.loop.run_in_executor(None, self.heartbeat)
+            cursor, proxies = await self.loop.run_in_executor(None, self.redis.batch, cursor, TEST_BATCH)
+            for proxy, score in proxies:
+                if total == 1 or shard_of(proxy, total) == index:
+                    await queue.put((proxy, score))
+            if not cursor:
+                break
+
+    async def screen(self, queue: asyncio.Queue, passed: asyncio.Queue, stats: dict):
+        """
+        connect to proxies from queue by tcp one by one until cancelled, and pass the connectable ones on,
+        proxies which never passed a test are evicted once they were not connectable CANDIDATE_FAILURES times
+        :param queue: queue filled by producer
+        :param passed: queue consumed by http workers
+        :param stats: counters of this cycle
+        :return:
+        """
+        while True:
+            proxy, score = await queue.get()
+            try:
+                if score >= PROXY_SCORE_MAX or await self.connectable(proxy):
+                    await passed.put((proxy, score))
+                    continue
+                stats['tested'] += 1
+                stats['unreachable'] += 1
+                TESTS.inc(result='unreachable')
+                if score <= PROXY_SCORE_INIT:
+                    self.writer.evict(proxy)
+                    logger.debug(f'proxy {proxy} is not connectable, count towards eviction')
+                else:
+                    self.writer.decrease(proxy)
+                    logger.debug(f'proxy {proxy} is not connectable, decrease score')
+                if self.writer.full():
+                    await self.loop.run_in_executor(None, self.writer.flush)
+            except Exception as e:
+                logger.exception(f'unexpected error while screening {proxy}: {e}')
+            finally:
+                queue.task_done()
+
+    async def work(self, queue: asyncio.Queue, session, stats: dict):
+        """
+        test proxies from queue one by one until cancelled
+        :param queue: queue filled by producer
+        :param session: shared session or None
+        :param stats: counters of this cycle
+        :return:
+        """
+        while True:
+            proxy, _ = await queue.get()
+            try:
+                result = await self.test(proxy, session)
+                stats['tested'] += 1
+                if result is True:
+                    stats['valid'] += 1
+                    TESTS.inc(result='valid')
+                elif result is False:
+                    stats['invalid'] += 1
+                    TESTS.inc(result='invalid')
+                else:
+                    TESTS.inc(result='unknown')
+                if self.writer.full():
+                    await self.loop.run_in_executor(None, self.writer.flush)
+            except Exception as e:
+                logger.exception(f'unexpected error while testing {proxy}: {e}')
+            finally:
+                queue.task_done()
+
+    async def run(self) -> dict:
+        """
+        test all proxies of one cycle, keep self.concurrency tests in flight until the pool is drained
+        :return: stats of this cycle
+        """
+        stats = {'tested': 0, 'valid': 0, 'invalid': 0, 'unreachable': 0}
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        # proxies are screened by tcp before they are put into queue
+        screen_queue = asyncio.Queue(maxsize=TEST_PRESCREEN_CONCURRENCY * 2) if self.prescreen else None
+        if self.anonymous:
+            try:
+                await self.get_origin_ip()
+            except (aiohttp.ClientError, TimeoutError, ValueError, KeyError) as e:
+                # a stale ip is still good enough to tell anonymous proxies
+                if not self.origin_ip:
+                    raise
+                logger.warning(f'failed to refresh origin ip, keep using {self.origin_ip}: {e}')
+            self.anonymous_until = await self.loop.run_in_executor(None, self.redis.anonymous)
+        session = self.create_session() if self.shared_session else None
+        workers = [asyncio.ensure_future(self.work(queue, session, stats)) for _ in range(self.concurrency)]
+        if screen_queue is not None:
+            workers += [asyncio.ensure_future(self.screen(screen_queue, queue, stats))
+                        for _ in range(TEST_PRESCREEN_CONCURRENCY)]
+        start = time.perf_counter()
+        try:
+            if screen_queue is not None:
+                await self.produce(screen_queue)
+                await screen_queue.join()
+            else:
+                await self.produce(queue)
+            await queue.join()
+            await self.loop.run_in_executor(None, self.writer.flush)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if session is not None:
+                await session.close()
+        stats['duration'] = time.perf_counter() - start
+        CYCLE_SECONDS.observe(stats['duration'])
+        stats['throughput'] = stats['tested'] / stats['duration'] if stats['duration'] else 0
+        return stats
 
     def __call__(self, *args, **kwargs):
         """
@@ -85,25 +428,30 @@ class Tester(object):
         :return:
         """
         asyncio.set_event_loop(self.loop)
-        if TEST_ANONYMOUS:
-            self.get_origin_ip()
         # event loop of aiohttp
         logger.info('stating tester...')
-        count = self.redis.count()
-        logger.debug(f'{count} proxies to test')
-        cursor = 0
-        while True:
-            logger.debug(f'testing proxies use cursor {cursor}, count {TEST_BATCH}')
-            cursor, proxies = self.redis.batch(cursor, count=TEST_BATCH)
-            if proxies:
-                tasks = [self.loop.create_task(self.test(proxy)) for proxy in proxies]
-                self.loop.run_until_complete(asyncio.wait(tasks))
-            if not cursor:
-                break
+        self.last_heartbeat = 0
+        index, total = self.heartbeat()
+        logger.debug(f'tester worker {self.worker_id} is {index + 1} of {total}')
+        if self.redis.tiered:
+            purged, candidates = self.redis.purge_candidates()
+            logger.debug(f'{candidates} candidates to test, {purged} expired ones dropped')
+        if self.adaptive:
+            count, due = self.redis.sync_schedule()
+            logger.debug(f'{due} of {count} proxies are due to test')
+        else:
+            count = self.redis.count()
+            logger.debug(f'{count} proxies to test')
+        stats = self.loop.run_until_complete(self.run())
+        logger.info(f'tester cycle finished, tested {stats["tested"]} proxies in {stats["duration"]:.2f}s, '
+                    f'{stats["throughput"]:.1f} proxies/s, valid {stats["valid"]}, invalid {stats["invalid"]}, '
+                    f'unreachable {stats["unreachable"]}')
+        return stats
 
 
 if __name__ == '__main__':
     tester = Tester()
+    start_pusher(tester.redis.db, tester.redis.key)
     tester()
 
     # tester.get_origin_ip()
@@ -1,14 +1,17 @@
 from scheduler import Scheduler
+from setting import TEST_WORKERS
 import argparse
 
 
 parser = argparse.ArgumentParser(description='ProxyPool')
 parser.add_argument('--processor', type=str, help='processor to run')
+parser.add_argument('--tester-workers', type=int, default=TEST_WORKERS,
+                    help='number of tester processes, 0 means number of cpus')
 args = parser.parse_args()
 
 if __name__ == '__main__':
     # if processor set, just run it
     if args.processor:
-        getattr(Scheduler(), f'run_{args.processor}')()
+        getattr(Scheduler(tester_workers=args.tester_workers), f'run_{args.processor}')()
     else:
-        Scheduler().run()
+        Scheduler(tester_workers=args.tester_workers).run()
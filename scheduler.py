@@ -1,12 +1,18 @@
+import queue
+import signal
+import sys
 import time
 import multiprocessing
 from proxy_server import app
 from proxy_getter import Getter
-from proxy_tester import Tester
-from setting import APP_PROD_METHOD_GEVENT, APP_PROD_METHOD_MEINHELD, APP_PROD_METHOD_TORNADO, CYCLE_GETTER, \
+from proxy_tester import Tester, merge_stats
+from trans4redis import RedisClient
+from metrics import start_pusher
+from setting import APP_PROD_METHOD_GEVENT, APP_PROD_METHOD_MEINHELD, APP_PROD_METHOD_TORNADO, \
+    APP_PROD_METHOD_AIOHTTP, CYCLE_GETTER, \
     CYCLE_TESTER, API_HOST, \
     API_THREADED, API_PORT, ENABLE_SERVER, IS_PROD, APP_PROD_METHOD, \
-    ENABLE_GETTER, ENABLE_TESTER, IS_WINDOWS
+    ENABLE_GETTER, ENABLE_TESTER, IS_WINDOWS, TEST_WORKERS
 from handle_log import get_logger
 
 logger = get_logger('Scheduler')
@@ -22,6 +28,12 @@ class Scheduler(object):
     scheduler
     """
 
+    def __init__(self, tester_workers=TEST_WORKERS):
+        """
+        :param tester_workers: number of tester processes, 0 means number of cpus
+        """
+        self.tester_workers = tester_workers or multiprocessing.cpu_count()
+
     def run_tester(self, cycle=CYCLE_TESTER):
         """
         run tester
@@ -29,7 +41,11 @@ class Scheduler(object):
         if not ENABLE_TESTER:
             logger.info('tester not enabled, exit')
             return
+        if self.tester_workers > 1:
+            self.run_tester_workers(cycle)
+            return
         tester = Tester()
+        start_pusher(tester.redis.db, tester.redis.key)
         loop = 0
         while True:
             logger.debug(f'tester loop {loop} start...')
@@ -37,6 +53,83 @@ class Scheduler(object):
             loop += 1
             time.sleep(cycle)
 
+    @staticmethod
+    def run_tester_worker(slot, cycle, reports):
+        """
+        run tester in a worker process, and report stats of every cycle to the parent
+        :param slot: index of the worker among the tester workers
+        :param cycle: seconds to sleep between cycles
+        :param reports: queue of (slot, stats) read by the parent
+        """
+        tester = Tester()
+        start_pusher(tester.redis.db, tester.redis.key)
+        loop = 0
+        while True:
+            logger.debug(f'tester worker {tester.worker_id} loop {loop} start...')
+            reports.put((slot, tester()))
+            loop += 1
+            time.sleep(cycle)
+
+    def spawn_tester_worker(self, slot, cycle, reports) -> multiprocessing.Process:
+        """
+        start a tester worker process
+        :param slot: index of the worker among the tester workers
+        :param cycle: seconds to sleep between cycles
+        :param reports: queue of (slot, stats) read by the parent
+        :return: started process
+        """
+        process = multiprocessing.Process(target=self.run_tester_worker, args=(slot, cycle, reports), daemon=True)
+        process.start()
+        return process
+
+    def run_tester_workers(self, cycle=CYCLE_TESTER, window=None, rounds=None) -> dict:
+        """
+        run tester in worker processes, each with its own event loop and redis connections,
+        the pool is shared between them by the due queue or by shards of the sweep,
+        workers which exit are respawned, and since their cycles drift apart, their stats are merged
+        by time window instead of by loop
+        :param cycle: seconds to sleep between cycles of a worker
+        :param window: max seconds stats are collected before they are merged, a window is closed earlier
+        once every worker reported, defaults to cycle
+        :param rounds: number of windows to merge before returning, None to run until terminated
+        :return: merged stats of the last window
+        """
+        window = window or cycle
+        reports = multiprocessing.Queue()
+        # make sure workers are terminated with this process
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        processes = [self.spawn_tester_worker(slot, cycle, reports) for slot in range(self.tester_workers)]
+        logger.info(f'starting {len(processes)} tester workers, pids {[p.pid for p in processes]}')
+        # stats reported by workers in the current window, by slot
+        collected, opened = {}, time.time()
+        stats, merged = {}, 0
+        try:
+            while rounds is None or merged < rounds:
+                for slot, process in enumerate(processes):
+                    if not process.is_alive():
+                        logger.warning(f'tester worker {process.pid} exited with code {process.exitcode}, respawn')
+                        processes[slot] = self.spawn_tester_worker(slot, cycle, reports)
+                try:
+                    slot, report = reports.get(timeout=1)
+                    collected.setdefault(slot, []).append(report)
+                except queue.Empty:
+                    pass
+                if len(collected) < len(processes) and time.time() - opened < window:
+                    continue
+                if collected:
+                    stats = merge_stats([report for reported in collected.values() for report in reported])
+                    merged += 1
+                    logger.info(f'tester window of {time.time() - opened:.0f}s finished by {len(collected)} of '
+                                f'{len(processes)} workers, tested {stats["tested"]} proxies in '
+                                f'{stats["duration"]:.2f}s, {stats["throughput"]:.1f} proxies/s, '
+                                f'valid {stats["valid"]}, invalid {stats["invalid"]}, '
+                                f'unreachable {stats["unreachable"]}')
+                collected, opened = {}, time.time()
+        finally:
+            for process in processes:
+                process.terminate()
+        return stats
+
     def run_getter(self, cycle=CYCLE_GETTER):
         """
         run getter
@@ -45,6 +138,7 @@ class Scheduler(object):
             logger.info('getter not enabled, exit')
             return
         getter = Getter()
+        start_pusher(getter.redis.db, getter.redis.key)
         loop = 0
         while True:
             logger.debug(f'getter loop {loop} start...')
@@ -59,6 +153,10 @@ class Scheduler(object):
         if not ENABLE_SERVER:
             logger.info('server not enabled, exit')
             return
+        # workers of the aiohttp server start their own pushers
+        if not (IS_PROD and APP_PROD_METHOD == APP_PROD_METHOD_AIOHTTP):
+            conn = RedisClient()
+            start_pusher(conn.db, conn.key)
         if IS_PROD:
             if APP_PROD_METHOD == APP_PROD_METHOD_GEVENT:
                 try:
@@ -90,6 +188,10 @@ class Scheduler(object):
                     meinheld.listen((API_HOST, API_PORT))
                     meinheld.run(app)
 
+            elif APP_PROD_METHOD == APP_PROD_METHOD_AIOHTTP:
+                from proxy_server_async import run_app
+                run_app(API_HOST, API_PORT)
+
             else:
                 logger.error("unsupported APP_PROD_METHOD")
                 return
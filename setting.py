@@ -26,9 +26,11 @@ APP_TEST = IS_TEST = APP_ENV == TEST_MODE
 # - gevent: pip install gevent
 # - tornado: pip install tornado
 # - meinheld: pip install meinheld
+# - aiohttp: native asyncio server, no WSGI container is needed
 APP_PROD_METHOD_GEVENT = 'gevent'
 APP_PROD_METHOD_TORNADO = 'tornado'
 APP_PROD_METHOD_MEINHELD = 'meinheld'
+APP_PROD_METHOD_AIOHTTP = 'aiohttp'
 APP_PROD_METHOD = env.str('APP_PROD_METHOD', APP_PROD_METHOD_GEVENT).lower()
 
 # redis host
@@ -46,17 +48,50 @@ REDIS_DB = env.int('PROXYPOOL_REDIS_DB', env.int('REDIS_DB', 0))
 REDIS_CONNECTION_STRING = env.str(
     'PROXYPOOL_REDIS_CONNECTION_STRING', env.str('REDIS_CONNECTION_STRING', None))
 
+# max number of connections of the asyncio redis connection pool of one process
+REDIS_MAX_CONNECTIONS = env.int('REDIS_MAX_CONNECTIONS', 100)
+
 # redis hash table key name
 REDIS_KEY = env.str('PROXYPOOL_REDIS_KEY', env.str(
     'REDIS_KEY', 'proxies:universal'))
 
+# number of buffered score updates sent to redis in one pipeline
+REDIS_FLUSH_SIZE = env.int('REDIS_FLUSH_SIZE', 200)
+# number of proxies added by one ZADD command when ingesting in bulk
+REDIS_ADD_CHUNK = env.int('REDIS_ADD_CHUNK', 1000)
+# keep new proxies in a set of candidates until they pass a test, so the pool only holds verified proxies,
+# and proxies falling to the min score are demoted to candidates instead of being removed
+REDIS_TIERED = env.bool('REDIS_TIERED', False)
+# seconds a new or demoted candidate is kept without passing a test
+CANDIDATE_TTL = env.int('CANDIDATE_TTL', 3600)
+# failed tests after which a proxy which never passed one is dropped, so a transient timeout does not evict it
+CANDIDATE_FAILURES = env.int('CANDIDATE_FAILURES', 3)
+# seconds an evicted proxy is remembered as dead, the getter skips it until then, 0 to not remember
+TOMBSTONE_TTL = env.int('TOMBSTONE_TTL', 86400)
+# max number of dead proxies remembered, those expiring first are forgotten first
+TOMBSTONE_MAX = env.int('TOMBSTONE_MAX', 100000)
+
 # definition of proxy scores
 PROXY_SCORE_MAX = 100
 PROXY_SCORE_MIN = 0
 PROXY_SCORE_INIT = 10
 
-# definition of proxy number
-PROXY_NUMBER_MAX = 50000
+# max number of proxies returned by one call of /random?n=
+API_RANDOM_MAX = env.int('API_RANDOM_MAX', 1000)
+# number of random draws per requested proxy of /random?n= before returning fewer proxies than requested
+RANDOM_MANY_DRAWS = env.int('RANDOM_MANY_DRAWS', 8)
+
+# pick random proxies with probability proportional to their score instead of only from max score ones
+RANDOM_WEIGHTED = env.bool('RANDOM_WEIGHTED', False)
+# max number of draws of one weighted pick before giving up and returning the last draw
+RANDOM_WEIGHTED_ATTEMPTS = env.int('RANDOM_WEIGHTED_ATTEMPTS', 16)
+
+# weight of a new latency sample in the moving average of latency of a proxy
+LATENCY_ALPHA = env.float('LATENCY_ALPHA', 0.3)
+
+# definition of proxy number, the pool and candidates are trimmed to PROXY_NUMBER_MAX after each crawl,
+# candidates expiring first are dropped first, then proxies with the lowest score
+PROXY_NUMBER_MAX = env.int('PROXY_NUMBER_MAX', 50000)
 PROXY_NUMBER_MIN = 0
 
 # definition of tester cycle, it will test every CYCLE_TESTER second
@@ -64,14 +99,67 @@ CYCLE_TESTER = env.int('CYCLE_TESTER', 40)
 # definition of getter cycle, it will get proxy every CYCLE_GETTER second
 CYCLE_GETTER = env.int('CYCLE_GETTER', 10000)
 GET_TIMEOUT = env.int('GET_TIMEOUT', 10)
+# number of source pages being fetched at the same time, and at most per host
+GET_CONCURRENCY = env.int('GET_CONCURRENCY', 20)
+GET_CONCURRENCY_PER_HOST = env.int('GET_CONCURRENCY_PER_HOST', 2)
+# max attempts to fetch one page, the wait between attempts starts at GET_BACKOFF seconds and doubles
+GET_RETRIES = env.int('GET_RETRIES', 3)
+GET_BACKOFF = env.float('GET_BACKOFF', 2)
+GET_BACKOFF_MAX = env.float('GET_BACKOFF_MAX', 30)
+# file to dump every fetched page to for debugging, no dump if not set
+GET_DUMP_FILE = env.str('GET_DUMP_FILE', None)
 
 # definition of tester
 TEST_URL = env.str('TEST_URL', 'http://www.baidu.com')
 TEST_TIMEOUT = env.int('TEST_TIMEOUT', 10)
+# number of members fetched by one ZSCAN call of the tester
 TEST_BATCH = env.int('TEST_BATCH', 20)
+# number of proxies being tested at the same time
+TEST_CONCURRENCY = env.int('TEST_CONCURRENCY', 500)
+# reuse one aiohttp session for a whole tester cycle instead of one session per proxy
+TEST_SESSION_SHARED = env.bool('TEST_SESSION_SHARED', False)
+# connector limits of the shared session, 0 means no limit
+TEST_CONN_LIMIT = env.int('TEST_CONN_LIMIT', 0)
+TEST_CONN_LIMIT_PER_HOST = env.int('TEST_CONN_LIMIT_PER_HOST', 0)
+# seconds to cache dns results of the shared session
+TEST_DNS_CACHE_TTL = env.int('TEST_DNS_CACHE_TTL', 600)
+# number of pre-generated fake headers, 0 means generate new headers for every proxy
+TEST_HEADERS_POOL = env.int('TEST_HEADERS_POOL', 0)
+# test every proxy when it is due instead of sweeping the whole pool every cycle
+TEST_ADAPTIVE = env.bool('TEST_ADAPTIVE', False)
+# seconds between two tests of a proxy, new and failed proxies are tested every TEST_INTERVAL_MIN seconds,
+# the interval is multiplied by TEST_INTERVAL_FACTOR after every passed test, up to TEST_INTERVAL_MAX seconds
+TEST_INTERVAL_MIN = env.int('TEST_INTERVAL_MIN', CYCLE_TESTER)
+TEST_INTERVAL_MAX = env.int('TEST_INTERVAL_MAX', 1800)
+TEST_INTERVAL_FACTOR = env.float('TEST_INTERVAL_FACTOR', 2)
+# seconds a claimed proxy is kept out of the due queue until its result is recorded, it is due again afterwards
+TEST_LEASE = env.int('TEST_LEASE', 300)
+# id of this tester worker in the registry shared by all testers of the pool, defaults to hostname:pid
+TEST_WORKER_ID = env.str('TEST_WORKER_ID', None)
+# seconds without heartbeat after which a tester worker is considered dead and its share is taken over
+TEST_WORKER_TTL = env.int('TEST_WORKER_TTL', 120)
+# number of tester processes started by the scheduler on this host, 0 means number of cpus
+TEST_WORKERS = env.int('TEST_WORKERS', 1)
+
+# connect to proxies by raw tcp before testing them by http, proxies not accepting the connection
+# in TEST_PRESCREEN_TIMEOUT seconds skip the http test, proxies at max score are not screened
+TEST_PRESCREEN = env.bool('TEST_PRESCREEN', False)
+TEST_PRESCREEN_TIMEOUT = env.float('TEST_PRESCREEN_TIMEOUT', 2)
+# number of tcp connects at the same time
+TEST_PRESCREEN_CONCURRENCY = env.int('TEST_PRESCREEN_CONCURRENCY', 1000)
 
 # only save anonymous proxy
 TEST_ANONYMOUS = env.bool('TEST_ANONYMOUS', True)
+# url answering the ip it sees in json, like {"origin": "8.8.8.8"}, used to find out the ip of this host
+TEST_ORIGIN_URL = env.str('TEST_ORIGIN_URL', 'https://httpbin.org/ip')
+# seconds to cache the ip of this host
+TEST_ORIGIN_TTL = env.int('TEST_ORIGIN_TTL', 600)
+# url of an echo endpoint like /echo of the api, if set, validity and anonymity of a proxy
+# are checked by one request to it instead of one request to TEST_ORIGIN_URL and one to TEST_URL
+TEST_ECHO_URL = env.str('TEST_ECHO_URL', None)
+# seconds a passed anonymity check of a proxy is trusted before it is checked again,
+# a proxy which passed a test over https is known to support https for as long
+TEST_ANONYMOUS_TTL = env.int('TEST_ANONYMOUS_TTL', 86400)
 
 TEST_VALID_STATUS = env.list('TEST_VALID_STATUS', [200, 206, 302])
 
@@ -79,6 +167,42 @@ TEST_VALID_STATUS = env.list('TEST_VALID_STATUS', [200, 206, 302])
 API_HOST = env.str('API_HOST', '0.0.0.0')
 API_PORT = env.int('API_PORT', 5555)
 API_THREADED = env.bool('API_THREADED', True)
+# number of worker processes of the aiohttp server sharing the port by SO_REUSEPORT, 0 means number of cpus
+API_WORKERS = env.int('API_WORKERS', 0)
+# number of proxies fetched from redis by one call while streaming /all
+API_PAGE_SIZE = env.int('API_PAGE_SIZE', 1000)
+# serve /random and /count from a snapshot of the pool kept in memory of the api process
+ENABLE_API_CACHE = env.bool('ENABLE_API_CACHE', False)
+# number of top ranked proxies kept in the snapshot, weighted picks fall back to redis once the pool is larger
+API_CACHE_SIZE = env.int('API_CACHE_SIZE', 10000)
+# seconds between checks of the pool version, the snapshot is reloaded once the version changes,
+# which happens when the set of max score proxies changes
+API_CACHE_POLL = env.float('API_CACHE_POLL', 1)
+# seconds after which the snapshot is reloaded even if the version did not change
+API_CACHE_TTL = env.float('API_CACHE_TTL', 10)
+
+# push metrics of every process to redis, so that /metrics of the api covers all of them,
+# otherwise it only shows the api process itself
+ENABLE_METRICS = env.bool('ENABLE_METRICS', False)
+# seconds between pushes of metrics of a process to redis
+METRICS_PUSH_INTERVAL = env.float('METRICS_PUSH_INTERVAL', 5)
+# seconds metrics of a process are kept after its last push
+METRICS_TTL = env.int('METRICS_TTL', 60)
+
+# default and max seconds a proxy is leased by /lease before the lease expires
+LEASE_TTL = env.int('LEASE_TTL', 60)
+LEASE_TTL_MAX = env.int('LEASE_TTL_MAX', 3600)
+# max number of leases of one proxy at the same time
+LEASE_CAP = env.int('LEASE_CAP', 1)
+# number of proxies looked at by one lease call before giving up if all of them are at the cap
+LEASE_ATTEMPTS = env.int('LEASE_ATTEMPTS', 16)
+
+# seconds between flushes of reports of clients by /report, reports of one proxy in between are coalesced
+REPORT_FLUSH_INTERVAL = env.float('REPORT_FLUSH_INTERVAL', 0.2)
+# max points a proxy loses by the failures reported in one flush
+REPORT_DECREASE_MAX = env.int('REPORT_DECREASE_MAX', 10)
+# number of failures reported since the last success which put a proxy at the front of the test queue
+REPORT_RETEST_FAILURES = env.int('REPORT_RETEST_FAILURES', 3)
 
 # flags of enable
 ENABLE_TESTER = env.bool('ENABLE_TESTER', True)
@@ -101,6 +225,13 @@ LOG_LEVEL_MAP = {
 
 # log level
 LOG_LEVEL = env.str('LOG_LEVEL', LOG_LEVEL_MAP.get(APP_ENV, 'DEBUG'))
+# rotate log files once they exceed a size like 500MB or an age like 1 day
 LOG_ROTATION = env.str('LOG_ROTATION', '500MB')
+# remove rotated log files older than an age like 1 week, or keep a number of them like 10
 LOG_RETENTION = env.str('LOG_RETENTION', '1 week')
+# records below WARNING let through per second from one line of code, 0 means no limit, and the burst allowed
+LOG_RATE_LIMIT = env.float('LOG_RATE_LIMIT', 0)
+LOG_RATE_BURST = env.int('LOG_RATE_BURST', 100)
+# write logs as json lines
+LOG_JSON = env.bool('LOG_JSON', False)
 
@@ -0,0 +1,56 @@
+from proxy_cache import ProxyCache, Snapshot
+from setting import PROXY_SCORE_MAX, PROXY_SCORE_MIN, PROXY_SCORE_INIT
+
+
+def scored(count, score, start=1):
+    return [(f'10.0.{n >> 8}.{n & 255}:80', score) for n in range(start, start + count)]
+
+
+def test_snapshot_picks_max_score_proxies():
+    snapshot = Snapshot(1, 4, scored(2, PROXY_SCORE_MAX) + scored(2, PROXY_SCORE_INIT, start=3))
+    assert snapshot.max_count == 2
+    assert {snapshot.random() for _ in range(50)} == {proxy for proxy, _ in scored(2, PROXY_SCORE_MAX)}
+    assert snapshot.covers() and snapshot.covers(weighted=True)
+
+
+def test_truncated_snapshot_covers():
+    # all max score proxies fit, so unweighted picks match the pool, weighted ones would miss the rest
+    snapshot = Snapshot(1, 300, scored(100, PROXY_SCORE_MAX) + scored(100, PROXY_SCORE_INIT, start=101))
+    assert snapshot.covers()
+    assert not snapshot.covers(weighted=True)
+    # max score proxies cut off by the size would skew unweighted picks too
+    assert not Snapshot(1, 300, scored(200, PROXY_SCORE_MAX)).covers()
+    # without max score proxies, picks are by rank among the top ones
+    assert Snapshot(1, 300, scored(PROXY_SCORE_MAX - PROXY_SCORE_MIN + 1, PROXY_SCORE_INIT)).covers()
+    assert not Snapshot(1, 300, scored(PROXY_SCORE_MAX - PROXY_SCORE_MIN, PROXY_SCORE_INIT)).covers()
+
+
+def test_cache_falls_back_to_redis(conn):
+    pool = [proxy for proxy, _ in scored(3, PROXY_SCORE_INIT)]
+    conn.add_many(pool)
+    conn.max(pool[0])
+    cache = ProxyCache(conn, size=2, poll=60, ttl=60)
+    # refreshed by hand rather than by the background thread
+    cache.thread = object()
+    cache.refresh()
+    assert cache.count() == 3
+    assert str(cache.random()) == pool[0]
+    assert cache.hits == 2
+    # a weighted pick from two of three proxies would differ from one of the pool
+    assert str(cache.random(weighted=True)) in pool
+    assert cache.misses == 1
+    stats = cache.stats()
+    assert stats['snapshot_size'] == 2
+    assert stats['hit_rate'] == 2 / 3
+
+
+def test_cache_reloads_on_version_change(conn):
+    cache = ProxyCache(conn, size=10, poll=60, ttl=60)
+    cache.refresh()
+    conn.add('8.8.8.8:8888')
+    cache.refresh_if_needed()
+    assert cache.refreshes == 1
+    conn.max('8.8.8.8:8888')
+    cache.refresh_if_needed()
+    assert cache.refreshes == 2
+    assert cache.snapshot.max_count == 1
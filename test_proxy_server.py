@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from setting import PROXY_SCORE_INIT
+
+pytest.importorskip('flask')
+
+PROXY = '8.8.8.8:8888'
+
+
+@pytest.fixture
+def client(conn, monkeypatch):
+    from proxy_server import app
+    # the app keeps its clients as attributes, reports are flushed by hand rather than by a thread
+    monkeypatch.setattr(app, 'redis', conn, raising=False)
+    monkeypatch.setattr(app, 'reports', conn.reports(), raising=False)
+    return app.test_client()
+
+
+def test_random(client, conn):
+    conn.add(PROXY)
+    assert client.get('/random').get_data(as_text=True) == PROXY
+    assert client.get('/random?weighted=1').get_data(as_text=True) == PROXY
+
+
+def test_random_many(client, conn):
+    conn.add_many(['8.8.8.8:8888', '1.1.1.1:80'])
+    response = client.get('/random?n=5&min_score=0')
+    assert sorted(response.get_data(as_text=True).split()) == ['1.1.1.1:80', '8.8.8.8:8888']
+    assert client.get('/random?n=5&anonymity=anonymous').get_data(as_text=True) == ''
+    assert client.get('/random?protocol=ftp').status_code == 400
+    assert client.get('/random?n=1&format=xml').status_code == 400
+
+
+def test_all_and_count(client, conn):
+    conn.add_many(['8.8.8.8:8888', '1.1.1.1:80'])
+    conn.max('1.1.1.1:80')
+    lines = client.get('/all?format=jsonl').get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == [{'proxy': '1.1.1.1:80', 'score': 100},
+                                                    {'proxy': '8.8.8.8:8888', 'score': PROXY_SCORE_INIT}]
+    assert client.get('/all?limit=1').get_data(as_text=True) == '1.1.1.1:80\n'
+    assert client.get('/count').get_data(as_text=True) == '2'
+
+
+def test_fastest(client, conn):
+    conn.add_many(['8.8.8.8:8888', '1.1.1.1:80'])
+    conn.record_latency('8.8.8.8:8888', 300)
+    conn.record_latency('1.1.1.1:80', 30)
+    assert client.get('/fastest?n=0').get_data(as_text=True) == '1.1.1.1:80\n'
+    lines = client.get('/fastest?format=jsonl').get_data(as_text=True).splitlines()
+    assert [json.loads(line)['proxy'] for line in lines] == ['1.1.1.1:80', '8.8.8.8:8888']
+
+
+def test_lease_and_release(client, conn):
+    assert client.get('/lease').status_code == 503
+    conn.add(PROXY)
+    lease = client.get('/lease?ttl=30').get_json()
+    assert lease['proxy'] == PROXY and lease['ttl'] == 30
+    assert client.get('/release').status_code == 400
+    assert client.get(f'/release?lease={lease["lease"]}&ok=0').get_data(as_text=True) == PROXY
+    assert conn.db.zscore(conn.key, PROXY) == PROXY_SCORE_INIT - 1
+    assert client.get(f'/release?lease={lease["lease"]}').status_code == 404
+
+
+def test_report(client, conn):
+    from proxy_server import app
+    conn.add(PROXY)
+    assert client.get('/report?proxy=nonsense').status_code == 400
+    assert client.get(f'/report?proxy={PROXY}&ok=0').get_data(as_text=True) == 'ok'
+    assert app.reports.flush() == 1
+    assert conn.db.zscore(conn.key, PROXY) == PROXY_SCORE_INIT - 1
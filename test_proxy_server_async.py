@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from setting import PROXY_SCORE_INIT
+
+pytest.importorskip('aiohttp')
+
+PROXY = '8.8.8.8:8888'
+
+
+@pytest.fixture
+def request_app(redis_server):
+    """
+    run a coroutine taking a client of the app, without a pytest plugin of aiohttp
+    """
+    from aiohttp.test_utils import TestClient, TestServer
+    from proxy_server_async import create_app
+
+    def run(check):
+        async def main():
+            async with TestClient(TestServer(create_app())) as client:
+                await check(client)
+
+        asyncio.run(main())
+
+    return run
+
+
+def test_random(request_app, conn):
+    async def check(client):
+        assert (await client.get('/random')).status == 500
+        conn.add(PROXY)
+        assert await (await client.get('/random')).text() == PROXY
+        assert await (await client.get('/random?weighted=1')).text() == PROXY
+
+    request_app(check)
+
+
+def test_random_many(request_app, conn):
+    conn.add_many(['8.8.8.8:8888', '1.1.1.1:80'])
+
+    async def check(client):
+        text = await (await client.get('/random?n=5&min_score=0')).text()
+        assert sorted(text.split()) == ['1.1.1.1:80', '8.8.8.8:8888']
+        assert await (await client.get('/random?n=5&anonymity=anonymous')).text() == ''
+        assert (await client.get('/random?protocol=ftp')).status == 400
+        assert (await client.get('/random?n=1&format=xml')).status == 400
+
+    request_app(check)
+
+
+def test_all_fastest_and_count(request_app, conn):
+    conn.add_many(['8.8.8.8:8888', '1.1.1.1:80'])
+    conn.max('1.1.1.1:80')
+    conn.record_latency('1.1.1.1:80', 30)
+
+    async def check(client):
+        lines = (await (await client.get('/all?format=jsonl')).text('utf-8')).splitlines()
+        assert [json.loads(line) for line in lines] == [{'proxy': '1.1.1.1:80', 'score': 100},
+                                                        {'proxy': '8.8.8.8:8888', 'score': PROXY_SCORE_INIT}]
+        assert await (await client.get('/all?offset=1')).text() == '8.8.8.8:8888\n'
+        assert await (await client.get('/fastest?n=0')).text() == '1.1.1.1:80\n'
+        assert await (await client.get('/count')).text() == '2'
+
+    request_app(check)
+
+
+def test_lease_and_release(request_app, conn):
+    async def check(client):
+        assert (await client.get('/lease')).status == 503
+        conn.add(PROXY)
+        lease = await (await client.get('/lease?ttl=30')).json()
+        assert lease['proxy'] == PROXY and lease['ttl'] == 30
+        assert (await client.get('/release')).status == 400
+        assert await (await client.get(f'/release?lease={lease["lease"]}&ok=0')).text() == PROXY
+        assert (await client.get(f'/release?lease={lease["lease"]}')).status == 404
+
+    request_app(check)
+    assert conn.db.zscore(conn.key, PROXY) == PROXY_SCORE_INIT - 1
+
+
+def test_report(request_app, conn):
+    conn.add(PROXY)
+
+    async def check(client):
+        assert (await client.get('/report?proxy=nonsense')).status == 400
+        assert await (await client.get(f'/report?proxy={PROXY}&ok=0')).text() == 'ok'
+
+    # pending reports are flushed on cleanup at the latest
+    request_app(check)
+    assert conn.db.zscore(conn.key, PROXY) == PROXY_SCORE_INIT - 1
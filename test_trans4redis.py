@@ -0,0 +1,232 @@
+import time
+
+import pytest
+
+from base_exception import PoolEmptyException
+from models import Proxy
+from setting import PROXY_SCORE_MAX, PROXY_SCORE_MIN, PROXY_SCORE_INIT, CANDIDATE_FAILURES, TEST_INTERVAL_MIN, \
+    TEST_INTERVAL_MAX, REPORT_DECREASE_MAX
+from trans4redis import RedisClient
+
+PROXY = '8.8.8.8:8888'
+
+
+def proxies(count, start=1):
+    return [Proxy(ip=f'10.0.{n >> 8}.{n & 255}', port='80') for n in range(start, start + count)]
+
+
+def test_add_many_counts_new_and_known(conn):
+    assert conn.add_many(proxies(3)) == (3, 0)
+    assert conn.add_many(proxies(5) + ['not a proxy']) == (2, 3)
+    assert conn.count() == 5
+    # new proxies are due at once
+    assert conn.db.zcard(conn.due_key) == 5
+
+
+def test_add_skips_tombstoned(conn):
+    conn.add(PROXY, score=PROXY_SCORE_MIN + 1)
+    conn.decrease(PROXY)
+    assert not conn.exists(PROXY)
+    assert conn.dead([PROXY, '1.1.1.1:80']) == {PROXY}
+    assert conn.add(PROXY) == 0
+    assert not conn.exists(PROXY)
+
+
+def test_decrease_removes_records_at_min(conn):
+    conn.add(PROXY, score=PROXY_SCORE_MIN + 2)
+    conn.record_latency(PROXY, 100, 20)
+    assert conn.decrease(PROXY) == PROXY_SCORE_MIN + 1
+    # a failed test drops latency averages, so /fastest only lists proxies whose last test passed
+    assert conn.fastest(10) == []
+    assert conn.decrease(PROXY) == PROXY_SCORE_MIN
+    for key in (conn.key, conn.due_key, conn.latency_key, conn.connect_key):
+        assert conn.db.zscore(key, PROXY) is None
+    assert conn.decrease(PROXY) is None
+
+
+def test_decrease_bumps_version_only_from_max(conn):
+    conn.add(PROXY)
+    version = conn.version()
+    conn.decrease(PROXY)
+    assert conn.version() == version
+    assert conn.max(PROXY) == 1
+    assert conn.version() == version + 1
+    assert conn.max(PROXY) == 0
+    assert conn.version() == version + 1
+    conn.decrease(PROXY)
+    assert conn.version() == version + 2
+
+
+def test_max_leaves_absent_and_tombstoned_proxies_alone(conn):
+    assert conn.max(PROXY) == 0
+    assert not conn.exists(PROXY)
+    conn.add(PROXY, score=PROXY_SCORE_MIN + 1)
+    conn.decrease(PROXY)
+    assert conn.max(PROXY) == 0
+    assert conn.record_latency(PROXY, 100) is None
+    assert not conn.exists(PROXY)
+    assert conn.fastest(10) == []
+
+
+def test_tiered_candidate_is_promoted_or_struck_out(redis_server):
+    conn = RedisClient(tiered=True)
+    good, bad = proxies(2)
+    assert conn.add_many([good, bad]) == (2, 0)
+    assert conn.count() == 0
+    assert conn.max(good) == 1
+    assert conn.db.zscore(conn.key, str(good)) == PROXY_SCORE_MAX
+    assert conn.db.zscore(conn.candidates_key, str(good)) is None
+    for _ in range(CANDIDATE_FAILURES - 1):
+        assert conn.decrease(bad) is None
+        assert conn.db.zscore(conn.candidates_key, str(bad)) is not None
+    conn.decrease(bad)
+    assert conn.db.zscore(conn.candidates_key, str(bad)) is None
+    assert conn.dead([bad]) == {str(bad)}
+
+
+def test_trim_drops_lowest_scores_and_tombstones_them(conn):
+    pool = proxies(5)
+    conn.add_many(pool)
+    for proxy in pool[2:]:
+        conn.max(proxy)
+    version = conn.version()
+    assert conn.trim(3) == 2
+    assert conn.count() == 3
+    assert conn.dead(pool) == {str(proxy) for proxy in pool[:2]}
+    assert conn.version() == version
+    assert conn.trim(3) == 0
+
+
+def test_buffer_evicts_after_failure_budget_and_schedules(conn):
+    conn.add(PROXY)
+    buffer = conn.buffer(schedule=True)
+    for _ in range(CANDIDATE_FAILURES - 1):
+        before = time.time()
+        buffer.evict(PROXY)
+        assert buffer.flush() == 1
+        assert conn.exists(PROXY)
+        # a proxy still in pool is scheduled like one which failed a test
+        assert conn.db.zscore(conn.due_key, PROXY) >= before + TEST_INTERVAL_MIN
+    buffer.evict(PROXY)
+    buffer.flush()
+    assert not conn.exists(PROXY)
+    assert conn.db.zscore(conn.due_key, PROXY) is None
+    assert conn.dead([PROXY]) == {PROXY}
+
+
+def test_buffer_max_records_latency_and_grows_interval(conn):
+    conn.add(PROXY)
+    buffer = conn.buffer(schedule=True)
+    intervals = []
+    for _ in range(3):
+        buffer.max(PROXY, latency=100, connect=20, anonymous=True, https=True)
+        buffer.flush()
+        intervals.append(float(conn.db.hget(conn.interval_key, PROXY)))
+    assert intervals == [TEST_INTERVAL_MIN, min(TEST_INTERVAL_MIN * 2, TEST_INTERVAL_MAX),
+                         min(TEST_INTERVAL_MIN * 4, TEST_INTERVAL_MAX)]
+    assert conn.db.zscore(conn.key, PROXY) == PROXY_SCORE_MAX
+    assert conn.fastest(10) == [(PROXY, 100)]
+    assert PROXY in conn.anonymous()
+    # a failed test starts over from the min interval
+    buffer.decrease(PROXY)
+    buffer.flush()
+    assert float(conn.db.hget(conn.interval_key, PROXY)) == TEST_INTERVAL_MIN
+
+
+def test_claim_due_is_bounded_by_due_time(conn):
+    pool = proxies(3)
+    conn.add_many(pool)
+    now = time.time()
+    conn.db.zadd(conn.due_key, {str(pool[2]): now + 60})
+    claimed = conn.claim_due(10, due=now, lease=300)
+    assert sorted(str(proxy) for proxy, _ in claimed) == sorted(str(proxy) for proxy in pool[:2])
+    assert all(score == PROXY_SCORE_INIT for _, score in claimed)
+    # claimed proxies are pushed past the lease, so other workers do not claim them again
+    assert conn.claim_due(10, due=now) == []
+    assert conn.db.zscore(conn.due_key, str(pool[0])) >= now + 300
+
+
+def test_claim_due_drops_proxies_not_in_pool(conn):
+    conn.add(PROXY)
+    conn.db.zadd(conn.due_key, {'1.1.1.1:80': 0})
+    assert [str(proxy) for proxy, _ in conn.claim_due(10)] == [PROXY]
+    assert conn.db.zscore(conn.due_key, '1.1.1.1:80') is None
+
+
+def test_sync_schedule_matches_pool(conn):
+    conn.db.zadd(conn.key, {PROXY: PROXY_SCORE_INIT})
+    conn.db.zadd(conn.due_key, {'1.1.1.1:80': 0})
+    assert conn.sync_schedule() == (1, 1)
+    assert conn.db.zrange(conn.due_key, 0, -1) == [PROXY]
+
+
+def test_lease_and_release(conn):
+    with pytest.raises(PoolEmptyException):
+        conn.lease()
+    conn.add(PROXY)
+    lease_id, proxy = conn.lease(ttl=60, cap=1)
+    assert str(proxy) == PROXY
+    # the only proxy is leased up to its cap
+    with pytest.raises(PoolEmptyException):
+        conn.lease(ttl=60, cap=1)
+    assert str(conn.release(lease_id, ok=False)) == PROXY
+    assert conn.db.zscore(conn.key, PROXY) == PROXY_SCORE_INIT - 1
+    assert conn.release(lease_id) is None
+    assert str(conn.lease(ttl=60, cap=1)[1]) == PROXY
+
+
+def test_report_caps_decrease_and_retests(conn):
+    conn.add(PROXY)
+    conn.max(PROXY)
+    conn.db.zadd(conn.due_key, {PROXY: time.time() + 600})
+    assert conn.report(PROXY, failures=1) == PROXY_SCORE_MAX - 1
+    assert conn.report(PROXY, successes=1) == PROXY_SCORE_MAX - 1
+    assert conn.report(PROXY, failures=REPORT_DECREASE_MAX * 2) == PROXY_SCORE_MAX - 1 - REPORT_DECREASE_MAX
+    # a burst of failures makes the proxy due at once
+    assert conn.db.zscore(conn.due_key, PROXY) == 0
+    assert conn.report('1.1.1.1:80', failures=1) is None
+
+
+def test_report_buffer_coalesces(conn):
+    conn.add(PROXY)
+    reports = conn.reports()
+    for ok in (False, False, True):
+        reports.report(PROXY, ok=ok)
+    assert len(reports) == 1
+    assert reports.flush() == 1
+    assert conn.db.zscore(conn.key, PROXY) == PROXY_SCORE_INIT - 2
+    assert reports.flush() == 0
+
+
+def test_random_many_filters(conn):
+    fast, slow, plain = (str(proxy) for proxy in proxies(3))
+    conn.add_many([fast, slow, plain])
+    buffer = conn.buffer()
+    buffer.max(fast, latency=50, anonymous=True, https=True)
+    buffer.max(slow, latency=500)
+    buffer.flush()
+    assert sorted(proxy for proxy, _ in conn.random_many(10)) == sorted([fast, slow])
+    assert len(conn.random_many(10, min_score=PROXY_SCORE_MIN)) == 3
+    assert len(conn.random_many(1)) == 1
+    assert [proxy for proxy, _ in conn.random_many(10, anonymous=True)] == [fast]
+    assert [proxy for proxy, _ in conn.random_many(10, https=True)] == [fast]
+    assert [proxy for proxy, _ in conn.random_many(10, max_latency=100)] == [fast]
+    assert str(conn.random(max_latency=100)) == fast
+
+
+def test_random_prefers_max_score(conn):
+    with pytest.raises(PoolEmptyException):
+        conn.random()
+    best, other = proxies(2)
+    conn.add_many([best, other])
+    conn.max(best)
+    assert {str(conn.random()) for _ in range(20)} == {str(best)}
+    assert str(conn.random(weighted=True)) in {str(best), str(other)}
+
+
+def test_purge_tombstones(conn):
+    now = time.time()
+    conn.db.zadd(conn.dead_key, {'1.1.1.1:80': now - 1, '2.2.2.2:80': now + 60, '3.3.3.3:80': now + 120})
+    assert conn.dead(['1.1.1.1:80', '2.2.2.2:80']) == {'2.2.2.2:80'}
+    assert conn.purge_tombstones(max_number=1) == 1
+    assert conn.db.zrange(conn.dead_key, 0, -1) == ['3.3.3.3:80']
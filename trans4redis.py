@@ -1,19 +1,580 @@
 import sys
+import threading
+import time
+import uuid
 
 import redis
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
 from base_exception import PoolEmptyException
 from models import Proxy, is_valid_proxy, convert_proxy_or_proxies
 from setting import REDIS_CONNECTION_STRING, REDIS_HOST, REDIS_PORT, REDIS_PASSWORD, REDIS_DB, REDIS_KEY, PROXY_SCORE_MAX, PROXY_SCORE_MIN, \
-    PROXY_SCORE_INIT
-from random import choice
-from typing import List
+    PROXY_SCORE_INIT, REDIS_FLUSH_SIZE, REDIS_ADD_CHUNK, RANDOM_WEIGHTED, RANDOM_WEIGHTED_ATTEMPTS, \
+    API_PAGE_SIZE, REDIS_MAX_CONNECTIONS, LATENCY_ALPHA, TEST_INTERVAL_MIN, TEST_INTERVAL_MAX, TEST_INTERVAL_FACTOR, \
+    TEST_LEASE, TEST_WORKER_TTL, TEST_ANONYMOUS_TTL, LEASE_TTL, LEASE_CAP, LEASE_ATTEMPTS, \
+    REPORT_FLUSH_INTERVAL, REPORT_DECREASE_MAX, REPORT_RETEST_FAILURES, RANDOM_MANY_DRAWS, REDIS_TIERED, \
+    CANDIDATE_TTL, CANDIDATE_FAILURES, PROXY_NUMBER_MAX, TOMBSTONE_TTL, TOMBSTONE_MAX
+import random
+from typing import List, Iterable, Iterator, Tuple
 from handle_log import get_logger
+from metrics import timed
 
 
 REDIS_CLIENT_VERSION = redis.__version__
 IS_REDIS_VERSION_2 = REDIS_CLIENT_VERSION.startswith('2.')
 logger = get_logger('redis_client')
 
+# decrease score of an existing proxy and remove it once it reaches the min score, in one atomic call,
+# its latency averages are dropped, so only proxies whose last test passed are picked by latency,
+# a removed proxy is demoted to a candidate expiring at ARGV[3] if set, and a candidate is dropped once
+# it failed ARGV[6] tests, proxies removed for good are remembered as dead until ARGV[4] if set,
+# the version is bumped only if the proxy leaves the max score ones
+# KEYS[1]: proxies key, KEYS[2]: version key, KEYS[3]: latency key, KEYS[4]: connect latency key,
+# KEYS[5]: due key, KEYS[6]: interval key, KEYS[7]: anonymous key, KEYS[8]: reported failures key,
+# KEYS[9]: https key, KEYS[10]: candidates key, KEYS[11]: dead key, KEYS[12]: strikes key
+# ARGV[1]: proxy, ARGV[2]: min score, ARGV[3]: expiry of demoted proxy, empty if proxies are not demoted,
+# ARGV[4]: expiry of tombstone, empty if dead proxies are not remembered, ARGV[5]: max score,
+# ARGV[6]: failed tests after which a candidate is dropped
+# return: new score, or false if proxy not exists
+DECREASE_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    if redis.call('ZSCORE', KEYS[10], ARGV[1])
+            and redis.call('HINCRBY', KEYS[12], ARGV[1], 1) >= tonumber(ARGV[6]) then
+        redis.call('ZREM', KEYS[10], ARGV[1])
+        redis.call('HDEL', KEYS[12], ARGV[1])
+        if ARGV[4] ~= '' then
+            redis.call('ZADD', KEYS[11], ARGV[4], ARGV[1])
+        end
+    end
+    return false
+end
+local score = redis.call('ZINCRBY', KEYS[1], -1, ARGV[1])
+if tonumber(score) + 1 >= tonumber(ARGV[5]) then
+    redis.call('INCR', KEYS[2])
+end
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+if tonumber(score) <= tonumber(ARGV[2]) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[5], ARGV[1])
+    redis.call('HDEL', KEYS[6], ARGV[1])
+    redis.call('ZREM', KEYS[7], ARGV[1])
+    redis.call('HDEL', KEYS[8], ARGV[1])
+    redis.call('ZREM', KEYS[9], ARGV[1])
+    redis.call('HDEL', KEYS[12], ARGV[1])
+    if ARGV[3] ~= '' then
+        redis.call('ZADD', KEYS[10], ARGV[3], ARGV[1])
+    elseif ARGV[4] ~= '' then
+        redis.call('ZADD', KEYS[11], ARGV[4], ARGV[1])
+    end
+end
+return score
+"""
+
+# apply reports of clients about a proxy, failures decrease its score by at most ARGV[6], drop its latency
+# averages, and remove it once it reaches the min score, a success clears its failures, and once ARGV[5]
+# failures are reported without a success in between, the proxy is due to be tested at once,
+# the version is bumped only if the proxy leaves the max score ones
+# KEYS: same as DECREASE_SCRIPT
+# ARGV[1]: proxy, ARGV[2]: failures, ARGV[3]: successes, ARGV[4]: min score, ARGV[5]: failures to retest,
+# ARGV[6]: max decrease, ARGV[7]: expiry of demoted proxy, empty if proxies are not demoted,
+# ARGV[8]: expiry of tombstone, empty if dead proxies are not remembered, ARGV[9]: max score
+# return: new score, or false if proxy not exists
+REPORT_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('HDEL', KEYS[8], ARGV[1])
+    return false
+end
+local failures = tonumber(ARGV[2])
+if failures == 0 then
+    redis.call('HDEL', KEYS[8], ARGV[1])
+    return redis.call('ZSCORE', KEYS[1], ARGV[1])
+end
+local decrease = math.min(failures, tonumber(ARGV[6]))
+local score = redis.call('ZINCRBY', KEYS[1], -decrease, ARGV[1])
+if tonumber(score) + decrease >= tonumber(ARGV[9]) then
+    redis.call('INCR', KEYS[2])
+end
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+if tonumber(score) <= tonumber(ARGV[4]) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[5], ARGV[1])
+    redis.call('HDEL', KEYS[6], ARGV[1])
+    redis.call('ZREM', KEYS[7], ARGV[1])
+    redis.call('HDEL', KEYS[8], ARGV[1])
+    redis.call('ZREM', KEYS[9], ARGV[1])
+    redis.call('HDEL', KEYS[12], ARGV[1])
+    if ARGV[7] ~= '' then
+        redis.call('ZADD', KEYS[10], ARGV[7], ARGV[1])
+    elseif ARGV[8] ~= '' then
+        redis.call('ZADD', KEYS[11], ARGV[8], ARGV[1])
+    end
+    return score
+end
+if redis.call('HINCRBY', KEYS[8], ARGV[1], failures) >= tonumber(ARGV[5]) then
+    redis.call('ZADD', KEYS[5], 0, ARGV[1])
+    redis.call('HDEL', KEYS[8], ARGV[1])
+end
+return score
+"""
+
+# set a proxy to max score, move it out of candidates and clear its failed tests, in one atomic call,
+# a proxy neither in pool nor a candidate, or remembered as dead after ARGV[3], is left alone, since it may
+# have been trimmed, evicted or tombstoned after it was claimed, the version is bumped only if the proxy
+# was not at max score yet
+# KEYS[1]: proxies key, KEYS[2]: candidates key, KEYS[3]: version key, KEYS[4]: strikes key, KEYS[5]: dead key
+# ARGV[1]: proxy, ARGV[2]: max score, ARGV[3]: now
+# return: 1 if proxy was not at max score, else 0
+PROMOTE_SCRIPT = """
+local dead = redis.call('ZSCORE', KEYS[5], ARGV[1])
+if dead and tonumber(dead) > tonumber(ARGV[3]) then
+    return 0
+end
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) and not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+local changed = redis.call('ZADD', KEYS[1], 'CH', ARGV[2], ARGV[1])
+if changed == 1 then
+    redis.call('INCR', KEYS[3])
+end
+return changed
+"""
+
+# remove proxies with their records and candidates once they failed ARGV[3] tests, and remember them
+# as dead until ARGV[2] if set, the version is bumped only if a proxy at max score is removed
+# KEYS: same as DECREASE_SCRIPT
+# ARGV[1]: max score, ARGV[2]: expiry of tombstone, empty if dead proxies are not remembered,
+# ARGV[3]: failed tests after which a proxy is removed, 1 to remove at once, ARGV[4...]: proxies
+# return: number of proxies removed from pool
+REMOVE_SCRIPT = """
+local removed = 0
+local bump = false
+local budget = tonumber(ARGV[3])
+for i = 4, #ARGV do
+    if budget <= 1 or redis.call('HINCRBY', KEYS[12], ARGV[i], 1) >= budget then
+        local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+        if score then
+            removed = removed + 1
+            bump = bump or tonumber(score) >= tonumber(ARGV[1])
+            redis.call('ZREM', KEYS[1], ARGV[i])
+        end
+        for _, key in ipairs({KEYS[3], KEYS[4], KEYS[5], KEYS[7], KEYS[9], KEYS[10]}) do
+            redis.call('ZREM', key, ARGV[i])
+        end
+        for _, key in ipairs({KEYS[6], KEYS[8], KEYS[12]}) do
+            redis.call('HDEL', key, ARGV[i])
+        end
+        if ARGV[2] ~= '' then
+            redis.call('ZADD', KEYS[11], ARGV[2], ARGV[i])
+        end
+    end
+end
+if bump then
+    redis.call('INCR', KEYS[2])
+end
+return removed
+"""
+
+# add proxies not in pool as candidates expiring at ARGV[1], known candidates keep their expiry
+# KEYS[1]: proxies key, KEYS[2]: candidates key
+# ARGV[1]: expiry, ARGV[2...]: proxies
+# return: number of new candidates
+CANDIDATE_SCRIPT = """
+local added = 0
+for i = 2, #ARGV do
+    if not redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        added = added + redis.call('ZADD', KEYS[2], 'NX', ARGV[1], ARGV[i])
+    end
+end
+return added
+"""
+
+# trim pool and candidates to ARGV[1] proxies in total, candidates expiring first are dropped first,
+# then proxies with the lowest score along with their records, dropped ones are remembered as dead until
+# ARGV[3] if set, the version is bumped only if a proxy at max score is dropped
+# KEYS: same as DECREASE_SCRIPT
+# ARGV[1]: max number of proxies, ARGV[2]: max score, ARGV[3]: expiry of tombstone, empty if dead proxies
+# are not remembered
+# return: number of proxies and candidates dropped
+TRIM_SCRIPT = """
+local excess = redis.call('ZCARD', KEYS[1]) + redis.call('ZCARD', KEYS[10]) - tonumber(ARGV[1])
+if excess <= 0 then
+    return 0
+end
+local dropped = math.min(excess, redis.call('ZCARD', KEYS[10]))
+if dropped > 0 then
+    local candidates = redis.call('ZRANGE', KEYS[10], 0, dropped - 1)
+    for i = 1, #candidates, 1000 do
+        local chunk = {unpack(candidates, i, math.min(i + 999, #candidates))}
+        redis.call('ZREM', KEYS[10], unpack(chunk))
+        redis.call('HDEL', KEYS[12], unpack(chunk))
+        if ARGV[3] ~= '' then
+            for _, member in ipairs(chunk) do
+                redis.call('ZADD', KEYS[11], ARGV[3], member)
+            end
+        end
+    end
+end
+if excess > dropped then
+    local members = redis.call('ZRANGE', KEYS[1], 0, excess - dropped - 1)
+    local highest = tonumber(redis.call('ZSCORE', KEYS[1], members[#members]))
+    -- unpack in chunks to stay within the stack of lua
+    for i = 1, #members, 1000 do
+        local chunk = {unpack(members, i, math.min(i + 999, #members))}
+        for _, key in ipairs({KEYS[1], KEYS[3], KEYS[4], KEYS[5], KEYS[7], KEYS[9]}) do
+            redis.call('ZREM', key, unpack(chunk))
+        end
+        for _, key in ipairs({KEYS[6], KEYS[8], KEYS[12]}) do
+            redis.call('HDEL', key, unpack(chunk))
+        end
+        if ARGV[3] ~= '' then
+            for _, member in ipairs(chunk) do
+                redis.call('ZADD', KEYS[11], ARGV[3], member)
+            end
+        end
+    end
+    if highest >= tonumber(ARGV[2]) then
+        redis.call('INCR', KEYS[2])
+    end
+    dropped = dropped + #members
+end
+return dropped
+"""
+
+# fold a latency sample of a proxy into its exponentially weighted moving average, unless the proxy
+# is not in pool
+# KEYS[1]: latency key, KEYS[2]: proxies key, ARGV[1]: proxy, ARGV[2]: sample in ms, ARGV[3]: weight of the sample
+# return: new average, or false if proxy not exists
+LATENCY_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return false
+end
+local value = tonumber(ARGV[2])
+local old = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if old then
+    local alpha = tonumber(ARGV[3])
+    value = alpha * value + (1 - alpha) * tonumber(old)
+end
+redis.call('ZADD', KEYS[1], value, ARGV[1])
+return tostring(value)
+"""
+
+# schedule next test of a proxy, the interval grows by ARGV[6] times after a passed test up to ARGV[5],
+# and falls back to ARGV[4] after a failed one, schedule of a proxy no longer in pool is dropped
+# KEYS[1]: proxies key, KEYS[2]: due key, KEYS[3]: interval key
+# ARGV[1]: proxy, ARGV[2]: 1 if passed else 0, ARGV[3]: now, ARGV[4]: min interval, ARGV[5]: max interval,
+# ARGV[6]: factor
+# return: interval in seconds, or false if proxy not exists
+SCHEDULE_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    return false
+end
+local interval = tonumber(ARGV[4])
+if ARGV[2] == '1' then
+    local last = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+    interval = math.min(math.max(last * tonumber(ARGV[6]), interval), tonumber(ARGV[5]))
+end
+redis.call('HSET', KEYS[3], ARGV[1], interval)
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]) + interval, ARGV[1])
+return tostring(interval)
+"""
+
+# claim at most ARGV[2] proxies due at ARGV[1], they are pushed ARGV[3] seconds past ARGV[4] so that
+# they are not claimed again while being tested, and are due again if their result is never recorded,
+# proxies no longer in pool are dropped from the due queue
+# KEYS[1]: due key, KEYS[2]: proxies key, ARGV[1]: due time, ARGV[2]: count, ARGV[3]: lease in seconds,
+# ARGV[4]: now
+# return: flat list of proxy, score pairs, empty only if no proxy is due
+CLAIM_SCRIPT = """
+local deadline = tonumber(ARGV[4]) + tonumber(ARGV[3])
+local result = {}
+while #result == 0 do
+    local proxies = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+    if #proxies == 0 then
+        break
+    end
+    for i, proxy in ipairs(proxies) do
+        local score = redis.call('ZSCORE', KEYS[2], proxy)
+        if score then
+            redis.call('ZADD', KEYS[1], 'XX', deadline, proxy)
+            table.insert(result, proxy)
+            table.insert(result, score)
+        else
+            redis.call('ZREM', KEYS[1], proxy)
+        end
+    end
+end
+return result
+"""
+
+# pick a random proxy whose average latency is at most ARGV[1], by rank of the latency set,
+# which only holds proxies whose last test passed
+# KEYS[1]: latency key, ARGV[1]: max latency in ms, ARGV[2]: random float in [0, 1)
+# return: proxy, or false if no proxy is fast enough
+RANDOM_LATENCY_SCRIPT = """
+local count = redis.call('ZCOUNT', KEYS[1], 0, ARGV[1])
+if count == 0 then
+    return false
+end
+local rank = math.floor(tonumber(ARGV[2]) * count)
+return redis.call('ZRANGE', KEYS[1], rank, rank)[1]
+"""
+
+# pick up to ARGV[1] distinct random proxies with score at least ARGV[2], or max score ones if ARGV[2] is empty,
+# falling back to all proxies if there is no max score proxy, and filter them by anonymity, https support and
+# latency, few candidates are all visited in random order, otherwise random ranks are drawn at most ARGV[9] times
+# per requested proxy
+# KEYS[1]: proxies key, KEYS[2]: latency key, KEYS[3]: anonymous key, KEYS[4]: https key
+# ARGV[1]: count, ARGV[2]: min score or empty, ARGV[3]: max score, ARGV[4]: 1 if anonymous is required,
+# ARGV[5]: 1 if https is required, ARGV[6]: max latency in ms or empty, ARGV[7]: now, ARGV[8]: random seed,
+# ARGV[9]: draws per requested proxy
+# return: flat list of proxy, score pairs
+RANDOM_MANY_SCRIPT = """
+local now = tonumber(ARGV[7])
+local function accept(proxy)
+    if ARGV[4] == '1' and tonumber(redis.call('ZSCORE', KEYS[3], proxy) or 0) <= now then
+        return false
+    end
+    if ARGV[5] == '1' and tonumber(redis.call('ZSCORE', KEYS[4], proxy) or 0) <= now then
+        return false
+    end
+    if ARGV[6] ~= '' then
+        local latency = redis.call('ZSCORE', KEYS[2], proxy)
+        if not latency or tonumber(latency) > tonumber(ARGV[6]) then
+            return false
+        end
+    end
+    return true
+end
+local n = tonumber(ARGV[1])
+local count
+if ARGV[2] == '' then
+    count = redis.call('ZCOUNT', KEYS[1], ARGV[3], '+inf')
+    if count == 0 then
+        count = redis.call('ZCARD', KEYS[1])
+    end
+else
+    count = redis.call('ZCOUNT', KEYS[1], ARGV[2], '+inf')
+end
+local result = {}
+if count == 0 then
+    return result
+end
+math.randomseed(tonumber(ARGV[8]))
+-- candidates are the top count ranked proxies
+local function try(rank)
+    local res = redis.call('ZREVRANGE', KEYS[1], rank, rank, 'WITHSCORES')
+    if res[1] and accept(res[1]) then
+        table.insert(result, res[1])
+        table.insert(result, res[2])
+    end
+end
+if count <= n * 4 then
+    local ranks = {}
+    for i = 1, count do
+        ranks[i] = i - 1
+    end
+    for i = count, 2, -1 do
+        local j = math.random(i)
+        ranks[i], ranks[j] = ranks[j], ranks[i]
+    end
+    for i = 1, count do
+        if #result >= n * 2 then
+            break
+        end
+        try(ranks[i])
+    end
+else
+    local drawn = {}
+    for i = 1, n * tonumber(ARGV[9]) do
+        if #result >= n * 2 then
+            break
+        end
+        local rank = math.random(0, count - 1)
+        if not drawn[rank] then
+            drawn[rank] = true
+            try(rank)
+        end
+    end
+end
+return result
+"""
+
+# pick a random proxy by rank, without transferring the pool, from max score proxies,
+# or from the top ARGV[2] ranked ones if there is no max score proxy
+# KEYS[1]: proxies key, ARGV[1]: max score, ARGV[2]: fallback size, ARGV[3]: random float in [0, 1)
+# return: proxy, or false if pool is empty
+RANDOM_SCRIPT = """
+local count = redis.call('ZCOUNT', KEYS[1], ARGV[1], ARGV[1])
+if count == 0 then
+    count = math.min(redis.call('ZCARD', KEYS[1]), tonumber(ARGV[2]))
+end
+if count == 0 then
+    return false
+end
+local rank = math.floor(tonumber(ARGV[3]) * count)
+return redis.call('ZREVRANGE', KEYS[1], rank, rank)[1]
+"""
+
+# pick a random proxy with probability proportional to its score, by rejection sampling over ranks
+# KEYS[1]: proxies key, ARGV[1]: max score, ARGV[2]: max attempts, ARGV[3]: random seed
+# return: proxy, or false if pool is empty
+WEIGHTED_RANDOM_SCRIPT = """
+local card = redis.call('ZCARD', KEYS[1])
+if card == 0 then
+    return false
+end
+math.randomseed(tonumber(ARGV[3]))
+local member
+for i = 1, tonumber(ARGV[2]) do
+    local rank = math.random(0, card - 1)
+    local res = redis.call('ZRANGE', KEYS[1], rank, rank, 'WITHSCORES')
+    member = res[1]
+    if math.random() * tonumber(ARGV[1]) < tonumber(res[2]) then
+        return member
+    end
+end
+return member
+"""
+
+# lease a proxy to a client, drop expired leases first, then walk the max score proxies,
+# or the top ARGV[6] ranked ones if there is no max score proxy, round-robin from the rotation counter,
+# and take the first one with less than ARGV[3] leases
+# KEYS[1]: proxies key, KEYS[2]: leases key, KEYS[3]: lease owners key, KEYS[4]: load key, KEYS[5]: rotation key
+# ARGV[1]: now, ARGV[2]: ttl, ARGV[3]: cap, ARGV[4]: lease id, ARGV[5]: max score, ARGV[6]: fallback size,
+# ARGV[7]: max attempts
+# return: proxy, or false if no proxy is available
+LEASE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for i, id in ipairs(expired) do
+    local proxy = redis.call('HGET', KEYS[3], id)
+    if proxy and tonumber(redis.call('ZINCRBY', KEYS[4], -1, proxy)) <= 0 then
+        redis.call('ZREM', KEYS[4], proxy)
+    end
+    redis.call('HDEL', KEYS[3], id)
+    redis.call('ZREM', KEYS[2], id)
+end
+local count = redis.call('ZCOUNT', KEYS[1], ARGV[5], ARGV[5])
+if count == 0 then
+    count = math.min(redis.call('ZCARD', KEYS[1]), tonumber(ARGV[6]))
+end
+if count == 0 then
+    return false
+end
+local start = redis.call('INCR', KEYS[5])
+local cap = tonumber(ARGV[3])
+for i = 0, math.min(tonumber(ARGV[7]), count) - 1 do
+    local rank = (start + i) % count
+    local proxy = redis.call('ZREVRANGE', KEYS[1], rank, rank)[1]
+    if proxy and tonumber(redis.call('ZSCORE', KEYS[4], proxy) or 0) < cap then
+        redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + tonumber(ARGV[2]), ARGV[4])
+        redis.call('HSET', KEYS[3], ARGV[4], proxy)
+        redis.call('ZINCRBY', KEYS[4], 1, proxy)
+        if i > 0 then
+            redis.call('INCRBY', KEYS[5], i)
+        end
+        return proxy
+    end
+end
+return false
+"""
+
+# end a lease
+# KEYS[1]: leases key, KEYS[2]: lease owners key, KEYS[3]: load key, ARGV[1]: lease id
+# return: proxy of the lease, or false if the lease is unknown or expired
+RELEASE_SCRIPT = """
+local proxy = redis.call('HGET', KEYS[2], ARGV[1])
+if not proxy then
+    return false
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[1], ARGV[1])
+if tonumber(redis.call('ZINCRBY', KEYS[3], -1, proxy)) <= 0 then
+    redis.call('ZREM', KEYS[3], proxy)
+end
+return proxy
+"""
+
+
+def random_args(weighted):
+    """
+    get args of the random scripts
+    :param weighted: args of WEIGHTED_RANDOM_SCRIPT if True, else of RANDOM_SCRIPT
+    :return: list of args
+    """
+    if weighted:
+        return [PROXY_SCORE_MAX, RANDOM_WEIGHTED_ATTEMPTS, random.getrandbits(31)]
+    return [PROXY_SCORE_MAX, PROXY_SCORE_MAX - PROXY_SCORE_MIN + 1, repr(random.random())]
+
+
+def scored_proxies(pairs) -> List[Tuple[Proxy, float]]:
+    """
+    convert (proxy string, score) pairs to (proxy, score), invalid proxies are dropped
+    :param pairs: iterable of (proxy string, score)
+    :return: list of (proxy, score)
+    """
+    result = []
+    for member, score in pairs:
+        proxy = convert_proxy_or_proxies(member)
+        if proxy:
+            result.append((proxy, float(score)))
+    return result
+
+
+def random_many_args(count, min_score=None, anonymous=False, https=False, max_latency=None):
+    """
+    get args of RANDOM_MANY_SCRIPT
+    :return: list of args
+    """
+    return [count, '' if min_score is None else min_score, PROXY_SCORE_MAX, int(bool(anonymous)), int(bool(https)),
+            '' if max_latency is None else max_latency, repr(time.time()), random.getrandbits(31), RANDOM_MANY_DRAWS]
+
+
+def lease_args(ttl, cap, lease_id):
+    """
+    get args of LEASE_SCRIPT
+    :param ttl: seconds before the lease expires
+    :param cap: max leases of one proxy
+    :param lease_id: id of the new lease
+    :return: list of args
+    """
+    return [repr(time.time()), ttl, cap, lease_id, PROXY_SCORE_MAX, PROXY_SCORE_MAX - PROXY_SCORE_MIN + 1,
+            LEASE_ATTEMPTS]
+
+
+def report_args(proxy, failures, successes, expiry='', tombstone=''):
+    """
+    get args of REPORT_SCRIPT
+    :param expiry: expiry of demoted proxy, empty if proxies are not demoted
+    :param tombstone: expiry of tombstone, empty if dead proxies are not remembered
+    :return: list of args
+    """
+    return [str(proxy), failures, successes, PROXY_SCORE_MIN, REPORT_RETEST_FAILURES, REPORT_DECREASE_MAX, expiry,
+            tombstone, PROXY_SCORE_MAX]
+
+
+def page_ranges(above, count, offset, limit, page_size):
+    """
+    split ranks of proxies within a score range into pages
+    :param above: number of proxies ranked before the range
+    :param count: number of proxies in the range
+    :param offset: number of proxies to skip
+    :param limit: max number of proxies, None means no limit
+    :param page_size: number of proxies of one page
+    :return: iterator of (start, end) ranks, both inclusive
+    """
+    start = above + offset
+    stop = above + count if limit is None else min(above + count, start + limit)
+    for i in range(start, stop, page_size):
+        yield i, min(i + page_size, stop) - 1
+
 
 class RedisClient(object):
     """
@@ -21,21 +582,123 @@ class RedisClient(object):
     """
 
     def __init__(self, host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=REDIS_DB,
-                 connection_string=REDIS_CONNECTION_STRING, **kwargs):
+                 connection_string=REDIS_CONNECTION_STRING, key=REDIS_KEY, tiered=REDIS_TIERED, **kwargs):
         """
         init redis client
         :param host: redis host
         :param port: redis port
         :param password: redis password
         :param connection_string: redis connection_string
+        :param key: key of the sorted set of proxies
+        :param tiered: add new proxies as candidates, which join the pool once they pass a test
         """
+        self.key = key
+        self.tiered = tiered
+        # bumped whenever the set of max score proxies changes, so readers can tell whether their copy
+        # of the pool is outdated
+        self.version_key = f'{key}:version'
+        # moving averages of total and connect latency of proxies in ms
+        self.latency_key = f'{key}:latency'
+        self.connect_key = f'{key}:connect'
+        # timestamps proxies are due to be tested at, and their current test intervals in seconds
+        self.due_key = f'{key}:due'
+        self.interval_key = f'{key}:interval'
+        # timestamps until which proxies are known to be anonymous
+        self.anonymous_key = f'{key}:anonymous'
+        # last heartbeat timestamps of tester workers
+        self.workers_key = f'{key}:testers'
+        # failures reported by clients since their last success
+        self.failures_key = f'{key}:failures'
+        # timestamps until which proxies are known to support https
+        self.https_key = f'{key}:https'
+        # expiry timestamps of proxies not verified yet
+        self.candidates_key = f'{key}:candidates'
+        # expiry timestamps of tombstones of evicted proxies
+        self.dead_key = f'{key}:dead'
+        # failed tests of proxies which never passed one
+        self.strikes_key = f'{key}:strikes'
+        # expiry timestamps of leases, proxies of leases, number of leases of proxies, and rotation counter
+        self.leases_key = f'{key}:leases'
+        self.owners_key = f'{key}:lease'
+        self.load_key = f'{key}:load'
+        self.rotation_key = f'{key}:rotation'
         # if set connection_string, just use it
         if connection_string:
             self.db = redis.StrictRedis.from_url(connection_string, decode_responses=True, **kwargs)
         else:
             self.db = redis.StrictRedis(
                 host=host, port=port, password=password, db=db, decode_responses=True, **kwargs)
+        self.decrease_script = self.db.register_script(DECREASE_SCRIPT)
+        self.latency_script = self.db.register_script(LATENCY_SCRIPT)
+        self.random_script = self.db.register_script(RANDOM_SCRIPT)
+        self.weighted_random_script = self.db.register_script(WEIGHTED_RANDOM_SCRIPT)
+        self.random_latency_script = self.db.register_script(RANDOM_LATENCY_SCRIPT)
+        self.schedule_script = self.db.register_script(SCHEDULE_SCRIPT)
+        self.claim_script = self.db.register_script(CLAIM_SCRIPT)
+        self.lease_script = self.db.register_script(LEASE_SCRIPT)
+        self.release_script = self.db.register_script(RELEASE_SCRIPT)
+        self.report_script = self.db.register_script(REPORT_SCRIPT)
+        self.random_many_script = self.db.register_script(RANDOM_MANY_SCRIPT)
+        self.promote_script = self.db.register_script(PROMOTE_SCRIPT)
+        self.remove_script = self.db.register_script(REMOVE_SCRIPT)
+        self.candidate_script = self.db.register_script(CANDIDATE_SCRIPT)
+        self.trim_script = self.db.register_script(TRIM_SCRIPT)
+
+    @property
+    def decrease_keys(self) -> List[str]:
+        """
+        keys of DECREASE_SCRIPT
+        """
+        return [self.key, self.version_key, self.latency_key, self.connect_key, self.due_key, self.interval_key,
+                self.anonymous_key, self.failures_key, self.https_key, self.candidates_key, self.dead_key,
+                self.strikes_key]
+
+    def demote_expiry(self) -> str:
+        """
+        get expiry of proxies demoted to candidates now, the arg of DECREASE_SCRIPT and REPORT_SCRIPT
+        :return: timestamp, empty if not tiered
+        """
+        return repr(time.time() + CANDIDATE_TTL) if self.tiered else ''
+
+    @staticmethod
+    def tombstone_expiry() -> str:
+        """
+        get expiry of tombstones of proxies evicted now
+        :return: timestamp, empty if dead proxies are not remembered
+        """
+        return repr(time.time() + TOMBSTONE_TTL) if TOMBSTONE_TTL else ''
+
+    def decrease_args(self, proxy) -> list:
+        """
+        get args of DECREASE_SCRIPT
+        :param proxy: proxy
+        :return: list of args
+        """
+        return [str(proxy), PROXY_SCORE_MIN, self.demote_expiry(), self.tombstone_expiry(), PROXY_SCORE_MAX,
+                CANDIDATE_FAILURES]
+
+    @property
+    def promote_keys(self) -> List[str]:
+        """
+        keys of PROMOTE_SCRIPT
+        """
+        return [self.key, self.candidates_key, self.version_key, self.strikes_key, self.dead_key]
+
+    @property
+    def lease_keys(self) -> List[str]:
+        """
+        keys of LEASE_SCRIPT
+        """
+        return [self.key, self.leases_key, self.owners_key, self.load_key, self.rotation_key]
 
+    @property
+    def schedule_keys(self) -> List[str]:
+        """
+        keys of SCHEDULE_SCRIPT
+        """
+        return [self.key, self.due_key, self.interval_key]
+
+    @timed
     def add(self, proxy: Proxy, score=PROXY_SCORE_INIT) -> int:
         """
         add proxy and set it to init score
@@ -45,47 +708,185 @@ class RedisClient(object):
         """
         if not is_valid_proxy(f'{proxy}'):
             logger.warn(f'invalid proxy {proxy}, throw it')
-        if not self.exists(proxy):
-            if IS_REDIS_VERSION_2:
-                return self.db.zadd(REDIS_KEY, score, str(proxy))
-            return self.db.zadd(REDIS_KEY, {str(proxy): score})
+        if IS_REDIS_VERSION_2:
+            if not self.exists(proxy):
+                return self.db.zadd(self.key, score, str(proxy))
+            return 0
+        # proxies remembered as dead are skipped, like those stored by the getter
+        if TOMBSTONE_TTL and self.dead([proxy]):
+            return 0
+        pipe = self.db.pipeline(transaction=False)
+        if self.tiered:
+            self.candidate_script(keys=[self.key, self.candidates_key],
+                                  args=[repr(time.time() + CANDIDATE_TTL), str(proxy)], client=pipe)
+        else:
+            pipe.zadd(self.key, {str(proxy): score}, nx=True)
+            # new proxies are due at once
+            pipe.zadd(self.due_key, {str(proxy): 0}, nx=True)
+        return pipe.execute()[0]
 
-    def random(self) -> Proxy:
+    @timed
+    def add_many(self, proxies: Iterable[Proxy], score=PROXY_SCORE_INIT, chunk=REDIS_ADD_CHUNK) -> Tuple[int, int]:
         """
-        get random proxy
+        add proxies not in pool yet with init score, by ZADD NX in one pipeline, or as candidates if tiered,
+        the pool is not trimmed here, see trim
+        :param proxies: iterable of proxies, duplicates and invalid ones are dropped
+        :param score: int score
+        :param chunk: number of proxies added by one ZADD command
+        :return: count of new proxies, count of proxies already in pool
+        """
+        members = list(dict.fromkeys(str(proxy) for proxy in proxies if is_valid_proxy(str(proxy))))
+        if not members:
+            return 0, 0
+        pipe = self.db.pipeline(transaction=False)
+        # positions of add results in the pipeline
+        adds = []
+        expiry = repr(time.time() + CANDIDATE_TTL)
+        for i in range(0, len(members), chunk):
+            adds.append(len(pipe))
+            if self.tiered:
+                self.candidate_script(keys=[self.key, self.candidates_key], args=[expiry, *members[i:i + chunk]],
+                                      client=pipe)
+            else:
+                pipe.zadd(self.key, {member: score for member in members[i:i + chunk]}, nx=True)
+                pipe.zadd(self.due_key, {member: 0 for member in members[i:i + chunk]}, nx=True)
+        results = pipe.execute()
+        added = sum(results[i] for i in adds)
+        return added, len(members) - added
+
+    @timed
+    def random(self, weighted=RANDOM_WEIGHTED, max_latency=None) -> Proxy:
+        """
+        get random proxy in one round trip, without transferring the pool
         firstly try to get proxy with max score
         if not exists, try to get proxy by rank
         if not exists, raise error
+        :param weighted: pick from all proxies with probability proportional to score
+        :param max_latency: if set, pick from proxies whose average latency is at most this many ms
         :return: proxy, like 8.8.8.8:8
         """
-        # try to get proxy with max score
-        proxies = self.db.zrangebyscore(
-            REDIS_KEY, PROXY_SCORE_MAX, PROXY_SCORE_MAX)
-        if len(proxies):
-            return convert_proxy_or_proxies(choice(proxies))
-        # else get proxy by rank
-        proxies = self.db.zrevrange(
-            REDIS_KEY, PROXY_SCORE_MIN, PROXY_SCORE_MAX)
-        if len(proxies):
-            return convert_proxy_or_proxies(choice(proxies))
+        if max_latency is not None:
+            proxy = self.random_latency_script(keys=[self.latency_key], args=[max_latency, repr(random.random())])
+        else:
+            script = self.weighted_random_script if weighted else self.random_script
+            proxy = script(keys=[self.key], args=random_args(weighted))
+        if proxy:
+            return convert_proxy_or_proxies(proxy)
         # else raise error
         raise PoolEmptyException
 
+    @timed
+    def random_many(self, count, min_score=None, anonymous=False, https=False, max_latency=None) \
+            -> List[Tuple[str, float]]:
+        """
+        get distinct random proxies in one call
+        :param count: max number of proxies
+        :param min_score: min score, if None, pick from max score proxies, or from all if there is none
+        :param anonymous: only pick proxies known to be anonymous
+        :param https: only pick proxies known to support https
+        :param max_latency: only pick proxies whose average latency is at most this many ms
+        :return: list of (proxy, score), fewer than count if not enough proxies match
+        """
+        result = self.random_many_script(keys=[self.key, self.latency_key, self.anonymous_key, self.https_key],
+                                         args=random_many_args(count, min_score, anonymous, https, max_latency))
+        return [(proxy, float(score)) for proxy, score in zip(result[::2], result[1::2])]
+
+    @timed
     def decrease(self, proxy: Proxy):
         """
-        decrease score of proxy, if small than PROXY_SCORE_MIN, delete it
+        decrease score of proxy, if small than PROXY_SCORE_MIN, delete it, or demote it to candidate if tiered
         :param proxy: proxy
-        :return: new score
+        :return: new score, None if proxy not exists
         """
-        if IS_REDIS_VERSION_2:
-            self.db.zincrby(REDIS_KEY, str(proxy), -1)
-        else:
-            self.db.zincrby(REDIS_KEY, -1, str(proxy))
-        score = self.db.zscore(REDIS_KEY, str(proxy))
+        score = self.decrease_script(keys=self.decrease_keys, args=self.decrease_args(proxy))
+        if score is None:
+            return None
+        score = float(score)
         logger.info(f'{proxy} score decrease 1, current {score}')
         if score <= PROXY_SCORE_MIN:
-            logger.info(f'{proxy} current score {score}, remove')
-            self.db.zrem(REDIS_KEY, str(proxy))
+            logger.info(f'{proxy} current score {score}, {"demote" if self.tiered else "remove"}')
+        return score
+
+    @timed
+    def lease(self, ttl=LEASE_TTL, cap=LEASE_CAP) -> (str, Proxy):
+        """
+        lease a proxy with less than cap leases, proxies are handed out round-robin
+        :param ttl: seconds before the lease expires if it is not released
+        :param cap: max leases of one proxy at the same time
+        :return: lease id, proxy
+        """
+        lease_id = uuid.uuid4().hex
+        proxy = self.lease_script(keys=self.lease_keys, args=lease_args(ttl, cap, lease_id))
+        if not proxy:
+            raise PoolEmptyException
+        return lease_id, convert_proxy_or_proxies(proxy)
+
+    @timed
+    def release(self, lease_id, ok=True) -> Proxy:
+        """
+        end a lease, and decrease score of its proxy if the client failed with it
+        :param lease_id: lease id
+        :param ok: whether the proxy worked for the client
+        :return: proxy of the lease, None if the lease is unknown or expired
+        """
+        proxy = self.release_script(keys=[self.leases_key, self.owners_key, self.load_key], args=[lease_id])
+        if not proxy:
+            return None
+        if not ok:
+            self.decrease(proxy)
+        return convert_proxy_or_proxies(proxy)
+
+    @timed
+    def report(self, proxy, failures=0, successes=0) -> float:
+        """
+        apply reports of clients about proxy at once
+        :param proxy: proxy
+        :param failures: number of failures reported
+        :param successes: number of successes reported
+        :return: new score, None if proxy not exists
+        """
+        score = self.report_script(keys=self.decrease_keys,
+                                   args=report_args(proxy, failures, successes, self.demote_expiry(),
+                                                    self.tombstone_expiry()))
+        return None if score is None else float(score)
+
+    def reports(self, interval=REPORT_FLUSH_INTERVAL) -> 'ReportBuffer':
+        """
+        get a buffer coalescing reports of clients, which are applied in one pipeline every interval seconds
+        :param interval: seconds between flushes
+        :return: ReportBuffer, not started yet
+        """
+        return ReportBuffer(self, interval)
+
+    @timed
+    def remove_many(self, proxies: Iterable[Proxy]) -> int:
+        """
+        remove proxies with their latency, schedule and anonymity records, by one command per key
+        :param proxies: iterable of proxies
+        :return: number of proxies removed from pool
+        """
+        members = list({str(proxy) for proxy in proxies})
+        if not members:
+            return 0
+        pipe = self.db.pipeline(transaction=False)
+        calls = self.pipe_remove(pipe, members)
+        return sum(pipe.execute()[:calls])
+
+    def pipe_remove(self, pipe, members: List[str], failures=1, chunk=REDIS_ADD_CHUNK) -> int:
+        """
+        queue removal of proxies in pipeline, by one script call per chunk, whose results are the numbers
+        of proxies removed from pool, removed proxies are remembered as dead for TOMBSTONE_TTL seconds
+        :param pipe: pipeline
+        :param members: list of proxy strings
+        :param failures: failed tests after which a proxy is removed, 1 to remove at once
+        :param chunk: number of proxies removed by one script call
+        :return: number of script calls queued
+        """
+        tombstone = self.tombstone_expiry()
+        for i in range(0, len(members), chunk):
+            self.remove_script(keys=self.decrease_keys,
+                               args=[PROXY_SCORE_MAX, tombstone, failures, *members[i:i + chunk]], client=pipe)
+        return (len(members) + chunk - 1) // chunk
 
     def exists(self, proxy: Proxy) -> bool:
         """
@@ -93,42 +894,537 @@ class RedisClient(object):
         :param proxy: proxy
         :return: if exists, bool
         """
-        return not self.db.zscore(REDIS_KEY, str(proxy)) is None
+        return not self.db.zscore(self.key, str(proxy)) is None
 
+    @timed
     def max(self, proxy: Proxy) -> int:
         """
         set proxy to max score
         :param proxy: proxy
-        :return: new score
+        :return: 1 if proxy was not at max score, else 0
         """
         logger.info(f'{proxy} is valid, set to {PROXY_SCORE_MAX}')
         if IS_REDIS_VERSION_2:
-            return self.db.zadd(REDIS_KEY, PROXY_SCORE_MAX, str(proxy))
-        return self.db.zadd(REDIS_KEY, {str(proxy): PROXY_SCORE_MAX})
+            return self.db.zadd(self.key, PROXY_SCORE_MAX, str(proxy))
+        return self.promote_script(keys=self.promote_keys, args=[str(proxy), PROXY_SCORE_MAX, repr(time.time())])
+
+    @timed
+    def record_latency(self, proxy: Proxy, latency, connect=None) -> float:
+        """
+        fold latency samples of proxy into its moving averages
+        :param proxy: proxy
+        :param latency: total latency in ms
+        :param connect: connect latency in ms, None if no new connection was made
+        :return: new average of total latency, None if proxy not in pool
+        """
+        pipe = self.db.pipeline(transaction=False)
+        self.latency_script(keys=[self.latency_key, self.key], args=[str(proxy), latency, LATENCY_ALPHA],
+                            client=pipe)
+        if connect is not None:
+            self.latency_script(keys=[self.connect_key, self.key], args=[str(proxy), connect, LATENCY_ALPHA],
+                                client=pipe)
+        average = pipe.execute()[0]
+        return None if average is None else float(average)
+
+    @timed
+    def fastest(self, count) -> List[Tuple[str, float]]:
+        """
+        get proxies with the lowest average latency, among proxies whose last test passed
+        :param count: max number of proxies
+        :return: list of (proxy, latency in ms) sorted by latency
+        """
+        return self.db.zrange(self.latency_key, 0, count - 1, withscores=True)
+
+    @timed
+    def version(self) -> int:
+        """
+        get version of pool, it changes on every write
+        :return: version, int
+        """
+        return int(self.db.get(self.version_key) or 0)
+
+    @timed
+    def snapshot(self, size) -> (int, int, List[Tuple[str, float]]):
+        """
+        get version, count and top ranked proxies of pool in one round trip
+        :param size: max number of proxies
+        :return: version, count, list of (proxy, score) sorted by score desc
+        """
+        pipe = self.db.pipeline(transaction=True)
+        pipe.get(self.version_key)
+        pipe.zcard(self.key)
+        pipe.zrevrange(self.key, 0, size - 1, withscores=True)
+        version, count, proxies = pipe.execute()
+        return int(version or 0), count, proxies
 
+    @timed
     def count(self) -> int:
         """
         get count of proxies
         :return: count, int
         """
-        return self.db.zcard(REDIS_KEY)
+        return self.db.zcard(self.key)
 
+    @timed
     def all(self) -> List[Proxy]:
         """
         get all proxies
         :return: list of proxies
         """
-        return convert_proxy_or_proxies(self.db.zrangebyscore(REDIS_KEY, PROXY_SCORE_MIN, PROXY_SCORE_MAX))
+        return convert_proxy_or_proxies(self.db.zrangebyscore(self.key, PROXY_SCORE_MIN, PROXY_SCORE_MAX))
 
-    def batch(self, cursor, count) -> (int, List[Proxy]):
+    def iter_pages(self, min_score=PROXY_SCORE_MIN, max_score=PROXY_SCORE_MAX, offset=0, limit=None,
+                   page_size=API_PAGE_SIZE) -> Iterator[List[Tuple[str, float]]]:
+        """
+        iterate proxies within score range by score desc, page by page,
+        every page is fetched by rank, so it costs O(log(n) + page_size) on redis side
+        :param min_score: min score, inclusive
+        :param max_score: max score, inclusive
+        :param offset: number of proxies to skip
+        :param limit: max number of proxies, None means no limit
+        :param page_size: number of proxies fetched by one call
+        :return: iterator of lists of (proxy, score)
+        """
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zcount(self.key, f'({max_score}', '+inf')
+        pipe.zcount(self.key, min_score, max_score)
+        above, count = pipe.execute()
+        for start, end in page_ranges(above, count, offset, limit, page_size):
+            page = self.db.zrevrange(self.key, start, end, withscores=True)
+            if not page:
+                break
+            yield page
+
+    @timed
+    def batch(self, cursor, count) -> (int, List[Tuple[Proxy, float]]):
         """
         get batch of proxies
         :param cursor: scan cursor
         :param count: scan count
-        :return: list of proxies
+        :return: next cursor, list of (proxy, score)
+        """
+        cursor, proxies = self.db.zscan(self.key, cursor, count=count)
+        return cursor, scored_proxies(proxies)
+
+    @timed
+    def candidate_batch(self, cursor, count) -> (int, List[Tuple[Proxy, float]]):
+        """
+        get batch of candidates
+        :param cursor: scan cursor
+        :param count: scan count
+        :return: next cursor, list of (proxy, expiry timestamp)
+        """
+        cursor, proxies = self.db.zscan(self.candidates_key, cursor, count=count)
+        return cursor, scored_proxies(proxies)
+
+    @timed
+    def purge_candidates(self) -> (int, int):
+        """
+        drop expired candidates with their failed tests
+        :return: number of candidates dropped, number of candidates left
+        """
+        now = time.time()
+        expired = self.db.zrangebyscore(self.candidates_key, '-inf', now)
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zremrangebyscore(self.candidates_key, '-inf', now)
+        pipe.zcard(self.candidates_key)
+        for i in range(0, len(expired), REDIS_ADD_CHUNK):
+            pipe.hdel(self.strikes_key, *expired[i:i + REDIS_ADD_CHUNK])
+        return tuple(pipe.execute()[:2])
+
+    @timed
+    def purge_tombstones(self, max_number=TOMBSTONE_MAX) -> int:
+        """
+        drop expired tombstones and those beyond max_number expiring first
+        :param max_number: max number of tombstones
+        :return: number of tombstones left
+        """
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zremrangebyscore(self.dead_key, '-inf', time.time())
+        pipe.zremrangebyrank(self.dead_key, 0, -max_number - 1)
+        pipe.zcard(self.dead_key)
+        return pipe.execute()[-1]
+
+    @timed
+    def dead(self, proxies: Iterable[Proxy]) -> set:
+        """
+        check proxies against tombstones by one ZMSCORE command
+        :param proxies: iterable of proxies
+        :return: set of strings of proxies known to be dead
+        """
+        members = list({str(proxy) for proxy in proxies})
+        if not members:
+            return set()
+        now = time.time()
+        expiries = self.db.zmscore(self.dead_key, members)
+        return {member for member, expiry in zip(members, expiries) if expiry is not None and expiry > now}
+
+    @timed
+    def trim(self, max_number=PROXY_NUMBER_MAX) -> int:
+        """
+        trim pool and candidates to max_number proxies in total, candidates expiring first are dropped first,
+        then proxies with the lowest score, dropped ones are remembered as dead for TOMBSTONE_TTL seconds,
+        called once per crawl rather than on every add
+        :param max_number: max number of proxies
+        :return: number of proxies dropped
+        """
+        dropped = self.trim_script(keys=self.decrease_keys,
+                                   args=[max_number, PROXY_SCORE_MAX, self.tombstone_expiry()])
+        if dropped:
+            logger.info(f'pool is over {max_number} proxies, dropped {dropped}')
+        return dropped
+
+    @timed
+    def sync_schedule(self) -> (int, int):
+        """
+        make the due queue match the pool, proxies missing from it are due at once,
+        and proxies no longer in pool are dropped from it
+        :return: number of scheduled proxies, number of proxies due now
+        """
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zunionstore(self.due_key, {self.due_key: 1, self.key: 0}, aggregate='MAX')
+        pipe.zinterstore(self.due_key, {self.due_key: 1, self.key: 0})
+        pipe.zcount(self.due_key, '-inf', time.time())
+        _, scheduled, due = pipe.execute()
+        return scheduled, due
+
+    @timed
+    def claim_due(self, count, due=None, lease=TEST_LEASE) -> List[Tuple[Proxy, float]]:
+        """
+        claim proxies due to be tested, earliest first
+        :param count: max number of proxies
+        :param due: only claim proxies due at this timestamp, defaults to now, a tester cycle passes its
+        start time, so proxies rescheduled during the cycle are left to the next one
+        :param lease: seconds before a claimed proxy is due again if its result is not recorded
+        :return: list of (proxy, score)
+        """
+        now = repr(time.time())
+        result = self.claim_script(keys=[self.due_key, self.key],
+                                   args=[now if due is None else repr(due), count, lease, now])
+        return scored_proxies(zip(result[::2], result[1::2]))
+
+    @timed
+    def anonymous(self) -> dict:
+        """
+        get proxies known to be anonymous, and drop expired ones
+        :return: dict of proxy string to timestamp until which it is trusted
+        """
+        now = time.time()
+        pipe = self.db.pipeline(transaction=False)
+        pipe.zremrangebyscore(self.anonymous_key, '-inf', now)
+        pipe.zrangebyscore(self.anonymous_key, now, '+inf', withscores=True)
+        return dict(pipe.execute()[-1])
+
+    @timed
+    def heartbeat(self, worker_id, ttl=TEST_WORKER_TTL) -> (int, int):
+        """
+        register tester worker as alive and drop workers without heartbeat for ttl seconds
+        :param worker_id: id of worker
+        :param ttl: seconds after which a worker without heartbeat is dropped
+        :return: index of worker among alive workers sorted by id, number of alive workers
+        """
+        now = time.time()
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zadd(self.workers_key, {worker_id: now})
+        pipe.zremrangebyscore(self.workers_key, '-inf', now - ttl)
+        pipe.zrange(self.workers_key, 0, -1)
+        workers = sorted(pipe.execute()[-1])
+        return workers.index(worker_id), len(workers)
+
+    def leave(self, worker_id):
+        """
+        unregister tester worker, so its share is taken over at once
+        :param worker_id: id of worker
+        """
+        self.db.zrem(self.workers_key, worker_id)
+
+    def buffer(self, size=REDIS_FLUSH_SIZE, schedule=False) -> 'ScoreBuffer':
+        """
+        get a buffer collecting score updates, which are sent in pipelined batches
+        :param size: number of updates to collect before the buffer is full
+        :param schedule: also schedule next test of every proxy by its result
+        :return: ScoreBuffer
+        """
+        return ScoreBuffer(self, size, schedule)
+
+
+class ScoreBuffer(object):
+    """
+    collect max/decrease updates of proxies and flush them to redis in one pipeline
+    """
+
+    MAX, DECREASE, EVICT = 'max', 'decrease', 'evict'
+
+    def __init__(self, client: RedisClient, size=REDIS_FLUSH_SIZE, schedule=False):
+        """
+        :param client: redis client to flush to
+        :param size: number of updates to collect before the buffer is full
+        :param schedule: also schedule next test of every proxy by its result
+        """
+        self.client = client
+        self.size = size
+        self.schedule = schedule
+        self.pending = []
+        # guards pending, which is appended to by the event loop while a flush runs in another thread
+        self.lock = threading.Lock()
+        # keeps flushes in order, without holding up appends while a pipeline is sent
+        self.flush_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def full(self) -> bool:
+        return len(self.pending) >= self.size
+
+    def max(self, proxy: Proxy, latency=None, connect=None, anonymous=False, https=False):
+        """
+        set proxy to max score on next flush
+        :param proxy: proxy
+        :param latency: total latency of the test in ms, recorded if not None
+        :param connect: connect latency of the test in ms, recorded if not None
+        :param anonymous: proxy passed an anonymity check, trusted for TEST_ANONYMOUS_TTL seconds
+        :param https: proxy passed a test over https, trusted for TEST_ANONYMOUS_TTL seconds
+        """
+        with self.lock:
+            self.pending.append((self.MAX, str(proxy), latency, connect, anonymous, https))
+
+    def decrease(self, proxy: Proxy):
+        """
+        decrease score of proxy on next flush
+        :param proxy: proxy
+        """
+        with self.lock:
+            self.pending.append((self.DECREASE, str(proxy), None, None, False, False))
+
+    def evict(self, proxy: Proxy):
+        """
+        count a failed test of proxy which never passed one on next flush, and remove it from pool once it
+        failed CANDIDATE_FAILURES tests, evictions of one flush are sent in bulk
+        :param proxy: proxy
+        """
+        with self.lock:
+            self.pending.append((self.EVICT, str(proxy), None, None, False, False))
+
+    @timed
+    def flush(self) -> int:
+        """
+        send all pending updates in one pipeline, safe to be called from another thread
+        :return: number of updates sent
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return 0
+            client = self.client
+            pipe = client.db.pipeline(transaction=False)
+            # positions of decrease results in the pipeline
+            decreases = []
+            evictions = [item[1] for item in pending if item[0] == self.EVICT]
+            # results of evictions come first in the pipeline
+            removals = client.pipe_remove(pipe, evictions, CANDIDATE_FAILURES) if evictions else 0
+            now = time.time()
+            for op, proxy, latency, connect, anonymous, https in pending:
+                if op == self.MAX:
+                    client.promote_script(keys=client.promote_keys, args=[proxy, PROXY_SCORE_MAX, repr(now)],
+                                          client=pipe)
+                    # latency of a proxy left alone by PROMOTE_SCRIPT is not recorded
+                    if latency is not None:
+                        client.latency_script(keys=[client.latency_key, client.key],
+                                              args=[proxy, latency, LATENCY_ALPHA], client=pipe)
+                    if connect is not None:
+                        client.latency_script(keys=[client.connect_key, client.key],
+                                              args=[proxy, connect, LATENCY_ALPHA], client=pipe)
+                    if anonymous:
+                        pipe.zadd(client.anonymous_key, {proxy: now + TEST_ANONYMOUS_TTL})
+                    if https:
+                        pipe.zadd(client.https_key, {proxy: now + TEST_ANONYMOUS_TTL})
+                    # failures reported by clients are outdated by a passed test
+                    pipe.hdel(client.failures_key, proxy)
+                elif op == self.DECREASE:
+                    decreases.append(len(pipe))
+                    client.decrease_script(keys=client.decrease_keys, args=client.decrease_args(proxy), client=pipe)
+                # evictions are queued in bulk above, a proxy still in pool is scheduled like a failed one,
+                # and a removed one is dropped from the due queue
+                if self.schedule:
+                    client.schedule_script(keys=client.schedule_keys,
+                                           args=[proxy, 1 if op == self.MAX else 0, repr(now), TEST_INTERVAL_MIN,
+                                                 TEST_INTERVAL_MAX, TEST_INTERVAL_FACTOR],
+                                           client=pipe)
+            results = pipe.execute()
+        removed = sum(1 for i in decreases if results[i] is not None and float(results[i]) <= PROXY_SCORE_MIN)
+        removed += sum(results[:removals])
+        logger.debug(f'flushed {len(pending)} score updates, {removed} proxies removed')
+        return len(pending)
+
+
+class ReportBuffer(object):
+    """
+    coalesce reports of clients about proxies, and apply them in one pipeline every interval seconds
+    by a background thread
+    """
+
+    def __init__(self, client: RedisClient, interval=REPORT_FLUSH_INTERVAL):
+        """
+        :param client: redis client to flush to
+        :param interval: seconds between flushes
+        """
+        self.client = client
+        self.interval = interval
+        # proxy: [failures, successes]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def report(self, proxy, ok=True):
+        """
+        collect a report about proxy
+        :param proxy: proxy
+        :param ok: whether the proxy worked for the client
+        """
+        with self.lock:
+            counts = self.pending.setdefault(str(proxy), [0, 0])
+            counts[1 if ok else 0] += 1
+
+    @timed
+    def flush(self) -> int:
+        """
+        apply all pending reports in one pipeline
+        :return: number of proxies reported
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        client = self.client
+        pipe = client.db.pipeline(transaction=False)
+        expiry, tombstone = client.demote_expiry(), client.tombstone_expiry()
+        for proxy, (failures, successes) in pending.items():
+            client.report_script(keys=client.decrease_keys,
+                                 args=report_args(proxy, failures, successes, expiry, tombstone), client=pipe)
+        results = pipe.execute()
+        removed = sum(1 for score in results if score is not None and float(score) <= PROXY_SCORE_MIN)
+        logger.debug(f'applied reports of {len(pending)} proxies, {removed} proxies removed')
+        return len(pending)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'apply reports failed: {e!r}')
+
+    def start(self):
+        """
+        start flushing in a daemon thread
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+
+class AsyncRedisClient(object):
+    """
+    asyncio redis client of proxypool for the read side of the api, all instances
+    created in one process share the connection pool given to them
+    """
+
+    def __init__(self, host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=REDIS_DB,
+                 connection_string=REDIS_CONNECTION_STRING, key=REDIS_KEY, max_connections=REDIS_MAX_CONNECTIONS,
+                 **kwargs):
         """
-        cursor, proxies = self.db.zscan(REDIS_KEY, cursor, count=count)
-        return cursor, convert_proxy_or_proxies([i[0] for i in proxies])
+        init async redis client, must be called inside the running event loop
+        :param host: redis host
+        :param port: redis port
+        :param password: redis password
+        :param connection_string: redis connection_string
+        :param key: key of the sorted set of proxies
+        :param max_connections: size of the connection pool
+        """
+        if aioredis is None:
+            raise RuntimeError(f'redis {REDIS_CLIENT_VERSION} has no asyncio support, redis>=4.2 is required')
+        self.key = key
+        self.latency_key = f'{key}:latency'
+        self.anonymous_key = f'{key}:anonymous'
+        self.https_key = f'{key}:https'
+        if connection_string:
+            self.db = aioredis.from_url(connection_string, decode_responses=True,
+                                        max_connections=max_connections, **kwargs)
+        else:
+            pool = aioredis.ConnectionPool(host=host, port=port, password=password, db=db, decode_responses=True,
+                                           max_connections=max_connections, **kwargs)
+            self.db = aioredis.Redis(connection_pool=pool)
+        self.random_script = self.db.register_script(RANDOM_SCRIPT)
+        self.weighted_random_script = self.db.register_script(WEIGHTED_RANDOM_SCRIPT)
+        self.random_latency_script = self.db.register_script(RANDOM_LATENCY_SCRIPT)
+        self.random_many_script = self.db.register_script(RANDOM_MANY_SCRIPT)
+
+    async def random(self, weighted=RANDOM_WEIGHTED, max_latency=None) -> Proxy:
+        """
+        get random proxy, same rules as RedisClient.random
+        :param weighted: pick from all proxies with probability proportional to score
+        :param max_latency: if set, pick from proxies whose average latency is at most this many ms
+        :return: proxy, like 8.8.8.8:8
+        """
+        if max_latency is not None:
+            proxy = await self.random_latency_script(keys=[self.latency_key],
+                                                     args=[max_latency, repr(random.random())])
+        else:
+            script = self.weighted_random_script if weighted else self.random_script
+            proxy = await script(keys=[self.key], args=random_args(weighted))
+        if proxy:
+            return convert_proxy_or_proxies(proxy)
+        raise PoolEmptyException
+
+    async def random_many(self, count, min_score=None, anonymous=False, https=False, max_latency=None) \
+            -> List[Tuple[str, float]]:
+        """
+        get distinct random proxies in one call, same as RedisClient.random_many
+        :return: list of (proxy, score)
+        """
+        result = await self.random_many_script(keys=[self.key, self.latency_key, self.anonymous_key, self.https_key],
+                                               args=random_many_args(count, min_score, anonymous, https, max_latency))
+        return [(proxy, float(score)) for proxy, score in zip(result[::2], result[1::2])]
+
+    async def fastest(self, count) -> List[Tuple[str, float]]:
+        """
+        get proxies with the lowest average latency
+        :param count: max number of proxies
+        :return: list of (proxy, latency in ms) sorted by latency
+        """
+        return await self.db.zrange(self.latency_key, 0, count - 1, withscores=True)
+
+    async def count(self) -> int:
+        """
+        get count of proxies
+        :return: count, int
+        """
+        return await self.db.zcard(self.key)
+
+    async def iter_pages(self, min_score=PROXY_SCORE_MIN, max_score=PROXY_SCORE_MAX, offset=0, limit=None,
+                         page_size=API_PAGE_SIZE):
+        """
+        iterate proxies within score range by score desc, page by page, same as RedisClient.iter_pages
+        :return: async iterator of lists of (proxy, score)
+        """
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zcount(self.key, f'({max_score}', '+inf')
+        pipe.zcount(self.key, min_score, max_score)
+        above, count = await pipe.execute()
+        for start, end in page_ranges(above, count, offset, limit, page_size):
+            page = await self.db.zrevrange(self.key, start, end, withscores=True)
+            if not page:
+                break
+            yield page
+
+    async def close(self):
+        await self.db.close()
+        await self.db.connection_pool.disconnect()
 
 
 if __name__ == '__main__':
@@ -136,4 +1432,4 @@ if __name__ == '__main__':
     zset = conn.db.zrangebyscore('proxies:universal', '-inf', '+inf', withscores=True)
     for member, score in zset:
         print(member, score)
-        conn.db.zadd('proxies:universal', {member: 10})
\ No newline at end of file
+        conn.db.zadd('proxies:universal', {member: 10})